@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+#####
+#
+# Module name:  ingestbench.py
+# Purpose:      End-to-end benchmark for collecting Duplicati reports
+#
+# Notes:        Generates a mailbox of synthetic reports (see reportgen.py) and collects it with the regular dupReport code
+#               (EmailManager.checkForNewMessages() -> EmailServer.processNextMessage()) into a new database.
+#               For IMAP the messages are served by a small stand-in IMAP server running in a separate process on localhost,
+#               so the numbers include the IMAP protocol work but not a real server's disk or network time.
+#               For mbox/maildir the messages are written to a local message store first.
+#
+#               Reports messages/second, the time spent in each stage of processing and peak memory use (RSS).
+#               Stage times come from dupReport's own stage timers ([main]stagetimers, see drtiming.py), which write a summary
+#               of each collection to the stage timer file. Times from parsing worker processes (parseworkers > 1) are included.
+#               A second pass (--passes 2) collects the same mailbox again, with every message already in the database.
+#               With --incremental true (the default) the second pass should skip every message already collected.
+#
+#               Usage: python3 benchmarks/ingestbench.py [-n messages] [--log-lines n] [--batchsize n] [--parseworkers n] ...
+#               Run with -h for the full list of options.
+#
+#####
+
+# Import system modules
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import socketserver
+import sys
+import tempfile
+import time
+import zlib
+
+try:
+    import resource
+except ImportError:     # Not available on Windows. Memory use isn't reported there.
+    resource = None
+
+# dupReport modules live in the directory above this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Import dupReport modules
+import globs
+import log
+import options
+import db
+import report
+import dremail
+import drtiming
+import reportgen
+
+# UIDVALIDITY reported by the stand-in IMAP server
+benchUidValidity = 1
+
+# .rc file used for the benchmark. The outgoing server is required, but isn't used when only collecting.
+rcTemplate = """[main]
+rcversion = {rcversion}
+dbpath = {dir}/dupReport.db
+logpath = {dir}/dupReport.log
+verbose = {verbose}
+dateformat = MM/DD/YYYY
+timeformat = HH:MM:SS
+emailservers = incoming, outgoing
+collectworkers = 1
+stagetimers = true
+stagetimerfile = {dir}/stagetimes.json
+
+[incoming]
+protocol = {protocol}
+server = 127.0.0.1
+port = {port}
+encryption = none
+account = bench
+password = bench
+folder = INBOX
+path = {store}
+keepalive = false
+unreadonly = false
+markread = {markread}
+authentication = basic
+incremental = {incremental}
+batchsize = {batchsize}
+connections = {connections}
+engine = {engine}
+bodylimit = {bodylimit}
+parseworkers = {parseworkers}
+compress = {compress}
+
+[outgoing]
+protocol = smtp
+server = 127.0.0.1
+port = 25
+encryption = none
+account = bench
+password = bench
+sender = bench@example.com
+sendername = Benchmark
+receiver = bench@example.com
+keepalive = false
+authentication = basic
+"""
+
+# Minimal IMAP4rev1 server for the generated messages
+# Handles what dupReport uses: LOGIN, SELECT, UID SEARCH, UID FETCH (header fields, body text, partial body text), UID STORE
+# and, with --compress, COMPRESS DEFLATE
+class ImapHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.compressor = None      # Set once COMPRESS DEFLATE has been accepted
+        self.decompressor = None
+        self.received = b''         # Decompressed data not read yet
+        capabilities = 'IMAP4rev1 UIDPLUS' + (' COMPRESS=DEFLATE' if self.server.compress else '')
+        self.reply('* OK [CAPABILITY {}] dupReport benchmark server ready'.format(capabilities))
+        while True:
+            line = self.readline()
+            if line == b'':
+                return
+            tag, command, args = (line.decode('utf-8').rstrip('\r\n').split(' ', 2) + ['', ''])[:3]
+            command = command.upper()
+            if command == 'UID':
+                command, args = (args.split(' ', 1) + [''])[:2]
+                command = 'UID ' + command.upper()
+            if command == 'CAPABILITY':
+                self.reply('* CAPABILITY {}'.format(capabilities))
+            elif command == 'COMPRESS' and self.server.compress and self.compressor is None:
+                self.reply('{} OK DEFLATE active'.format(tag))
+                self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+                self.decompressor = zlib.decompressobj(-15)
+                continue
+            elif command == 'SELECT':
+                self.reply('* {} EXISTS\r\n* OK [UIDVALIDITY {}] UIDs valid\r\n* OK [UIDNEXT {}] Predicted next UID'.format(len(self.server.messages), benchUidValidity, len(self.server.messages) + 1))
+                self.reply('{} OK [READ-WRITE] SELECT completed'.format(tag))
+                continue
+            elif command == 'UID SEARCH':
+                self.reply('* SEARCH {}'.format(' '.join(str(uid) for uid in self.search(args))).rstrip())
+            elif command == 'UID FETCH':
+                self.fetch(*args.split(' ', 1))
+            elif command == 'UID STORE':
+                for uid in self.uidSet(args.split(' ', 1)[0]):
+                    self.server.seen.add(uid)
+            elif command == 'LOGOUT':
+                self.reply('* BYE Logging out')
+                self.reply('{} OK LOGOUT completed'.format(tag))
+                return
+            elif command not in ['LOGIN', 'NOOP', 'CLOSE']:
+                self.reply('{} BAD Unknown command'.format(tag))
+                continue
+            self.reply('{} OK {} completed'.format(tag, command))
+
+    def readline(self):
+        if self.decompressor is None:
+            return self.rfile.readline()
+        while b'\n' not in self.received:
+            data = self.rfile.read1(65536)
+            if data == b'':
+                return b''
+            self.received += self.decompressor.decompress(data)
+        line, self.received = self.received.split(b'\n', 1)
+        return line + b'\n'
+
+    def write(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.wfile.write(data)
+        return None
+
+    def reply(self, text):
+        self.write(text.encode('utf-8') + b'\r\n')
+        return None
+
+    # Expand a UID set (e.g., '1:5,7,9:*') into a list of UIDs of messages in the folder
+    def uidSet(self, spec):
+        numMessages = len(self.server.messages)
+        uids = set()
+        for part in spec.split(','):
+            first, last = (part.split(':') + [part])[:2]
+            first = numMessages if first == '*' else int(first)
+            last = numMessages if last == '*' else int(last)
+            uids.update(range(max(min(first, last), 1), min(max(first, last), numMessages) + 1))
+        return sorted(uids)
+
+    # Search criteria are ALL, UNSEEN, UID <set> and SUBJECT "<text>". SINCE is ignored, so it matches everything.
+    def search(self, criteria):
+        uids = range(1, len(self.server.messages) + 1)
+        uidRange = re.search(r'UID (\S+)', criteria)
+        if uidRange:
+            uids = self.uidSet(uidRange.group(1))
+        if 'UNSEEN' in criteria:
+            uids = [uid for uid in uids if uid not in self.server.seen]
+        subject = re.search(r'SUBJECT "((?:[^"\\]|\\.)*)"', criteria)
+        if subject:
+            text = subject.group(1).replace('\\"', '"').replace('\\\\', '\\').lower()
+            uids = [uid for uid in uids if text in self.server.subjects[uid - 1]]
+        return uids
+
+    def fetch(self, spec, items):
+        fields = re.search(r'HEADER\.FIELDS \(([^)]*)\)', items)
+        partial = re.search(r'<(\d+)\.(\d+)>', items)
+        response = []
+        for uid in self.uidSet(spec):
+            header, body = self.server.messages[uid - 1]
+            if fields:
+                wanted = fields.group(1).upper().split()
+                data = b''.join(line + b'\r\n' for line in header.split(b'\r\n') if line.split(b':', 1)[0].upper().decode() in wanted) + b'\r\n'
+                name = 'BODY[HEADER.FIELDS ({})]'.format(fields.group(1))
+            elif partial:
+                start, length = int(partial.group(1)), int(partial.group(2))
+                data = body[start:start + length]
+                name = 'BODY[TEXT]<{}>'.format(start)
+            else:
+                data = body
+                name = 'BODY[TEXT]'
+            response.append('* {} FETCH (UID {} {} {{{}}}\r\n'.format(uid, uid, name, len(data)).encode('utf-8') + data + b')\r\n')
+        self.write(b''.join(response))
+        return None
+
+class ImapServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+# Run the stand-in IMAP server. Runs in its own process so it doesn't compete with the code being measured.
+# The port it's listening on is sent back through 'conn'.
+def runImapServer(args, conn):
+    server = ImapServer(('127.0.0.1', 0), ImapHandler)
+    messages = reportgen.messagesFromArgs(args)
+    server.messages = [(message['header'].encode('utf-8'), message['body'].encode('utf-8')) for message in messages]
+    server.subjects = [re.search(r'^Subject: (.*)$', message['header'], re.MULTILINE).group(1).lower() for message in messages]
+    server.seen = set()
+    server.compress = args.compress
+    conn.send(server.server_address[1])
+    server.serve_forever()
+    return None
+
+# Peak RSS in MB for this process ('self') or its finished worker processes ('children')
+def peakRss(who):
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)   # Bytes on macOS, KB elsewhere
+
+# Stage times for the last collection, as written to the stage timer file by drtiming.StageTimer.writeSummary()
+def stageSummary():
+    with open(globs.opts['stagetimerfile']) as timerFile:
+        lines = timerFile.read().splitlines()
+    return json.loads(lines[-1])['stages'] if lines else {}
+
+def printPass(passNum, result):
+    print('\nPass {}: {} messages in {:.2f}s = {:.1f} msgs/sec. {} reports in database.'.format(passNum, result['messages'], result['elapsedSec'], result['msgsPerSec'], result['reports']))
+    print('{:<14} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('stage', 'count', 'total s', 'mean ms', 'p50<= ms', 'p95<= ms', 'max ms'))
+    for stage, stats in result['stages'].items():
+        print('{:<14} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(stage, stats['count'], stats['totalMs'] / 1000, stats['meanMs'], stats['p50Ms'], stats['p95Ms'], stats['maxMs']))
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark collecting synthetic Duplicati reports.')
+    reportgen.addGeneratorArgs(parser)
+    parser.add_argument('--protocol', choices=['imap', 'mbox', 'maildir'], default='imap', help='Where the messages are collected from. Default imap')
+    parser.add_argument('--batchsize', type=int, default=500, help='IMAP batchsize= option. Default 500')
+    parser.add_argument('--connections', type=int, default=1, help='IMAP connections= option. Default 1')
+    parser.add_argument('--engine', choices=['sync', 'async'], default='sync', help='IMAP engine= option. Default sync')
+    parser.add_argument('--bodylimit', type=int, default=0, help='IMAP bodylimit= option. Default 0')
+    parser.add_argument('--parseworkers', type=int, default=1, help='parseworkers= option. Default 1')
+    parser.add_argument('--compress', action='store_true', help='Have the IMAP server offer COMPRESS=DEFLATE and set compress=true')
+    parser.add_argument('--markread', action='store_true', help='Set markread=true')
+    parser.add_argument('--incremental', choices=['true', 'false'], default='true', help='IMAP incremental= option. Default true')
+    parser.add_argument('--passes', type=int, default=1, help='Number of times to collect the mailbox. Default 1')
+    parser.add_argument('--verbose', type=int, default=3, help='Log level (verbose= option). Default 3')
+    parser.add_argument('--json', metavar='FILE', help='Also write the results to FILE in JSON format')
+    parser.add_argument('--keep', action='store_true', help='Keep the database, log and .rc file instead of deleting them')
+    args = parser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix='dupreport-bench-')
+    storePath = os.path.join(workDir, 'store')
+    serverProcess = None
+    port = 0
+    if args.protocol == 'imap':
+        parentConn, childConn = multiprocessing.Pipe()
+        serverProcess = multiprocessing.Process(target=runImapServer, args=(args, childConn), daemon=True)
+        serverProcess.start()
+        port = parentConn.recv()
+    else:
+        reportgen.writeStore(reportgen.messagesFromArgs(args), args.protocol, storePath)
+
+    rcPath = os.path.join(workDir, 'dupReport.rc')
+    with open(rcPath, 'w') as rcFile:
+        rcFile.write(rcTemplate.format(rcversion='{}.{}.{}'.format(*globs.rcVersion), dir=workDir, verbose=args.verbose, protocol=args.protocol, port=port, store=storePath, markread=str(args.markread).lower(),
+                                       incremental=args.incremental, compress=str(args.compress).lower(),
+                                       batchsize=args.batchsize, connections=args.connections, engine=args.engine, bodylimit=args.bodylimit, parseworkers=args.parseworkers))
+
+    # Same start-up sequence as dupReport.py, collecting only (-c)
+    globs.progPath = workDir
+    globs.log = log.LogHandler()
+    sys.argv = ['dupReport.py', '-r', rcPath, '-c']
+    if not options.initOptions():
+        print('Unable to read benchmark .rc file {}'.format(rcPath))
+        return 1
+    globs.log.openLog(globs.opts['logpath'], False, globs.opts['verbose'])
+    globs.timer = drtiming.StageTimer(globs.opts['stagetimers'])
+    globs.report = report.Report()
+    globs.db = db.Database(globs.opts['dbpath'])
+    globs.emailManager = dremail.EmailManager()
+
+    results = {'args': vars(args), 'passes': []}
+    startRss = peakRss('self')
+    for passNum in range(1, args.passes + 1):
+        start = time.perf_counter()
+        globs.emailManager.checkForNewMessages()
+        elapsed = time.perf_counter() - start
+        result = {
+            'messages': args.messages,
+            'elapsedSec': elapsed,
+            'msgsPerSec': args.messages / elapsed if elapsed > 0 else 0.0,
+            'reports': globs.db.execSqlStmt('SELECT COUNT(*) FROM emails').fetchone()[0],
+            'stages': stageSummary()
+            }
+        results['passes'].append(result)
+        printPass(passNum, result)
+
+    results['peakRssMb'] = peakRss('self')
+    results['startRssMb'] = startRss
+    results['workerPeakRssMb'] = peakRss('children')     # Only includes processes that have finished. The stand-in server is still running.
+    if results['peakRssMb'] is not None:
+        print('\nPeak RSS: {:.1f} MB (was {:.1f} MB before collecting). Parse worker processes: {:.1f} MB.'.format(results['peakRssMb'], results['startRssMb'], results['workerPeakRssMb']))
+
+    globs.emailManager.incoming['incoming'].close()
+    globs.db.dbClose()
+    globs.log.closeLog()
+    if serverProcess is not None:
+        serverProcess.terminate()
+        serverProcess.join()
+
+    if args.json:
+        with open(args.json, 'w') as jsonFile:
+            json.dump(results, jsonFile, indent=2)
+    if args.keep:
+        print('Benchmark files kept in {}'.format(workDir))
+    else:
+        shutil.rmtree(workDir)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
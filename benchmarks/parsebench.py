@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+#####
+#
+# Module name:  parsebench.py
+# Purpose:      Microbenchmark for parsing the text (non-JSON) Duplicati report format
+#
+# Notes:        Compares EmailServer.searchMessageParts(), which finds every lineParts field in one scan of the
+#               message body, with calling EmailServer.searchMessagePart() once for each lineParts entry.
+#               Both must return the same values for every test message.
+#
+#               Usage: python3 benchmarks/parsebench.py [iterations]
+#
+#####
+
+# Import system modules
+import os
+import sys
+import time
+
+# dupReport modules live in the directory above this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Import dupReport modules
+import globs
+import log
+import dremail
+
+# Build a "classic" Duplicati report body
+# logLines - number of lines in each of the Messages/Warnings/Errors sections
+# failed - True to build a failed backup report, with the exception text and stack trace Duplicati sends
+def reportBody(logLines, failed):
+    lines = []
+    for num in range(logLines):
+        lines.append('    "2020-05-17 02:10:{:02d} -04 - [Information-Duplicati.Library.Main.BasicResults-BackendEvent]: Backend event: Put - Completed: duplicati-b{:032x}.dblock.zip.aes (49.93 MB)",'.format(num % 60, num))
+    logSection = '\n'.join(lines)
+
+    body = ''
+    if failed:
+        body += 'Failed: The remote server returned an error: (550) File unavailable (e.g., file not found, no access).\n'
+        body += 'Details: System.Net.WebException: The remote server returned an error: (550) File unavailable (e.g., file not found, no access).\n'
+        body += ''.join('   at Duplicati.Library.Backend.FTP.List{}(String filename)\n'.format(num) for num in range(logLines))
+        body += '\n'
+    body += 'DeletedFiles: 12\nDeletedFolders: 0\nModifiedFiles: 30\nExaminedFiles: 412339\nOpenedFiles: 43\nAddedFiles: 13\n'
+    body += 'SizeOfModifiedFiles: 23 KB (23556)\nSizeOfAddedFiles: 10.12 KB (10364)\nSizeOfExaminedFiles: 44.42 GB (47695243956)\nSizeOfOpenedFiles: 33.16 KB (33954)\n'
+    body += 'NotProcessedFiles: 0\nAddedFolders: 1\nTooLargeFiles: 0\nFilesWithError: 0\nModifiedFolders: 0\nModifiedSymlinks: 0\nAddedSymlinks: 0\nDeletedSymlinks: 0\n'
+    body += 'PartialBackup: False\nDryrun: False\nMainOperation: Backup\n'
+    body += 'ParsedResult: {}\nVersion: 2.0.5.1 (2.0.5.1_beta_2020-01-18)\n'.format('Fatal' if failed else 'Success')
+    body += 'EndTime: 5/17/2020 2:12:09 AM (1589695929)\nBeginTime: 5/17/2020 2:10:00 AM (1589695800)\nDuration: 00:02:09.3720000\n'
+    body += 'Messages: [\n{}\n]\nWarnings: []\nErrors: [\n{}\n]\n'.format(logSection, logSection if failed else '')
+    body += 'BackendStatistics:\n    RemoteCalls: 12\n    BytesUploaded: 104857600\n    BytesDownloaded: 52428800\n'
+    body += '\nLog data:\n{}\n'.format(logSection)
+    return body
+
+# Time one parser. Returns (seconds per message, last result)
+def timeParser(parser, body, iterations):
+    start = time.perf_counter()
+    for num in range(iterations):
+        result = parser(body)
+    return (time.perf_counter() - start) / iterations, result
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    # Log to nowhere. Both parsers write debug lines; keep the cost of formatting them in the numbers.
+    globs.progPath = os.path.dirname(os.path.abspath(__file__))
+    globs.log = log.LogHandler()
+    globs.log.logFile = open(os.devnull, 'w')
+    server = dremail.EmailServer('bench', {})
+
+    perField = lambda body: {section: server.searchMessagePart(body, regex, flag, typ) for section, regex, flag, typ, jsonSection in dremail.lineParts}
+    singlePass = server.searchMessageParts
+
+    print('{:>10} {:>7} {:>10} {:>14} {:>14} {:>8}'.format('log lines', 'failed', 'body KB', 'per-field ms', 'one-pass ms', 'speedup'))
+    for logLines in (10, 1000, 10000, 50000):
+        for failed in (False, True):
+            body = reportBody(logLines, failed)
+            oldTime, oldResult = timeParser(perField, body, iterations)
+            newTime, newResult = timeParser(singlePass, body, iterations)
+            if oldResult != newResult:
+                print('Results differ for log lines={} failed={}: {}'.format(logLines, failed, [section for section in oldResult if oldResult[section] != newResult[section]]))
+                return 1
+            print('{:>10} {:>7} {:>10.1f} {:>14.3f} {:>14.3f} {:>7.1f}x'.format(logLines, str(failed), len(body) / 1024, oldTime * 1000, newTime * 1000, oldTime / newTime))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+#####
+#
+# Module name:  queryplancheck.py
+# Purpose:      Check that reports read the emails table through the (pairId, endTimestamp) index
+#
+# Notes:        Builds a database in the old (3.0.5) format, upgrades it with convert.convertDb(), and runs the report
+#               extraction (set-based and one email at a time) and report.getLatestTimestamp() against it, recording
+#               every SQL statement executed.
+#               Each statement that reads the emails table goes through EXPLAIN QUERY PLAN. It must use srcdestindx,
+#               must not scan the emails table, and must not need a temporary b-tree to sort its results.
+#               A newly created database is checked the same way.
+#
+#               Usage: python3 benchmarks/queryplancheck.py
+#
+#####
+
+# Import system modules
+import os
+import re
+import sys
+import sqlite3
+import tempfile
+
+# dupReport modules live in the directory above this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Import dupReport modules
+import globs
+import log
+import db
+import convert
+import report
+import drtiming
+
+# Stand-in for the .rc file option manager. No source/destination pairs are ignored.
+class NoRcOptions:
+    def getRcOption(self, section, option):
+        return None
+
+# Tables as they were in database version 3.0.5
+oldTables = [
+    "CREATE TABLE version (desc varchar(20), major int, minor int, subminor int)",
+    "INSERT INTO version (desc, major, minor, subminor) VALUES ('database', 3, 0, 5)",
+    "CREATE TABLE emails (messageId varchar(50), sourceComp varchar(50), destComp varchar(50), emailTimestamp real, deletedFiles int, deletedFolders int, modifiedFiles int, \
+        examinedFiles int, openedFiles int, addedFiles int, sizeOfModifiedFiles int, sizeOfAddedFiles int, sizeOfExaminedFiles int, sizeOfOpenedFiles int, notProcessedFiles int, addedFolders int, \
+        tooLargeFiles int, filesWithError int, modifiedFolders int, modifiedSymlinks int, addedSymlinks int, deletedSymlinks int, partialBackup varchar(30), dryRun varchar(30), mainOperation varchar(30), \
+        parsedResult varchar(30), verboseOutput varchar(30), verboseErrors varchar(30), endTimestamp real, beginTimestamp real, duration real, messages varchar(255), warnings varchar(255), errors varchar(255), \
+        failedMsg varchar(100), dbSeen int, dupversion varchar(100), logdata varchar(255), bytesUploaded int, bytesDownloaded int)",
+    "CREATE UNIQUE INDEX emailindx ON emails (messageId)",
+    "CREATE INDEX srcdestindx ON emails (sourceComp, destComp)",
+    "CREATE TABLE report (source varchar(20), destination varchar(20), timestamp real, date real, time real, duration real, examinedFiles int, examinedFilesDelta int, \
+        sizeOfExaminedFiles int, fileSizeDelta int, addedFiles int, deletedFiles int, modifiedFiles int, filesWithError int, parsedResult varchar(30), messages varchar(255), \
+        warnings varchar(255), errors varchar(255), failedMsg varchar(100), dupversion varchar(100), logdata varchar(255), bytesUploaded int, bytesDownloaded int)",
+    "CREATE TABLE backupsets (source varchar(20), destination varchar(20), lastFileCount integer, lastFileSize integer, lastTimestamp real, dupversion varchar(100))",
+    "CREATE TABLE imapsync (server varchar(50), account varchar(50), folder varchar(50), uidValidity int, lastUid int)",
+    "CREATE TABLE pop3uidl (server varchar(50), account varchar(50), uidl varchar(70))",
+    "CREATE TABLE imapcheckpoint (server varchar(50), account varchar(50), folder varchar(50), uidValidity int, lastUid int, batchId int, timestamp real)",
+    ]
+
+# Source/destination pairs and emails put in the test databases
+numPairs = 5
+emailsPerPair = 200
+firstTimestamp = 1500000000
+
+# Create a database in the 3.0.5 format
+def buildOldDb(dbPath):
+    conn = sqlite3.connect(dbPath)
+    for stmt in oldTables:
+        conn.execute(stmt)
+    for pair in range(numPairs):
+        source, destination = 'Source{}'.format(pair), 'Dest{}'.format(pair)
+        # Half of each backup set's emails are newer than its last report
+        conn.execute("INSERT INTO backupsets VALUES (?, ?, 0, 0, ?, '')", (source, destination, firstTimestamp + (emailsPerPair // 2) * 3600))
+        for num in range(emailsPerPair):
+            conn.execute("INSERT INTO emails (messageId, sourceComp, destComp, emailTimestamp, examinedFiles, sizeOfExaminedFiles, endTimestamp, beginTimestamp, duration, parsedResult, dbSeen, dupversion) \
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 60, 'Success', 1, '2.0.5.1')", ('<{}.{}@check>'.format(pair, num), source, destination, firstTimestamp + num * 3600, num, num * 1000,
+                firstTimestamp + num * 3600, firstTimestamp + num * 3600 - 60))
+    conn.commit()
+    conn.close()
+    return None
+
+# Create a database with the current tables and the same backup sets. Query plans don't depend on there being emails.
+def buildNewDb(dbPath):
+    globs.db = db.Database(dbPath)
+    for pair in range(numPairs):
+        globs.db.searchSrcDestPair('Source{}'.format(pair), 'Dest{}'.format(pair))
+    globs.db.dbCommit()
+    return None
+
+# Run both ways of extracting report data and look up each backup set's latest timestamp, returning the statements executed that read the emails table
+def extractStatements():
+    statements = []
+    globs.db.dbConn.set_trace_callback(statements.append)
+
+    for pair in range(numPairs):
+        report.getLatestTimestamp('Source{}'.format(pair), 'Dest{}'.format(pair))
+    reporter = report.Report.__new__(report.Report)     # Only extraction is needed. Skips reading the report layout from the .rc file.
+    reporter.resultList = {}
+    savedTimestamps = globs.db.execSqlStmt("SELECT pairId, lastTimestamp FROM backupsets").fetchall()
+    reporter.extractReportDataByRow()
+    globs.db.execSqlMany("UPDATE backupsets SET lastTimestamp = ? WHERE pairId = ?", [(lastTimestamp, pairId) for pairId, lastTimestamp in savedTimestamps])
+    globs.db.dbCommit()
+    globs.db.forgetBackupSets()
+    if sqlite3.sqlite_version_info >= (3, 25, 0):
+        reporter.extractReportData()
+
+    globs.db.dbConn.set_trace_callback(None)
+    checked = []
+    for stmt in statements:
+        if re.search(r'\bemails\b', stmt) and not stmt.lstrip().upper().startswith('EXPLAIN') and stmt not in checked:
+            checked.append(stmt)
+    return checked
+
+# Check one statement's query plan. Returns a list of problems, empty if there are none.
+def checkPlan(stmt):
+    plan = [row[3] for row in globs.db.dbConn.execute('EXPLAIN QUERY PLAN ' + stmt).fetchall()]
+    problems = ['scans the emails table: ' + line for line in plan if re.match(r'SCAN (emails|e)\b', line)]
+    problems += ['searches the emails table without srcdestindx: ' + line for line in plan if re.match(r'SEARCH (emails|e)\b', line) and 'srcdestindx' not in line]
+    problems += ['sorts its results: ' + line for line in plan if 'USE TEMP B-TREE FOR ORDER BY' in line]
+    if not any('srcdestindx' in line for line in plan):
+        problems.append('does not use srcdestindx: {}'.format(plan))
+    return problems
+
+# Check every statement run against the database in globs.db. Returns the number of statements with problems.
+def checkDb(description):
+    failed = 0
+    statements = extractStatements()
+    if not statements:
+        print('FAILED  {}: no statements read the emails table'.format(description))
+        return 1
+    for stmt in statements:
+        problems = checkPlan(stmt)
+        result = 'ok' if not problems else 'FAILED'
+        if problems:
+            failed += 1
+        print('{:<7} {}: {}'.format(result, description, ' '.join(stmt.split())[:100]))
+        for problem in problems:
+            print('            {}'.format(problem))
+    return failed
+
+def main():
+    globs.progPath = os.path.dirname(os.path.abspath(__file__))
+    globs.log = log.LogHandler()
+    globs.log.logFile = open(os.devnull, 'w')
+    globs.timer = drtiming.StageTimer(False)
+    globs.optionManager = NoRcOptions()
+
+    failed = 0
+    with tempfile.TemporaryDirectory() as tempDir:
+        # Upgraded database
+        globs.opts = {'dbpath': os.path.join(tempDir, 'upgraded.db'), 'srcdestdelimiter': '-', 'dateformat': 'MM/DD/YYYY', 'timeformat': 'HH:MM:SS', 'show24hourtime': True}
+        buildOldDb(globs.opts['dbpath'])
+        globs.db = db.Database(globs.opts['dbpath'])
+        needToUpgrade, currVerNum = globs.db.checkDbVersion()
+        if needToUpgrade:
+            convert.convertDb(currVerNum)
+        failed += checkDb('upgraded from 3.0.5')
+        globs.db.dbClose()
+
+        # New database
+        globs.opts['dbpath'] = os.path.join(tempDir, 'new.db')
+        buildNewDb(globs.opts['dbpath'])
+        failed += checkDb('new database')
+        globs.db.dbClose()
+    return 1 if failed > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+#####
+#
+# Module name:  reportgen.py
+# Purpose:      Generate synthetic Duplicati report emails for benchmarking
+#
+# Notes:        Builds a mailbox of Duplicati job reports in the text ("classic") and JSON formats, mixed with some
+#               messages that aren't reports. The size of the log sections, the share of failed backups and the number
+#               of source & destination computers can all be set. The same arguments and seed always give the same mailbox.
+#
+#               Used by ingestbench.py. Can also be run by itself to write the messages to a local message store:
+#               Usage: python3 benchmarks/reportgen.py [-n messages] [--log-lines n] [--fail-ratio r] ... (mbox|maildir) path
+#
+#####
+
+# Import system modules
+import argparse
+import email.utils
+import json
+import mailbox
+import quopri
+import random
+import sys
+import time
+
+# Time of the first generated report. Each source/destination pair gets one report a day after that.
+firstReportTime = 1589695800
+
+# Header fields in each generated message
+headerFormat = 'Date: {date}\r\nFrom: Duplicati <duplicati@{source}.example.com>\r\nTo: backups@example.com\r\nSubject: {subject}\r\n' \
+               'Message-ID: {messageId}\r\nMIME-Version: 1.0\r\nContent-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: {cte}\r\n'
+
+# Log lines for the Messages/Warnings/Errors sections and the log data
+logFormats = [
+    '{time} - [Information-Duplicati.Library.Main.Controller-StartingOperation]: The operation Backup has started',
+    '{time} - [Information-Duplicati.Library.Main.BasicResults-BackendEvent]: Backend event: Put - Started: duplicati-b{hash}.dblock.zip.aes (49.93 MB)',
+    '{time} - [Information-Duplicati.Library.Main.BasicResults-BackendEvent]: Backend event: Put - Completed: duplicati-b{hash}.dblock.zip.aes (49.93 MB)',
+    '{time} - [Information-Duplicati.Library.Main.BasicResults-BackendEvent]: Backend event: List - Completed:  (1.02 KB)',
+    '{time} - [Warning-Duplicati.Library.Main.Operation.Backup.FileEnumerationProcess-FileAccessError]: Error reported while accessing file: C:\\Users\\user\\AppData\\Local\\Temp\\{hash}.tmp',
+    ]
+
+# Subjects of the messages that aren't Duplicati reports
+otherSubjects = ['Weekly newsletter', 'Re: Lunch on Friday?', 'Your invoice is ready', 'Disk space warning on fileserver']
+
+# Build the log lines for a report
+def logLines(rng, count, endTime):
+    lines = []
+    for num in range(count):
+        lineTime = endTime - count + num
+        lines.append(rng.choice(logFormats).format(time=email.utils.formatdate(lineTime), hash='{:032x}'.format(rng.getrandbits(128))))
+    return lines
+
+# Build the body of a text ("classic") format report
+def textReport(rng, numLogLines, failed, beginTime, endTime):
+    lines = logLines(rng, numLogLines, endTime)
+    logSection = ''.join('    "{}",\r\n'.format(line) for line in lines)
+
+    body = ''
+    if failed:
+        body += 'Failed: The remote server returned an error: (550) File unavailable (e.g., file not found, no access).\r\n'
+        body += 'Details: System.Net.WebException: The remote server returned an error: (550) File unavailable (e.g., file not found, no access).\r\n'
+        body += ''.join('   at Duplicati.Library.Backend.FTP.List{}(String filename)\r\n'.format(num) for num in range(max(numLogLines // 4, 3)))
+        body += '\r\nLog data:\r\n{}\r\n'.format('\r\n'.join(lines))
+        return body
+
+    examined = rng.randint(1000, 500000)
+    body += 'DeletedFiles: {}\r\nDeletedFolders: 0\r\nModifiedFiles: {}\r\nExaminedFiles: {}\r\nOpenedFiles: {}\r\nAddedFiles: {}\r\n'.format(rng.randint(0, 50), rng.randint(0, 200), examined, rng.randint(0, 300), rng.randint(0, 100))
+    body += 'SizeOfModifiedFiles: 23 KB ({})\r\nSizeOfAddedFiles: 10.12 KB ({})\r\nSizeOfExaminedFiles: 44.42 GB ({})\r\nSizeOfOpenedFiles: 33.16 KB ({})\r\n'.format(rng.randint(0, 10**7), rng.randint(0, 10**7), examined * 100000, rng.randint(0, 10**7))
+    body += 'NotProcessedFiles: 0\r\nAddedFolders: 1\r\nTooLargeFiles: 0\r\nFilesWithError: 0\r\nModifiedFolders: 0\r\nModifiedSymlinks: 0\r\nAddedSymlinks: 0\r\nDeletedSymlinks: 0\r\n'
+    body += 'PartialBackup: False\r\nDryrun: False\r\nMainOperation: Backup\r\nCompactResults: null\r\n'
+    body += 'DeleteResults:\r\n    DeletedSets: []\r\n    Dryrun: False\r\n    MainOperation: Delete\r\n    ParsedResult: Success\r\n'
+    body += 'ParsedResult: Success\r\nVersion: 2.0.5.1 (2.0.5.1_beta_2020-01-18)\r\n'
+    body += 'EndTime: {} ({})\r\nBeginTime: {} ({})\r\nDuration: 00:{:02d}:{:02d}\r\n'.format(email.utils.formatdate(endTime), endTime, email.utils.formatdate(beginTime), beginTime, (endTime - beginTime) // 60, (endTime - beginTime) % 60)
+    body += 'Messages: [\r\n{}]\r\nWarnings: []\r\nErrors: []\r\n'.format(logSection)
+    body += 'BackendStatistics:\r\n    RemoteCalls: 12\r\n    BytesUploaded: {}\r\n    BytesDownloaded: {}\r\n'.format(rng.randint(0, 10**9), rng.randint(0, 10**8))
+    body += '\r\nLog data:\r\n\r\n'
+    return body
+
+# Build the body of a JSON format report
+def jsonReport(rng, numLogLines, failed, beginTime, endTime, backupName):
+    rfc3339 = lambda timestamp: '{}.{:07d}Z'.format(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)), rng.randint(0, 9999999))
+    examined = rng.randint(1000, 500000)
+    data = {
+        'DeletedFiles': rng.randint(0, 50), 'DeletedFolders': 0, 'ModifiedFiles': rng.randint(0, 200), 'ExaminedFiles': examined,
+        'OpenedFiles': rng.randint(0, 300), 'AddedFiles': rng.randint(0, 100), 'SizeOfModifiedFiles': rng.randint(0, 10**7),
+        'SizeOfAddedFiles': rng.randint(0, 10**7), 'SizeOfExaminedFiles': examined * 100000, 'SizeOfOpenedFiles': rng.randint(0, 10**7),
+        'NotProcessedFiles': 0, 'AddedFolders': 1, 'TooLargeFiles': 0, 'FilesWithError': 0, 'ModifiedFolders': 0, 'ModifiedSymlinks': 0,
+        'AddedSymlinks': 0, 'DeletedSymlinks': 0, 'PartialBackup': False, 'Dryrun': False, 'MainOperation': 'Backup',
+        'ParsedResult': 'Fatal' if failed else 'Success', 'Version': '2.0.5.1 (2.0.5.1_beta_2020-01-18)',
+        'EndTime': rfc3339(endTime), 'BeginTime': rfc3339(beginTime), 'Duration': '00:{:02d}:{:02d}'.format((endTime - beginTime) // 60, (endTime - beginTime) % 60),
+        'Messages': [], 'Warnings': [], 'Errors': [],
+        'BackendStatistics': {'RemoteCalls': 12, 'BytesUploaded': rng.randint(0, 10**9), 'BytesDownloaded': rng.randint(0, 10**8)}
+        }
+    if failed:
+        data['Message'] = 'The remote server returned an error: (550) File unavailable (e.g., file not found, no access).'
+        data['Exception'] = 'System.Net.WebException: ' + data['Message']
+    report = {
+        'Data': data,
+        'Extra': {'OperationName': 'Backup', 'machine-name': backupName.split('-')[0], 'backup-name': backupName},
+        'LogLines': logLines(rng, numLogLines, endTime)
+        }
+    return json.dumps(report)
+
+# Build a mailbox of synthetic messages
+# count - number of messages
+# numLogLines - number of log lines in each report
+# failRatio - share of the reports that are for failed backups
+# jsonRatio - share of the reports in JSON format
+# otherRatio - share of the messages that aren't Duplicati reports
+# qpRatio - share of the messages sent with quoted-printable encoding
+# sources, destinations - number of source & destination computers. Reports cycle through every pair.
+# Returns a list of {'header': header text, 'body': body text}, oldest first
+def makeMessages(count, numLogLines=20, failRatio=0.05, jsonRatio=0.3, otherRatio=0.1, qpRatio=0.0, sources=20, destinations=2, seed=1):
+    rng = random.Random(seed)
+    pairs = [('Source{:04d}'.format(src), 'Dest{:02d}'.format(dest)) for src in range(sources) for dest in range(destinations)]
+    messages = []
+    numReports = 0
+    for num in range(count):
+        source, dest = pairs[numReports % len(pairs)]
+        endTime = firstReportTime + (numReports // len(pairs)) * 86400 + (numReports % len(pairs)) * 7
+        beginTime = endTime - rng.randint(30, 3600)
+        if rng.random() < otherRatio:
+            subject = rng.choice(otherSubjects)
+            body = 'This message is not a Duplicati report.\r\n' * 5
+        else:
+            subject = 'Duplicati Backup report for {}-{}'.format(source, dest)
+            failed = rng.random() < failRatio
+            if rng.random() < jsonRatio:
+                body = jsonReport(rng, numLogLines, failed, beginTime, endTime, '{}-{}'.format(source, dest))
+            else:
+                body = textReport(rng, numLogLines, failed, beginTime, endTime)
+            numReports += 1
+        cte = '7bit'
+        if rng.random() < qpRatio:
+            cte = 'quoted-printable'
+            body = quopri.encodestring(body.encode('utf-8')).decode('ascii')
+        header = headerFormat.format(date=email.utils.formatdate(endTime + 5), source=source, subject=subject, messageId='<{:08d}.{:016x}@{}.example.com>'.format(num, rng.getrandbits(64), source), cte=cte)
+        messages.append({'header': header, 'body': body})
+    return messages
+
+# Write messages to a local message store
+# storeType - 'mbox' or 'maildir'
+def writeStore(messages, storeType, path):
+    store = mailbox.mbox(path) if storeType == 'mbox' else mailbox.Maildir(path)
+    store.lock()
+    for message in messages:
+        store.add((message['header'] + '\r\n' + message['body']).encode('utf-8'))
+    store.flush()
+    store.unlock()
+    store.close()
+    return None
+
+# Command line options shared with ingestbench.py
+def addGeneratorArgs(parser):
+    parser.add_argument('-n', '--messages', type=int, default=2000, help='Number of messages. Default 2000')
+    parser.add_argument('--log-lines', type=int, default=20, help='Log lines in each report. Default 20')
+    parser.add_argument('--fail-ratio', type=float, default=0.05, help='Share of reports for failed backups. Default 0.05')
+    parser.add_argument('--json-ratio', type=float, default=0.3, help='Share of reports in JSON format. Default 0.3')
+    parser.add_argument('--other-ratio', type=float, default=0.1, help='Share of messages that aren\'t reports. Default 0.1')
+    parser.add_argument('--qp-ratio', type=float, default=0.0, help='Share of messages with quoted-printable encoding. Default 0')
+    parser.add_argument('--sources', type=int, default=20, help='Number of source computers. Default 20')
+    parser.add_argument('--destinations', type=int, default=2, help='Number of destinations for each source. Default 2')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed. Default 1')
+    return None
+
+# Build the messages described by the command line options
+def messagesFromArgs(args):
+    return makeMessages(args.messages, numLogLines=args.log_lines, failRatio=args.fail_ratio, jsonRatio=args.json_ratio, otherRatio=args.other_ratio,
+                        qpRatio=args.qp_ratio, sources=args.sources, destinations=args.destinations, seed=args.seed)
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic Duplicati report emails.')
+    addGeneratorArgs(parser)
+    parser.add_argument('storetype', choices=['mbox', 'maildir'], help='Type of message store to write')
+    parser.add_argument('path', help='Path of the message store')
+    args = parser.parse_args()
+
+    messages = messagesFromArgs(args)
+    writeStore(messages, args.storetype, args.path)
+    print('Wrote {} messages to {} {}'.format(len(messages), args.storetype, args.path))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
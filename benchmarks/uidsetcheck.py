@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+#####
+#
+# Module name:  uidsetcheck.py
+# Purpose:      Check the UID sequence sets used to mark IMAP messages as read
+#
+# Notes:        EmailServer.markMessagesRead() flags messages with UID STORE on compressed sequence sets (e.g., '10:12,15').
+#               A range must only cover UIDs that are being marked. With serversearch=true the folder search leaves
+#               other mail out of the message list, so UIDs next to each other in the list aren't always consecutive.
+#               Each case feeds a search result to markMessagesRead() and checks the sets sent to the server.
+#
+#               Usage: python3 benchmarks/uidsetcheck.py
+#
+#####
+
+# Import system modules
+import os
+import sys
+
+# dupReport modules live in the directory above this one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Import dupReport modules
+import globs
+import log
+import dremail
+
+# Stand-in for the imaplib connection. Records the UID STORE commands sent.
+class StoreRecorder:
+    def __init__(self):
+        self.stored = []
+
+    def uid(self, command, *args):
+        self.stored.append(args[0])
+        return 'OK', [None]
+
+# (description, UIDs returned by the folder search, UIDs to mark or None for all, storebatch, expected sequence sets)
+checks = [
+    ('gap left by the server-side search', [10, 12], None, 0, ['10,12']),
+    ('consecutive UIDs', [10, 11, 12], None, 0, ['10:12']),
+    ('several runs', [3, 4, 5, 9, 20, 21], None, 0, ['3:5,9,20:21']),
+    ('message in the search result that isn\'t being marked', [10, 11, 12], [10, 12], 0, ['10,12']),
+    ('storebatch splits a run', [1, 2, 3, 4, 5], None, 2, ['1:2', '3:4', '5']),
+    ]
+
+def main():
+    globs.progPath = os.path.dirname(os.path.abspath(__file__))
+    globs.log = log.LogHandler()
+    globs.log.logFile = open(os.devnull, 'w')
+
+    failed = 0
+    for description, searchUids, markUids, storeBatch, expected in checks:
+        server = dremail.EmailServer('check', {'protocol': 'imap', 'storebatch': storeBatch, 'markparsedonly': False})
+        server.serverconnect = StoreRecorder()
+        server.newEmails = [str(uid).encode() for uid in searchUids]
+        server.numEmails = len(server.newEmails)
+        server.markMessagesRead(None if markUids is None else [str(uid).encode() for uid in markUids])
+        result = 'ok' if server.serverconnect.stored == expected else 'FAILED'
+        if result != 'ok':
+            failed += 1
+        print('{:<7} {}: sent {}, expected {}'.format(result, description, server.serverconnect.stored, expected))
+    return 1 if failed > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -275,6 +275,13 @@ def doConvertDb(fromVersion):
     # 1.0.3 - Store new logdata field and Duplicati version numbers (per backup)
     # 3.0.0 - changes to report table for dupReport 3.0.0
     # 3.0.1 - Add bytesUploaded & bytesDownloaded fields to email & reports
+    # 3.0.2 - Add imapsync table for incremental IMAP collection
+    # 3.0.3 - Add pop3uidl table for incremental POP3 collection
+    # 3.0.4 - Add imapcheckpoint table for resuming unfinished IMAP collections
+    # 3.0.5 - Remove duplicate emails and make the messageId index unique
+    # 3.0.6 - Add endTimestamp to the source/destination index on emails
+    # 3.0.7 - Add pairId to backupsets. emails and report refer to source/destination pairs by pairId
+    # 3.0.8 - Add lastEmailTimestamp to imapsync
 
     # Update DB version number
     if fromVersion < 101: # Upgrade from DB version 100 (original format). 
@@ -412,6 +419,81 @@ def doConvertDb(fromVersion):
         # Insert last dupversion for all existing backupset rows
         doConvertDb(301)
         pass
+    elif fromVersion < 302: # Upgrade from version 301
+        globs.log.write(globs.SEV_NOTICE, function='Convert', action='doConvertDb', msg='Converting database from version {} to version 302'.format(fromVersion))
+        # Add table to track UIDVALIDITY & last UID seen on each IMAP folder
+        globs.db.execSqlStmt("CREATE TABLE imapsync (server varchar(50), account varchar(50), folder varchar(50), uidValidity int, lastUid int)")
+        doConvertDb(302)
+    elif fromVersion < 303: # Upgrade from version 302
+        globs.log.write(globs.SEV_NOTICE, function='Convert', action='doConvertDb', msg='Converting database from version {} to version 303'.format(fromVersion))
+        # Add table to track the UIDLs of messages already seen on each POP3 server
+        globs.db.execSqlStmt("CREATE TABLE pop3uidl (server varchar(50), account varchar(50), uidl varchar(70))")
+        doConvertDb(303)
+    elif fromVersion < 304: # Upgrade from version 303
+        globs.log.write(globs.SEV_NOTICE, function='Convert', action='doConvertDb', msg='Converting database from version {} to version 304'.format(fromVersion))
+        # Add table to save the progress of IMAP collections so an unfinished one can be resumed
+        globs.db.execSqlStmt("CREATE TABLE imapcheckpoint (server varchar(50), account varchar(50), folder varchar(50), uidValidity int, lastUid int, batchId int, timestamp real)")
+        doConvertDb(304)
+    elif fromVersion < 305: # Upgrade from version 304
+        globs.log.write(globs.SEV_NOTICE, function='Convert', action='doConvertDb', msg='Converting database from version {} to version 305'.format(fromVersion))
+        # Keep the first copy of each message and remove the rest, then replace the messageId index with a unique one
+        numEmails = globs.db.execSqlStmt("SELECT COUNT(*) FROM emails").fetchone()[0]
+        globs.db.execSqlStmt("DELETE FROM emails WHERE rowid NOT IN (SELECT MIN(rowid) FROM emails GROUP BY messageId)")
+        numDups = numEmails - globs.db.execSqlStmt("SELECT COUNT(*) FROM emails").fetchone()[0]
+        globs.log.write(globs.SEV_NOTICE, function='Convert', action='doConvertDb', msg='Removed {} duplicate emails.'.format(numDups))
+        globs.db.execSqlStmt("DROP INDEX IF EXISTS emailindx")
+        globs.db.execSqlStmt("CREATE UNIQUE INDEX emailindx ON emails (messageId)")
+        doConvertDb(305)
+    elif fromVersion < 306: # Upgrade from version 305
+        globs.log.write(globs.SEV_NOTICE, function='Convert', action='doConvertDb', msg='Converting database from version {} to version 306'.format(fromVersion))
+        # Reports look up the emails for each source/destination pair newer than a timestamp, in time order
+        # With endTimestamp in the index those lookups don't need to sort, and max(endTimestamp) is answered from the index alone
+        globs.db.execSqlStmt("DROP INDEX IF EXISTS srcdestindx")
+        globs.db.execSqlStmt("CREATE INDEX srcdestindx ON emails (sourceComp, destComp, endTimestamp)")
+        doConvertDb(306)
+    elif fromVersion < 307: # Upgrade from version 306
+        globs.log.write(globs.SEV_NOTICE, function='Convert', action='doConvertDb', msg='Converting database from version {} to version 307'.format(fromVersion))
+        # Source/destination pairs get an integer pairId in backupsets. emails and report refer to the pair by pairId instead of repeating the names.
+        # Pairs that have emails but no backupsets row are added, so their emails are kept
+        globs.db.execSqlStmt("INSERT INTO backupsets (source, destination, lastFileCount, lastFileSize, lastTimestamp, dupversion) SELECT DISTINCT sourceComp, destComp, 0, 0, 0, '' FROM emails \
+            WHERE NOT EXISTS (SELECT 1 FROM backupsets WHERE source = emails.sourceComp AND destination = emails.destComp)")
+
+        # Existing backup sets keep their rowid as their pairId
+        globs.db.execSqlStmt("ALTER TABLE backupsets RENAME TO _backupsets_old_")
+        globs.db.execSqlStmt("CREATE TABLE backupsets (pairId integer primary key, source varchar(20), destination varchar(20), lastFileCount integer, lastFileSize integer, lastTimestamp real, dupversion varchar(100))")
+        globs.db.execSqlStmt("INSERT INTO backupsets (pairId, source, destination, lastFileCount, lastFileSize, lastTimestamp, dupversion) SELECT rowid, source, destination, lastFileCount, lastFileSize, lastTimestamp, dupversion \
+            FROM _backupsets_old_ WHERE rowid IN (SELECT MIN(rowid) FROM _backupsets_old_ GROUP BY source, destination)")
+        globs.db.execSqlStmt("DROP TABLE _backupsets_old_")
+
+        # Recreate the emails table with pairId in place of sourceComp & destComp. The indexes go with the old table and are recreated.
+        globs.db.execSqlStmt("ALTER TABLE emails RENAME TO _emails_old_")
+        globs.db.execSqlStmt("CREATE TABLE emails (messageId varchar(50), pairId integer, emailTimestamp real, deletedFiles int, deletedFolders int, modifiedFiles int, \
+            examinedFiles int, openedFiles int, addedFiles int, sizeOfModifiedFiles int, sizeOfAddedFiles int, sizeOfExaminedFiles int, sizeOfOpenedFiles int, notProcessedFiles int, addedFolders int, \
+            tooLargeFiles int, filesWithError int, modifiedFolders int, modifiedSymlinks int, addedSymlinks int, deletedSymlinks int, partialBackup varchar(30), dryRun varchar(30), mainOperation varchar(30), \
+            parsedResult varchar(30), verboseOutput varchar(30), verboseErrors varchar(30), endTimestamp real, beginTimestamp real, duration real, messages varchar(255), warnings varchar(255), errors varchar(255), \
+            failedMsg varchar(100), dbSeen int, dupversion varchar(100), logdata varchar(255), bytesUploaded int, bytesDownloaded int)")
+        globs.db.execSqlStmt("INSERT INTO emails (messageId, pairId, emailTimestamp, deletedFiles, deletedFolders, modifiedFiles, examinedFiles, openedFiles, addedFiles, sizeOfModifiedFiles, sizeOfAddedFiles, \
+            sizeOfExaminedFiles, sizeOfOpenedFiles, notProcessedFiles, addedFolders, tooLargeFiles, filesWithError, modifiedFolders, modifiedSymlinks, addedSymlinks, deletedSymlinks, partialBackup, dryRun, \
+            mainOperation, parsedResult, verboseOutput, verboseErrors, endTimestamp, beginTimestamp, duration, messages, warnings, errors, failedMsg, dbSeen, dupversion, logdata, bytesUploaded, bytesDownloaded) \
+            SELECT e.messageId, b.pairId, e.emailTimestamp, e.deletedFiles, e.deletedFolders, e.modifiedFiles, e.examinedFiles, e.openedFiles, e.addedFiles, e.sizeOfModifiedFiles, e.sizeOfAddedFiles, \
+            e.sizeOfExaminedFiles, e.sizeOfOpenedFiles, e.notProcessedFiles, e.addedFolders, e.tooLargeFiles, e.filesWithError, e.modifiedFolders, e.modifiedSymlinks, e.addedSymlinks, e.deletedSymlinks, e.partialBackup, e.dryRun, \
+            e.mainOperation, e.parsedResult, e.verboseOutput, e.verboseErrors, e.endTimestamp, e.beginTimestamp, e.duration, e.messages, e.warnings, e.errors, e.failedMsg, e.dbSeen, e.dupversion, e.logdata, e.bytesUploaded, e.bytesDownloaded \
+            FROM _emails_old_ e JOIN backupsets b ON b.source = e.sourceComp AND b.destination = e.destComp")
+        globs.db.execSqlStmt("DROP TABLE _emails_old_")
+        globs.db.execSqlStmt("CREATE UNIQUE INDEX emailindx ON emails (messageId)")
+        globs.db.execSqlStmt("CREATE INDEX srcdestindx ON emails (pairId, endTimestamp)")
+
+        # The report table is refilled on every run, so it's simply recreated
+        globs.db.execSqlStmt("DROP TABLE report")
+        globs.db.execSqlStmt("CREATE TABLE report (pairId integer, source varchar(20), destination varchar(20), timestamp real, date real, time real, duration real, examinedFiles int, examinedFilesDelta int, \
+            sizeOfExaminedFiles int, fileSizeDelta int, addedFiles int, deletedFiles int, modifiedFiles int, filesWithError int, parsedResult varchar(30), messages varchar(255), \
+            warnings varchar(255), errors varchar(255), failedMsg varchar(100), dupversion varchar(100), logdata varchar(255), bytesUploaded int, bytesDownloaded int)")
+        doConvertDb(307)
+    elif fromVersion < 308: # Upgrade from version 307
+        globs.log.write(globs.SEV_NOTICE, function='Convert', action='doConvertDb', msg='Converting database from version {} to version 308'.format(fromVersion))
+        # Remember the newest email collected from each IMAP folder. The server-side search for a folder starts from its own newest email.
+        globs.db.execSqlStmt("ALTER TABLE imapsync ADD COLUMN lastEmailTimestamp real")
+        doConvertDb(308)
     else:
         pass
 
@@ -11,6 +11,9 @@
 import sqlite3
 import sys
 import os
+import math
+import hashlib
+import time
 from datetime import datetime
 from datetime import timedelta
 
@@ -18,11 +21,56 @@ from datetime import timedelta
 import globs
 import drdatetime
 
+# Bloom filter for message-ids. Used in place of a set when the emails table is very large.
+# Never gives false negatives. Positives (about 1% of them false) need to be confirmed against the database.
+class BloomFilter:
+    def __init__(self, numItems, fpRate = 0.01):
+        numItems = max(numItems, 1)
+        self.numBits = max(int(-numItems * math.log(fpRate) / (math.log(2) ** 2)), 8)
+        self.numHashes = max(int(round(self.numBits / numItems * math.log(2))), 1)
+        self.bits = bytearray((self.numBits + 7) // 8)
+        return None
+
+    # Bit positions for an item, using double hashing on a single digest
+    def positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8', 'surrogateescape'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.numBits for i in range(self.numHashes)]
+
+    def add(self, item):
+        for pos in self.positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        return None
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(item))
+
+# Statement used to add a parsed message to the emails table. Rows are built by Database.execEmailInsertSql().
+# messageId has a unique index, so a message that's already in the table is skipped.
+emailInsertSql = "INSERT OR IGNORE INTO emails(messageId, pairId, emailTimestamp, \
+    deletedFiles, deletedFolders, modifiedFiles, examinedFiles, \
+    openedFiles, addedFiles, sizeOfModifiedFiles, sizeOfAddedFiles, sizeOfExaminedFiles, \
+    sizeOfOpenedFiles, notProcessedFiles, addedFolders, tooLargeFiles, filesWithError, \
+    modifiedFolders, modifiedSymlinks, addedSymlinks, deletedSymlinks, partialBackup, \
+    dryRun, mainOperation, parsedResult, verboseOutput, verboseErrors, endTimestamp, \
+    beginTimestamp, duration, messages, warnings, errors, dbSeen, dupversion, logdata, bytesUploaded, bytesDownloaded) \
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?, ?, ?)"
+
 class Database:
     dbConn = None
     def __init__(self, dbPath):
         globs.log.write(globs.SEV_NOTICE,function='Database', action='Init', msg='Initializing database manager.')
 
+        self.knownIds = None        # Set of message-ids in the emails table. Loaded by loadKnownMessageIds()
+        self.knownBloom = None      # Bloom filter used instead of knownIds for very large databases
+        self.commitsHeld = 0        # Hold commits until commitHeld() is called while this is > 0. Set by holdCommits()
+        self.commitPending = False  # A commit was asked for while commits were being held
+        self.pendingEmails = []     # Rows for the emails table waiting to be written by flushEmails()
+        self.pendingIds = set()     # Message-ids of the rows in pendingEmails
+        self.pendingSince = None    # Time the oldest email that hasn't been committed was added. Emails written by flushEmails() count until the commit.
+        self.backupSets = None      # Copy of the backupsets table, keyed by (source, destination). Loaded by loadBackupSets()
+
         # First, see if the database is there. If not, need to create it
         isThere = os.path.isfile(dbPath)
 
@@ -47,6 +95,7 @@ class Database:
 
         # Don't attempt to close a non-existant conmnection
         if self.dbConn:
+            self.commitHeld()   # Save any emails still waiting to be written
             self.dbConn.close()
         self.dbConn = None
         return None
@@ -68,26 +117,57 @@ class Database:
         return needToUpgrade, currVerNum
 
     # Commit pending database transaction
+    # Emails waiting to be written are always written first, so nothing committed (checkpoints, sync state, etc.) can get ahead of them.
     def dbCommit(self):
+        if self.commitsHeld > 0:
+            self.commitPending = True
+            return None
         globs.log.write(globs.SEV_DEBUG, function='Database', action='dbCommit', msg='Committing transaction.')
         if self.dbConn:     # Don't try to commit to a nonexistant connection
+            self.flushEmails()
+            timerStart = globs.timer.start()
             self.dbConn.commit()
+            globs.timer.stop('commit', timerStart)
+            self.pendingSince = None
+        return None
+
+    # Hold (hold = True) or stop holding (hold = False) commits, so a run of inserts can be committed together
+    # Used by the database writer while messages are being collected. Calls can be nested. Anything held is committed when the last hold ends.
+    def holdCommits(self, hold):
+        self.commitsHeld += 1 if hold else -1
+        if self.commitsHeld == 0:
+            self.commitHeld()
+        return None
+
+    # Commit anything held back by holdCommits(), and any emails waiting to be written
+    def commitHeld(self):
+        if self.commitPending or self.pendingSince is not None:
+            self.commitPending = False
+            globs.log.write(globs.SEV_DEBUG, function='Database', action='commitHeld', msg='Committing held transaction.')
+            if self.dbConn:
+                self.flushEmails()
+                timerStart = globs.timer.start()
+                self.dbConn.commit()
+                globs.timer.stop('commit', timerStart)
+                self.pendingSince = None
         return None
 
-    def execEmailInsertSql(self, emailParts):  
+    # Add a parsed message to the emails table
+    # Messages are written in batches: the row is held in memory, and the batch is written with one statement and committed once
+    # there are [main]insertbatch messages waiting, and whenever anything else is committed (checkpoints, IMAP sync state, POP3 UIDLs,
+    # end of collection). The age of the batch is checked here and by commitIfDue(), which the collection loops call while they wait for
+    # messages, so a batch is also written once the oldest message has waited [main]insertinterval seconds. If dupReport dies, only the
+    # messages in the unwritten batch are lost. Nothing recording collection progress is committed ahead of them, so they're collected again next run.
+    def execEmailInsertSql(self, emailParts):
         globs.log.write(globs.SEV_NOTICE, function='Database', action='execEmailInsertSql', msg='Inserting into emails table: messageId={}  sourceComp={}  destComp={}'.format(emailParts['header']['messageId'], emailParts['header']['sourceComp'], emailParts['header']['destComp']))
 
+        if not self.dbConn:
+            return None
+
+        # Emails refer to their source/destination pair by its pairId in the backupsets table
+        pairId = self.getPairId(emailParts['header']['sourceComp'], emailParts['header']['destComp'])
         durVal = float(emailParts['body']['endTimestamp']) - float(emailParts['body']['beginTimestamp'])
-        sqlStmt = "INSERT INTO emails(messageId, sourceComp, destComp, emailTimestamp, \
-            deletedFiles, deletedFolders, modifiedFiles, examinedFiles, \
-            openedFiles, addedFiles, sizeOfModifiedFiles, sizeOfAddedFiles, sizeOfExaminedFiles, \
-            sizeOfOpenedFiles, notProcessedFiles, addedFolders, tooLargeFiles, filesWithError, \
-            modifiedFolders, modifiedSymlinks, addedSymlinks, deletedSymlinks, partialBackup, \
-            dryRun, mainOperation, parsedResult, verboseOutput, verboseErrors, endTimestamp, \
-            beginTimestamp, duration, messages, warnings, errors, dbSeen, dupversion, logdata, bytesUploaded, bytesDownloaded) \
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?, ?, ?)"
-
-        data  = (emailParts['header']['messageId'], emailParts['header']['sourceComp'], emailParts['header']['destComp'], emailParts['header']['emailTimestamp'], emailParts['body']['deletedFiles'], \
+        data  = (emailParts['header']['messageId'], pairId, emailParts['header']['emailTimestamp'], emailParts['body']['deletedFiles'], \
                 emailParts['body']['deletedFolders'], emailParts['body']['modifiedFiles'], emailParts['body']['examinedFiles'], emailParts['body']['openedFiles'], \
                 emailParts['body']['addedFiles'], emailParts['body']['sizeOfModifiedFiles'], emailParts['body']['sizeOfAddedFiles'], emailParts['body']['sizeOfExaminedFiles'], emailParts['body']['sizeOfOpenedFiles'], \
                 emailParts['body']['notProcessedFiles'], emailParts['body']['addedFolders'], emailParts['body']['tooLargeFiles'], emailParts['body']['filesWithError'], \
@@ -96,21 +176,46 @@ class Database:
                 emailParts['body']['verboseErrors'], emailParts['body']['endTimestamp'], emailParts['body']['beginTimestamp'], \
                 durVal, emailParts['body']['messages'], emailParts['body']['warnings'], emailParts['body']['errors'], emailParts['body']['dupversion'], emailParts['body']['logdata'], emailParts['body']['bytesUploaded'], emailParts['body']['bytesDownloaded'])
 
-        globs.log.write(globs.SEV_DEBUG, function='Database', action='execEmailInsertSql', msg='sqlStmt=[{}]'.format(sqlStmt))
         globs.log.write(globs.SEV_DEBUG, function='Database', action='execEmailInsertSql', msg='data=[{}]'.format(data))
 
-        if not self.dbConn:
+        if self.pendingSince is None:
+            self.pendingSince = time.time()
+        self.pendingEmails.append(data)
+        self.pendingIds.add(emailParts['header']['messageId'])
+        self.rememberMessageId(emailParts['header']['messageId'])
+        self.rememberEmailTimestamp(emailParts['header']['sourceComp'], emailParts['header']['destComp'], emailParts['body']['endTimestamp'])
+        if len(self.pendingEmails) >= globs.opts['insertbatch'] or time.time() - self.pendingSince >= globs.opts['insertinterval']:
+            self.dbCommit()
+        return None
+
+    # Write and commit the emails waiting in pendingEmails if the oldest has waited [main]insertinterval seconds
+    # Commits even while commits are held (see holdCommits()), so a batch isn't left unwritten when no more messages arrive to trigger it
+    def commitIfDue(self):
+        if self.pendingSince is not None and time.time() - self.pendingSince >= globs.opts['insertinterval']:
+            globs.log.write(globs.SEV_DEBUG, function='Database', action='commitIfDue', msg='Emails waiting to be committed are over {} seconds old.'.format(globs.opts['insertinterval']))
+            self.commitHeld()
+        return None
+
+    # Write the emails waiting in pendingEmails to the emails table with a single statement. Doesn't commit.
+    def flushEmails(self):
+        if len(self.pendingEmails) == 0 or not self.dbConn:
             return None
 
-        # Set db cursor
+        globs.log.write(globs.SEV_DEBUG, function='Database', action='flushEmails', msg='Writing {} emails. sqlStmt=[{}]'.format(len(self.pendingEmails), emailInsertSql))
+        pendingEmails = self.pendingEmails
+        self.pendingEmails = []
+        self.pendingIds = set()
         curs = self.dbConn.cursor()
+        timerStart = globs.timer.start()
         try:
-            curs.execute(sqlStmt, data)
+            curs.executemany(emailInsertSql, pendingEmails)
         except sqlite3.Error as err:
-            globs.log.write(globs.SEV_ERROR, function='Database', action='execEmailInsertSql', msg='SQLite error: {}'.format(err.args[0]))
+            globs.log.write(globs.SEV_ERROR, function='Database', action='flushEmails', msg='SQLite error: {}'.format(err.args[0]))
+            self.dbConn.rollback()      # Don't let anything saved with these emails be committed while closing down
             globs.closeEverythingAndExit(1)  # Abort program. Can't continue with DB error
-        
-        self.dbCommit()
+        globs.timer.stop('insert', timerStart)
+        if curs.rowcount >= 0 and curs.rowcount < len(pendingEmails):
+            globs.log.write(globs.SEV_NOTICE, function='Database', action='flushEmails', msg='Skipped {} emails already in the database.'.format(len(pendingEmails) - curs.rowcount))
         return None
 
     def execReportInsertSql(self, sqlStmt, sqlData):  
@@ -131,17 +236,20 @@ class Database:
         return None
 
     # Execute a Sqlite command and manage exceptions
+    # params holds the values for any '?' placeholders in stmt
     # Return the cursor object to the command result
-    def execSqlStmt(self, stmt):
+    def execSqlStmt(self, stmt, params = ()):
         globs.log.write(globs.SEV_NOTICE, function='Database', action='execSqlStmt', msg='Executing SQL statement: [{}]'.format(stmt))
 
         if not self.dbConn:
             return None
 
+        self.flushEmails()      # The statement may need to see emails that haven't been written yet
+
         # Set db cursor
         curs = self.dbConn.cursor()
         try:
-            curs.execute(stmt)
+            curs.execute(stmt, params)
         except sqlite3.Error as err:
             globs.log.write(globs.SEV_ERROR, function='Database', action='execSqlStmt', msg='SQLite error: {}'.format(err.args[0]))
             globs.closeEverythingAndExit(1)  # Abort program. Can't continue with DB error
@@ -149,6 +257,23 @@ class Database:
         # Return the cursor to the executed command result.    
         return curs
 
+    # Execute a Sqlite command once for each row of data in dataRows and manage exceptions
+    def execSqlMany(self, stmt, dataRows):
+        globs.log.write(globs.SEV_NOTICE, function='Database', action='execSqlMany', msg='Executing SQL statement for {} rows: [{}]'.format(len(dataRows), stmt))
+
+        if not self.dbConn:
+            return None
+
+        self.flushEmails()      # The statement may need to see emails that haven't been written yet
+
+        curs = self.dbConn.cursor()
+        try:
+            curs.executemany(stmt, dataRows)
+        except sqlite3.Error as err:
+            globs.log.write(globs.SEV_ERROR, function='Database', action='execSqlMany', msg='SQLite error: {}'.format(err.args[0]))
+            globs.closeEverythingAndExit(1)  # Abort program. Can't continue with DB error
+        return curs
+
     # Initialize database to empty, default tables
     def dbInitialize(self):
         globs.log.write(globs.SEV_NOTICE, function='Database', action='dbInitialize', msg='Initializing (resetting) database.')
@@ -156,12 +281,17 @@ class Database:
         # Don't initialize a non-existant connection
         if not self.dbConn:
             return None
+        self.forgetKnownMessageIds()
+        self.forgetBackupSets()
 
         # Drop any tables and indices that might already exist in the database
         self.execSqlStmt("drop table if exists version")
         self.execSqlStmt("drop table if exists emails")
         self.execSqlStmt("drop table if exists backupsets")
         self.execSqlStmt("drop table if exists report")
+        self.execSqlStmt("drop table if exists imapsync")
+        self.execSqlStmt("drop table if exists pop3uidl")
+        self.execSqlStmt("drop table if exists imapcheckpoint")
         self.execSqlStmt("drop index if exists emailindx")
         self.execSqlStmt("drop index if exists srcdestindx")
  
@@ -171,7 +301,8 @@ class Database:
         self.execSqlStmt("insert into version(desc, major, minor, subminor) values (\'database\',{},{},{})".format(globs.dbVersion[0], globs.dbVersion[1], globs.dbVersion[2]))
 
         # emails table holds information about all emails received
-        sqlStmt = "create table emails (messageId varchar(50), sourceComp varchar(50), destComp varchar(50), \
+        # Each email's source/destination pair is identified by the pair's pairId in backupsets
+        sqlStmt = "create table emails (messageId varchar(50), pairId integer, \
             emailTimestamp real, deletedFiles int, deletedFolders int, modifiedFiles int, \
             examinedFiles int, openedFiles int, addedFiles int, sizeOfModifiedFiles int, sizeOfAddedFiles int, sizeOfExaminedFiles int, \
             sizeOfOpenedFiles int, notProcessedFiles int, addedFolders int, tooLargeFiles int, filesWithError int, \
@@ -181,18 +312,28 @@ class Database:
             beginTimestamp real, duration real, messages varchar(255), warnings varchar(255), errors varchar(255), failedMsg varchar(100), dbSeen int, dupversion varchar(100), logdata varchar(255), \
             bytesUploaded int, bytesDownloaded int)"
         self.execSqlStmt(sqlStmt)
-        self.execSqlStmt("create index emailindx on emails (messageId)")
-        self.execSqlStmt("create index srcdestindx on emails (sourceComp, destComp)")
+        self.execSqlStmt("create unique index emailindx on emails (messageId)")
+        self.execSqlStmt("create index srcdestindx on emails (pairId, endTimestamp)")  # Emails for a source/destination pair, in time order
 
-        sqlStmt = "create table report (source varchar(20), destination varchar(20), timestamp real, date real, time real, duration real, examinedFiles int, examinedFilesDelta int, \
+        sqlStmt = "create table report (pairId integer, source varchar(20), destination varchar(20), timestamp real, date real, time real, duration real, examinedFiles int, examinedFilesDelta int, \
             sizeOfExaminedFiles int, fileSizeDelta int, addedFiles int, deletedFiles int, modifiedFiles int, filesWithError int, parsedResult varchar(30), messages varchar(255), \
             warnings varchar(255), errors varchar(255), failedMsg varchar(100), dupversion varchar(100), logdata varchar(255), bytesUploaded int, bytesDownloaded int)"
         self.execSqlStmt(sqlStmt)
 
-        # backup sets contains information on all source-destination pairs in the backups
-        self.execSqlStmt("create table backupsets (source varchar(20), destination varchar(20), lastFileCount integer, lastFileSize integer, \
+        # backup sets contains information on all source-destination pairs in the backups. pairId is used to refer to the pair in other tables.
+        self.execSqlStmt("create table backupsets (pairId integer primary key, source varchar(20), destination varchar(20), lastFileCount integer, lastFileSize integer, \
             lastTimestamp real, dupversion varchar(100))")
 
+        # imapsync holds the UIDVALIDITY and last processed UID for each IMAP server/folder, so a run only needs to look at new messages
+        # lastEmailTimestamp is the newest email collected from the folder. It sets the date for the server-side search (serversearch=true).
+        self.execSqlStmt("create table imapsync (server varchar(50), account varchar(50), folder varchar(50), uidValidity int, lastUid int, lastEmailTimestamp real)")
+
+        # pop3uidl holds the UIDL of every message on each POP3 server as of the last run, so a run only needs to look at new messages
+        self.execSqlStmt("create table pop3uidl (server varchar(50), account varchar(50), uidl varchar(70))")
+
+        # imapcheckpoint holds the progress of a collection from an IMAP folder that is still running (or died), so it can be resumed
+        self.execSqlStmt("create table imapcheckpoint (server varchar(50), account varchar(50), folder varchar(50), uidValidity int, lastUid int, batchId int, timestamp real)")
+
         self.dbCommit()
         self.dbCompact()
         globs.log.write(globs.SEV_NOTICE, function='Database', action='dbInitialize', msg='Database initialization complete.')
@@ -212,23 +353,214 @@ class Database:
             globs.log.write(globs.SEV_NOTICE, function='Database', action='searchForMessage', msg='Message [{}] not yet in email database'.format(msgID))
             return False
 
+    # Load the message-ids already in the database into memory, so messages can be checked without a query for each one
+    # Uses a set, or a Bloom filter if there are more than [main]bloomthreshold emails in the database (0 = always use a set)
+    def loadKnownMessageIds(self):
+        if self.knownIds is not None or self.knownBloom is not None:     # Already loaded. Inserts keep it up to date.
+            return None
+
+        numEmails = self.execSqlStmt('SELECT COUNT(*) FROM emails').fetchone()[0]
+        dbCursor = self.execSqlStmt('SELECT messageId FROM emails')
+        if globs.opts['bloomthreshold'] > 0 and numEmails > globs.opts['bloomthreshold']:
+            self.knownBloom = BloomFilter(numEmails * 2)    # Leave room for new messages
+            for (msgID,) in dbCursor:
+                self.knownBloom.add(msgID)
+            globs.log.write(globs.SEV_NOTICE, function='Database', action='loadKnownMessageIds', msg='Loaded {} message-ids into Bloom filter ({} bits, {} hashes).'.format(numEmails, self.knownBloom.numBits, self.knownBloom.numHashes))
+        else:
+            self.knownIds = set(msgID for (msgID,) in dbCursor)
+            globs.log.write(globs.SEV_NOTICE, function='Database', action='loadKnownMessageIds', msg='Loaded {} message-ids.'.format(len(self.knownIds)))
+        return None
+
+    # Discard the in-memory message-ids. Needed whenever emails are deleted from the database.
+    def forgetKnownMessageIds(self):
+        self.knownIds = None
+        self.knownBloom = None
+        return None
+
+    # Add a newly-inserted message-id to the in-memory message-ids
+    def rememberMessageId(self, msgID):
+        if self.knownIds is not None:
+            self.knownIds.add(msgID)
+        elif self.knownBloom is not None:
+            self.knownBloom.add(msgID)
+        return None
+
+    # See if a message ID is already in the database, using the in-memory message-ids if they're loaded
+    # Return True (already there) or False (not there)
+    def isKnownMessage(self, msgID):
+        timerStart = globs.timer.start()
+        if self.knownIds is not None:
+            known = msgID in self.knownIds
+        elif self.knownBloom is not None and msgID not in self.knownBloom:
+            known = False
+        elif msgID in self.pendingIds:      # Waiting to be written by flushEmails()
+            known = True
+        else:
+            known = self.searchForMessage(msgID)     # Not loaded, or a Bloom filter hit that might be a false positive
+        globs.timer.stop('lookup', timerStart)
+        return known
+
+    # Mark a message that's already in the database as seen in this collection (see [main]purgedb)
+    # Committed along with the next batch of emails (see execEmailInsertSql())
+    def markMessageSeen(self, msgID):
+        self.dbConn.cursor().execute("UPDATE emails SET dbSeen = 1 WHERE messageId = ?", (msgID,))
+        return None
+
+    # Check a batch of message IDs
+    # Returns the set of IDs that are already in the database
+    def filterKnownMessages(self, msgIDs):
+        return set(msgID for msgID in msgIDs if self.isKnownMessage(msgID))
+
+    # Load the backupsets table into memory, so backup sets can be looked up without a query for each one
+    # Each entry is {'pairId', 'lastFileCount', 'lastFileSize', 'lastTimestamp', 'dupversion', 'lastEmailTimestamp'}. lastEmailTimestamp is the newest
+    # endTimestamp of the backup set's emails, which can be newer than lastTimestamp until the next report.
+    # Changes to single backup sets are written to the table and the copy at the same time. Operations that change many rows call forgetBackupSets().
+    def loadBackupSets(self):
+        dbCursor = self.execSqlStmt("SELECT pairId, source, destination, lastFileCount, lastFileSize, lastTimestamp, dupversion, \
+            (SELECT MAX(endTimestamp) FROM emails WHERE pairId = backupsets.pairId) FROM backupsets ORDER BY pairId")
+        self.backupSets = {}
+        for pairId, source, destination, lastFileCount, lastFileSize, lastTimestamp, dupversion, lastEmailTimestamp in dbCursor.fetchall():
+            self.backupSets[(source, destination)] = {'pairId': pairId, 'lastFileCount': lastFileCount, 'lastFileSize': lastFileSize, 'lastTimestamp': lastTimestamp, 'dupversion': dupversion, 'lastEmailTimestamp': lastEmailTimestamp}
+        globs.log.write(globs.SEV_NOTICE, function='Database', action='loadBackupSets', msg='Loaded {} backup sets.'.format(len(self.backupSets)))
+        return None
+
+    # Discard the in-memory backup sets. Needed whenever backupsets rows are changed in bulk, or emails are deleted.
+    def forgetBackupSets(self):
+        self.backupSets = None
+        return None
+
+    # Get all the backup sets as a dictionary of {(source, destination): backup set}, in the order they were added to the database
+    def getBackupSets(self):
+        if self.backupSets is None:
+            self.loadBackupSets()
+        return self.backupSets
+
+    # Get a single backup set. Returns None if the source/destination pair isn't in the database.
+    def getBackupSet(self, src, dest):
+        return self.getBackupSets().get((src, dest))
+
+    # Get the pairId of a source/destination pair, adding the pair to backupsets if it isn't there yet
+    def getPairId(self, src, dest):
+        if self.getBackupSet(src, dest) is None:
+            self.searchSrcDestPair(src, dest)
+        return self.getBackupSet(src, dest)['pairId']
+
+    # Save the latest activity for a backup set
+    def updateBackupSet(self, src, dest, lastFileCount, lastFileSize, lastTimestamp, dupversion):
+        bkSet = self.getBackupSet(src, dest)
+        if bkSet is not None:
+            self.dbConn.cursor().execute("UPDATE backupsets SET lastFileCount = ?, lastFileSize = ?, lastTimestamp = ?, dupversion = ? WHERE pairId = ?", (lastFileCount, lastFileSize, lastTimestamp, dupversion, bkSet['pairId']))
+            bkSet.update({'lastFileCount': lastFileCount, 'lastFileSize': lastFileSize, 'lastTimestamp': lastTimestamp, 'dupversion': dupversion})
+        return None
+
+    # Keep a backup set's newest email time up to date as emails are added
+    def rememberEmailTimestamp(self, src, dest, endTimestamp):
+        if self.backupSets is None:
+            return None
+        bkSet = self.backupSets.get((src, dest))
+        if bkSet is not None and (bkSet['lastEmailTimestamp'] is None or float(endTimestamp) > bkSet['lastEmailTimestamp']):
+            bkSet['lastEmailTimestamp'] = float(endTimestamp)     # Parsed timestamps may be strings. The emails table stores them as real.
+        return None
+
     def searchSrcDestPair(self, src, dest, add2Db = True):
         globs.log.write(globs.SEV_NOTICE, function='Database', action='searchSrcDestPair', msg='Searching for {}{}{} in backupsets'.format(src, globs.opts['srcdestdelimiter'], dest))
-        sqlStmt = "SELECT source, destination FROM backupsets WHERE source=\'{}\' AND destination=\'{}\'".format(src, dest)
-        dbCursor = self.execSqlStmt(sqlStmt)
-        idExists = dbCursor.fetchone()
+        timerStart = globs.timer.start()
+        idExists = self.getBackupSet(src, dest) is not None
+        globs.timer.stop('lookup', timerStart)
         if idExists:
             globs.log.write(globs.SEV_NOTICE, function='Database', action='searchSrcDestPair', msg='{}{}{} already in backupsets.'.format(src, globs.opts['srcdestdelimiter'], dest))
             return True
 
+        # The new pair is committed along with the next batch of emails (see execEmailInsertSql())
         if add2Db is True:
-            sqlStmt = "INSERT INTO backupsets (source, destination, lastFileCount, lastFileSize, lastTimestamp, dupversion) \
-                VALUES ('{}', '{}', 0, 0, 0, '')".format(src, dest)
-            self.execSqlStmt(sqlStmt)
-            self.dbCommit()
+            dbCursor = self.dbConn.cursor()
+            dbCursor.execute("INSERT INTO backupsets (source, destination, lastFileCount, lastFileSize, lastTimestamp, dupversion) VALUES (?, ?, 0, 0, 0, '')", (src, dest))
+            self.backupSets[(src, dest)] = {'pairId': dbCursor.lastrowid, 'lastFileCount': 0, 'lastFileSize': 0, 'lastTimestamp': 0, 'dupversion': '', 'lastEmailTimestamp': None}
             globs.log.write(globs.SEV_NOTICE, function='Database', action='searchSrcDestPair', msg='{}{}{} added to database'.format(src, globs.opts['srcdestdelimiter'], dest))
         return False
 
+    # Get the timestamp of the newest email collected from an IMAP server/account/folder
+    # Returns None if no emails have been collected from the folder yet
+    def getImapLastEmailTimestamp(self, server, account, folder):
+        dbCursor = self.dbConn.cursor()
+        dbCursor.execute("SELECT lastEmailTimestamp FROM imapsync WHERE server=? AND account=? AND folder=?", (server, account, folder))
+        syncRow = dbCursor.fetchone()
+        return syncRow[0] if syncRow is not None else None
+
+    # Get the saved IMAP sync state for a server/account/folder
+    # Returns (uidValidity, lastUid), or (None, None) if the folder hasn't been synced before
+    def getImapSyncState(self, server, account, folder):
+        globs.log.write(globs.SEV_NOTICE, function='Database', action='getImapSyncState', msg='Getting sync state for {}/{}'.format(server, folder))
+        dbCursor = self.dbConn.cursor()
+        dbCursor.execute("SELECT uidValidity, lastUid FROM imapsync WHERE server=? AND account=? AND folder=?", (server, account, folder))
+        syncRow = dbCursor.fetchone()
+        if syncRow is None:
+            return None, None
+        globs.log.write(globs.SEV_DEBUG, function='Database', action='getImapSyncState', msg='uidValidity={} lastUid={}'.format(syncRow[0], syncRow[1]))
+        return syncRow[0], syncRow[1]
+
+    # Save the IMAP sync state for a server/account/folder
+    # lastEmailTimestamp = newest email collected from the folder this run, or None. The newest one from any run is kept.
+    def setImapSyncState(self, server, account, folder, uidValidity, lastUid, lastEmailTimestamp = None):
+        previous = self.getImapLastEmailTimestamp(server, account, folder)
+        if previous is not None and (lastEmailTimestamp is None or previous > lastEmailTimestamp):
+            lastEmailTimestamp = previous
+        globs.log.write(globs.SEV_NOTICE, function='Database', action='setImapSyncState', msg='Setting sync state for {}/{}: uidValidity={} lastUid={} lastEmailTimestamp={}'.format(server, folder, uidValidity, lastUid, lastEmailTimestamp))
+        dbCursor = self.dbConn.cursor()
+        dbCursor.execute("DELETE FROM imapsync WHERE server=? AND account=? AND folder=?", (server, account, folder))
+        dbCursor.execute("INSERT INTO imapsync (server, account, folder, uidValidity, lastUid, lastEmailTimestamp) VALUES (?, ?, ?, ?, ?, ?)", (server, account, folder, uidValidity, lastUid, lastEmailTimestamp))
+        self.dbCommit()
+        return None
+
+    # Get the checkpoint saved by an unfinished collection from an IMAP server/folder
+    # Returns (uidValidity, lastUid, batchId), or (None, None, None) if there isn't one
+    def getImapCheckpoint(self, server, account, folder):
+        dbCursor = self.dbConn.cursor()
+        dbCursor.execute("SELECT uidValidity, lastUid, batchId FROM imapcheckpoint WHERE server=? AND account=? AND folder=?", (server, account, folder))
+        checkRow = dbCursor.fetchone()
+        if checkRow is None:
+            return None, None, None
+        globs.log.write(globs.SEV_NOTICE, function='Database', action='getImapCheckpoint', msg='Found checkpoint for {}/{}: uidValidity={} lastUid={} batchId={}'.format(server, folder, checkRow[0], checkRow[1], checkRow[2]))
+        return checkRow[0], checkRow[1], checkRow[2]
+
+    # Save a checkpoint for a collection from an IMAP server/folder: every message up to and including lastUid has been processed
+    # Commits right away, even if commits are being held. The messages before the checkpoint must be saved along with it.
+    def setImapCheckpoint(self, server, account, folder, uidValidity, lastUid, batchId):
+        globs.log.write(globs.SEV_NOTICE, function='Database', action='setImapCheckpoint', msg='Checkpoint {} for {}/{}: lastUid={}'.format(batchId, server, folder, lastUid))
+        dbCursor = self.dbConn.cursor()
+        dbCursor.execute("DELETE FROM imapcheckpoint WHERE server=? AND account=? AND folder=?", (server, account, folder))
+        dbCursor.execute("INSERT INTO imapcheckpoint (server, account, folder, uidValidity, lastUid, batchId, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)", (server, account, folder, uidValidity, lastUid, batchId, datetime.now().timestamp()))
+        self.dbCommit()
+        self.commitHeld()
+        return None
+
+    # Remove the checkpoint for an IMAP server/folder after a collection finishes
+    def clearImapCheckpoint(self, server, account, folder):
+        globs.log.write(globs.SEV_DEBUG, function='Database', action='clearImapCheckpoint', msg='Clearing checkpoint for {}/{}'.format(server, folder))
+        dbCursor = self.dbConn.cursor()
+        dbCursor.execute("DELETE FROM imapcheckpoint WHERE server=? AND account=? AND folder=?", (server, account, folder))
+        self.dbCommit()
+        return None
+
+    # Get the UIDLs of the messages that were on a POP3 server at the end of the last run
+    # Returns a set of UIDL strings (empty if the server hasn't been synced before)
+    def getPop3Uidls(self, server, account):
+        globs.log.write(globs.SEV_NOTICE, function='Database', action='getPop3Uidls', msg='Getting UIDLs for {}/{}'.format(server, account))
+        dbCursor = self.dbConn.cursor()
+        dbCursor.execute("SELECT uidl FROM pop3uidl WHERE server=? AND account=?", (server, account))
+        uidls = set(row[0] for row in dbCursor.fetchall())
+        globs.log.write(globs.SEV_DEBUG, function='Database', action='getPop3Uidls', msg='Found {} UIDLs'.format(len(uidls)))
+        return uidls
+
+    # Save the UIDLs of the messages now on a POP3 server. UIDLs of messages no longer on the server are dropped.
+    def setPop3Uidls(self, server, account, uidls):
+        globs.log.write(globs.SEV_NOTICE, function='Database', action='setPop3Uidls', msg='Setting {} UIDLs for {}/{}'.format(len(uidls), server, account))
+        dbCursor = self.dbConn.cursor()
+        dbCursor.execute("DELETE FROM pop3uidl WHERE server=? AND account=?", (server, account))
+        dbCursor.executemany("INSERT INTO pop3uidl (server, account, uidl) VALUES (?, ?, ?)", [(server, account, uidl) for uidl in uidls])
+        self.dbCommit()
+        return None
+
     # Roll back database to specific date/time
     # Datespec = Date & time to roll back to
     def rollback(self, datespec):
@@ -262,25 +594,32 @@ class Database:
         sqlStmt = 'DELETE FROM emails WHERE emailtimestamp > {}'.format(newTimeStamp)
         dbCursor = self.execSqlStmt(sqlStmt)
 
+        # Forget where the IMAP & POP3 servers left off so the rolled-back emails get read again
+        dbCursor = self.execSqlStmt('DELETE FROM imapsync')
+        dbCursor = self.execSqlStmt('DELETE FROM pop3uidl')
+        dbCursor = self.execSqlStmt('DELETE FROM imapcheckpoint')
+        self.forgetKnownMessageIds()
+        self.forgetBackupSets()
+
         # Delete all backup set records that happened after input datetime
-        sqlStmt = 'SELECT source, destination FROM backupsets WHERE lastTimestamp > {}'.format(newTimeStamp)
+        sqlStmt = 'SELECT pairId, source, destination FROM backupsets WHERE lastTimestamp > {}'.format(newTimeStamp)
         dbCursor = self.execSqlStmt(sqlStmt)
         setRows= dbCursor.fetchall()
-        for source, destination in setRows:
+        for pairId, source, destination in setRows:
             # Select largest timestamp from remaining data for that source/destination
-            sqlStmt = 'select max(endTimeStamp), examinedFiles, sizeOfExaminedFiles, dupversion from emails where sourceComp = \'{}\' and destComp= \'{}\''.format(source, destination)
+            sqlStmt = 'select max(endTimeStamp), examinedFiles, sizeOfExaminedFiles, dupversion from emails where pairId = {}'.format(pairId)
             dbCursor = self.execSqlStmt(sqlStmt)
             emailTimestamp, examinedFiles, sizeOfExaminedFiles, dupversion = dbCursor.fetchone()
             if emailTimestamp is None:
                 # After the rollback, some srcdest pairs may have no corresponding entries in the the database, meaning they were not seen until after the rollback period
                 # We should remove these from the database, to return it to the state it was in before the rollback.
                 globs.log.write(globs.SEV_NOTICE, function='Database', action='rollback', msg='Deleting {}{}{} from backupsets. Not seen until after rollback.'.format(source, globs.opts['srcdestdelimiter'], destination))
-                sqlStmt = 'DELETE FROM backupsets WHERE source = \"{}\" AND destination = \"{}\"'.format(source, destination)
+                sqlStmt = 'DELETE FROM backupsets WHERE pairId = {}'.format(pairId)
                 dbCursor = self.execSqlStmt(sqlStmt)
             else:
                 globs.log.write(globs.SEV_NOTICE, function='Database', action='rollback', msg='Resetting {}{}{} to {}'.format(source, globs.opts['srcdestdelimiter'], destination, drdatetime.fromTimestamp(emailTimestamp)))
                 # Update backupset table to reflect rolled-back date
-                sqlStmt = 'update backupsets set lastFileCount={}, lastFileSize={}, lastTimestamp={}, dupversion=\'{}\' where source = \'{}\' and destination = \'{}\''.format(examinedFiles, sizeOfExaminedFiles, emailTimestamp, dupversion, source, destination)
+                sqlStmt = 'update backupsets set lastFileCount={}, lastFileSize={}, lastTimestamp={}, dupversion=\'{}\' where pairId = {}'.format(examinedFiles, sizeOfExaminedFiles, emailTimestamp, dupversion, pairId)
                 dbCursor = self.execSqlStmt(sqlStmt)
             
         self.dbCommit()
@@ -296,11 +635,14 @@ class Database:
             globs.log.write(globs.SEV_NOTICE, function='Database', action='removeSrcDest', msg='Pair {}{}{} does not exist in database. Check spelling and capitalization then try again.'.format(source, globs.opts['srcdestdelimiter'], destination))
             return False
 
-        sqlStmt = "DELETE FROM backupsets WHERE source = \"{}\" AND destination = \"{}\"".format(source, destination)
+        pairId = self.getBackupSet(source, destination)['pairId']
+        sqlStmt = "DELETE FROM backupsets WHERE pairId = {}".format(pairId)
         dbCursor = self.execSqlStmt(sqlStmt)
 
-        sqlStmt = "DELETE FROM emails WHERE sourceComp = \"{}\" AND destComp = \"{}\"".format(source, destination)
+        sqlStmt = "DELETE FROM emails WHERE pairId = {}".format(pairId)
         dbCursor = self.execSqlStmt(sqlStmt)
+        self.forgetKnownMessageIds()
+        self.forgetBackupSets()
 
         self.dbCommit()
 
@@ -311,9 +653,17 @@ class Database:
         return True
 
     # Purge database of old emails
+    # Reports received over HTTP (message-ids ending in globs.httpMessageIdSuffix) aren't in any mailbox to be seen again. They're purged once they're
+    # older than the oldest email still in a mailbox for the same source/destination pair, or for any pair if that one has none.
+    # If no emails were seen in a mailbox, the HTTP reports are all kept.
     def purgeOldEmails(self):
         globs.log.write(globs.SEV_NOTICE, function='Database', action='purgeOldEmails', msg='Purging unseen emails from database')
-        self.execSqlStmt('DELETE FROM emails WHERE dbSeen = 0')
+        httpPattern = '%' + globs.httpMessageIdSuffix
+        self.execSqlStmt('DELETE FROM emails WHERE dbSeen = 0 AND (messageId NOT LIKE ? OR emailTimestamp < \
+            COALESCE((SELECT MIN(kept.emailTimestamp) FROM emails kept WHERE kept.pairId = emails.pairId AND kept.dbSeen = 1 AND kept.messageId NOT LIKE ?), \
+            (SELECT MIN(kept.emailTimestamp) FROM emails kept WHERE kept.dbSeen = 1 AND kept.messageId NOT LIKE ?)))', (httpPattern, httpPattern, httpPattern))
+        self.forgetKnownMessageIds()
+        self.forgetBackupSets()
         self.dbCommit()
         self.dbCompact()
         return None
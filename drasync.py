@@ -0,0 +1,228 @@
+#####
+#
+# Module name:  drasync.py
+# Purpose:      asyncio-based IMAP retrieval engine for dupReport
+#
+# Notes:        Used when an IMAP server section has 'engine = async'.
+#               Opens several connections to the server's folder and keeps several UID FETCH commands
+#               in flight on each one. The raw FETCH results are returned in the same format imaplib uses,
+#               so EmailServer.parseFetchData() and the rest of the parsing code work unchanged.
+#
+#####
+
+# Import system modules
+import asyncio
+import re
+import ssl
+
+# Import dupReport modules
+import globs
+
+# A single IMAP connection driven by asyncio
+class AsyncImapConnection:
+    def __init__(self, options, connNum):
+        self.options = options
+        self.connNum = connNum
+        self.reader = None
+        self.writer = None
+        self.tagNum = 0
+        self.pending = {}       # Tag -> Future waiting for the tagged completion response
+        self.untagged = []      # Untagged response data, in imaplib format
+        self.readerTask = None
+        self.uidValidity = None
+
+    # Quote a string for use in an IMAP command
+    def quote(self, text):
+        return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    # Connect, log in, and select the folder
+    async def open(self):
+        sslContext = ssl.create_default_context() if self.options['encryption'] != 'none' else None
+        self.reader, self.writer = await asyncio.open_connection(self.options['server'], self.options['port'], ssl=sslContext, limit=1024*1024)
+        greeting = await self.reader.readline()
+        if not greeting.startswith(b'* OK'):
+            raise ConnectionError('Unexpected greeting: {}'.format(greeting))
+
+        self.readerTask = asyncio.get_running_loop().create_task(self.readResponses())
+        status, data = await self.command('LOGIN {} {}'.format(self.quote(self.options['account']), self.quote(self.options['password'])))
+        if status != 'OK':
+            raise ConnectionError('Login failed: {}'.format(data))
+        self.untagged = []
+        status, data = await self.command('SELECT {}'.format(self.quote(self.options['folder'])))
+        if status != 'OK':
+            raise ConnectionError('Unable to select folder {}: {}'.format(self.options['folder'], data))
+        for item in self.untagged:
+            match = re.search(rb'\[UIDVALIDITY (\d+)\]', item if isinstance(item, bytes) else item[0])
+            if match:
+                self.uidValidity = int(match.group(1))
+        self.untagged = []
+        return None
+
+    # Log out and close the connection
+    async def close(self):
+        try:
+            await asyncio.wait_for(self.command('LOGOUT'), 10)
+        except Exception:
+            pass
+        if self.readerTask is not None:
+            self.readerTask.cancel()
+            try:
+                await self.readerTask
+            except BaseException:
+                pass
+        if self.writer is not None:
+            self.writer.close()
+        return None
+
+    # Send a command without waiting for it to finish
+    # Returns a Future that gets the (status, text) of the tagged response
+    def sendCommand(self, cmd):
+        self.tagNum += 1
+        tag = 'D{:04d}'.format(self.tagNum)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[tag.encode()] = future
+        self.writer.write('{} {}\r\n'.format(tag, cmd).encode())
+        return future
+
+    # Send a command and wait for it to finish
+    async def command(self, cmd):
+        future = self.sendCommand(cmd)
+        await self.writer.drain()
+        return await future
+
+    # Read one complete response from the server, including any literals
+    # Returns the response in imaplib format: a bytes line, or a list of (prefix, literal) tuples followed by the rest of the line
+    async def readResponse(self):
+        line = await self.reader.readline()
+        if line == b'':
+            raise ConnectionError('Connection closed by server')
+        parts = []
+        while True:
+            literal = re.search(rb'\{(\d+)\}\r\n$', line)
+            if literal is None:
+                parts.append(line.rstrip(b'\r\n'))
+                break
+            data = await self.reader.readexactly(int(literal.group(1)))
+            parts.append((line.rstrip(b'\r\n'), data))
+            line = await self.reader.readline()
+        return parts
+
+    # Read responses for as long as the connection is open
+    # Untagged responses are saved for the caller. Tagged responses complete the matching command.
+    async def readResponses(self):
+        try:
+            while True:
+                parts = await self.readResponse()
+                first = parts[0] if isinstance(parts[0], bytes) else parts[0][0]
+                if first.startswith(b'* '):
+                    if isinstance(parts[0], bytes):
+                        self.untagged.append(parts[0][2:])
+                    else:
+                        self.untagged.append((parts[0][0][2:], parts[0][1]))
+                        self.untagged.extend(parts[1:])
+                    continue
+                if first.startswith(b'+'):     # Continuation request. Not used by any command we send.
+                    continue
+                tag, status, text = (first.split(b' ', 2) + [b'', b''])[:3]
+                future = self.pending.pop(tag, None)
+                if future is not None and not future.done():
+                    future.set_result((status.decode(), text.decode(errors='replace')))
+        except Exception as e:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Connection error: {}'.format(e)))
+            self.pending = {}
+        return None
+
+    # Run a list of UID FETCH commands, keeping up to 'depth' of them in flight at once
+    # Returns (all commands OK?, untagged data in imaplib format)
+    async def fetch(self, uidSets, fetchSpec, depth):
+        self.untagged = []
+        allOk = True
+        inFlight = []
+        for uidSet in uidSets:
+            inFlight.append(self.sendCommand('UID FETCH {} {}'.format(uidSet, fetchSpec)))
+            if len(inFlight) >= depth:
+                await self.writer.drain()
+                status, text = await inFlight.pop(0)
+                allOk = allOk and status == 'OK'
+        await self.writer.drain()
+        for future in inFlight:
+            status, text = await future
+            allOk = allOk and status == 'OK'
+        data = self.untagged
+        self.untagged = []
+        return allOk, data
+
+# Manager for a group of async IMAP connections to a single server/folder
+class AsyncImapEngine:
+    def __init__(self, serverName, options):
+        self.name = serverName
+        self.options = options
+        self.loop = None
+        self.connections = []
+        self.uidValidity = None
+
+    # Run a list of coroutines concurrently on the engine's event loop and wait for them all to finish
+    # Returns a list of results. Exceptions are returned in place of results.
+    def runAll(self, coroutines):
+        async def gatherAll():
+            return await asyncio.gather(*coroutines, return_exceptions=True)
+        return self.loop.run_until_complete(gatherAll())
+
+    # Open the connections. Returns True if at least one connection is available
+    def open(self):
+        globs.log.write(globs.SEV_NOTICE, function='AsyncImapEngine', action='open', msg='Opening {} async connections to {}.'.format(self.options['asyncconnections'], self.options['server']))
+        self.loop = asyncio.new_event_loop()
+        connections = [AsyncImapConnection(self.options, connNum) for connNum in range(max(self.options['asyncconnections'], 1))]
+        results = self.runAll([conn.open() for conn in connections])
+        for conn, result in zip(connections, results):
+            if isinstance(result, Exception):
+                globs.log.write(globs.SEV_ERROR, function='AsyncImapEngine', action='open', msg='Async connection #{} to {} failed: {}'.format(conn.connNum, self.options['server'], result))
+                self.loop.run_until_complete(conn.close())
+            else:
+                self.connections.append(conn)
+
+        if len(self.connections) == 0:
+            self.close()
+            return False
+        self.uidValidity = self.connections[0].uidValidity
+        globs.log.write(globs.SEV_NOTICE, function='AsyncImapEngine', action='open', msg='{} async connections open. UIDVALIDITY={}'.format(len(self.connections), self.uidValidity))
+        return True
+
+    # Close all the connections
+    def close(self):
+        if self.loop is None:
+            return None
+        self.runAll([conn.close() for conn in self.connections])
+        self.connections = []
+        self.loop.close()
+        self.loop = None
+        return None
+
+    # Fetch a list of UIDs, spreading them over all the connections with 'asyncpipeline' FETCH commands in flight on each one
+    # Returns (all commands OK?, combined untagged data in imaplib format)
+    def fetch(self, uidList, fetchSpec):
+        if len(uidList) == 0:
+            return True, []
+
+        # Split the UIDs into one chunk per FETCH command. Deal the chunks out round-robin so each connection gets an even share.
+        numCommands = min(len(uidList), len(self.connections) * max(self.options['asyncpipeline'], 1))
+        chunkSize = -(-len(uidList) // numCommands)   # Round up
+        chunks = [b','.join(uidList[pos:pos + chunkSize]).decode() for pos in range(0, len(uidList), chunkSize)]
+        assigned = [chunks[connNum::len(self.connections)] for connNum in range(len(self.connections))]
+
+        jobs = [conn.fetch(uidSets, fetchSpec, max(self.options['asyncpipeline'], 1)) for conn, uidSets in zip(self.connections, assigned) if len(uidSets) > 0]
+        results = self.runAll(jobs)
+
+        allOk = True
+        data = []
+        for result in results:
+            if isinstance(result, Exception):
+                globs.log.write(globs.SEV_ERROR, function='AsyncImapEngine', action='fetch', msg='Async FETCH error: {}'.format(result))
+                allOk = False
+                continue
+            allOk = allOk and result[0]
+            data.extend(result[1])
+        globs.log.write(globs.SEV_DEBUG, function='AsyncImapEngine', action='fetch', msg='Fetched {} messages in {} commands over {} connections. allOk={}'.format(len(uidList), len(chunks), len(jobs), allOk))
+        return allOk, data
@@ -0,0 +1,125 @@
+#####
+#
+# Module name:  drcompress.py
+# Purpose:      IMAP COMPRESS=DEFLATE (RFC 4978) support for imaplib connections
+#
+# Notes:        imaplib doesn't support the COMPRESS extension. Once the server has accepted 'COMPRESS DEFLATE', everything
+#               sent and received on the connection is a raw DEFLATE stream. DeflateStream takes over the connection's
+#               read(), readline() and send() methods so the rest of imaplib (and dupReport) works the same as before.
+#
+#               Duplicati reports are very repetitive text, so compression greatly reduces the data sent over slow or metered links.
+#
+#####
+
+# Import system modules
+import imaplib
+import zlib
+
+# Import dupReport modules
+import globs
+
+# Largest amount of compressed data read from the connection at once
+readSize = 65536
+
+# Longest line accepted from the server, after decompression. Same limit imaplib uses for uncompressed connections.
+maxLineLength = 1000000
+
+class DeflateStream:
+    def __init__(self, imapConn):
+        self.imapConn = imapConn
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)    # Negative window size = raw DEFLATE, no zlib header
+        self.decompressor = zlib.decompressobj(-15)
+        self.buffer = bytearray()   # Data received and decompressed, but not read yet
+        self.bytesIn = 0            # Bytes received, compressed
+        self.bytesInData = 0        # Bytes received, after decompression
+        self.bytesOut = 0           # Bytes sent, compressed
+        self.bytesOutData = 0       # Bytes sent, before compression
+
+        # Take over imaplib's I/O for this connection
+        imapConn.read = self.read
+        imapConn.readline = self.readline
+        imapConn.send = self.send
+
+    # Receive and decompress more data from the server
+    def fill(self):
+        data = self.imapConn.file.read1(readSize)   # Whatever is available, up to readSize. Includes anything imaplib's reader already had buffered.
+        if data == b'':
+            raise imaplib.IMAP4.abort('socket error: EOF')
+        self.bytesIn += len(data)
+        data = self.decompressor.decompress(data)
+        self.bytesInData += len(data)
+        self.buffer += data
+        return None
+
+    # Replacement for imaplib.IMAP4.read(). Read 'size' bytes.
+    def read(self, size):
+        while len(self.buffer) < size:
+            self.fill()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    # Replacement for imaplib.IMAP4.readline(). Read one line, including the line ending.
+    def readline(self):
+        start = 0
+        while True:
+            end = self.buffer.find(b'\n', start)
+            if end >= 0:
+                break
+            if len(self.buffer) > maxLineLength:
+                raise imaplib.IMAP4.error('got more than {} bytes'.format(maxLineLength))
+            start = len(self.buffer)
+            self.fill()
+        data = bytes(self.buffer[:end + 1])
+        del self.buffer[:end + 1]
+        return data
+
+    # Replacement for imaplib.IMAP4.send(). Compress and send data, flushing so the server gets the complete command right away.
+    def send(self, data):
+        compressed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.bytesOutData += len(data)
+        self.bytesOut += len(compressed)
+        self.imapConn.sock.sendall(compressed)
+        return None
+
+    # True if there is received data that hasn't been read yet. The connection's socket won't show as readable for it.
+    def pending(self):
+        return len(self.buffer) > 0
+
+    # Describe the compression achieved so far, for the log
+    def stats(self):
+        return 'received {} bytes ({} uncompressed, ratio {:.1f}:1), sent {} bytes ({} uncompressed)'.format(self.bytesIn, self.bytesInData,
+            self.bytesInData / self.bytesIn if self.bytesIn > 0 else 0.0, self.bytesOut, self.bytesOutData)
+
+# Check that an imaplib connection has the attributes DeflateStream takes over: the buffered reader ('file'), the socket and the
+# method used to send the COMPRESS command. They aren't a documented part of imaplib, so another Python version could change them.
+def canCompress(imapConn):
+    return hasattr(getattr(imapConn, 'file', None), 'read1') and hasattr(getattr(imapConn, 'sock', None), 'sendall') and hasattr(imapConn, '_simple_command')
+
+# Turn on compression for an IMAP connection, if the server supports it. Must be called after logging in.
+# Returns a DeflateStream if compression is on, or None if it isn't
+def startCompression(imapConn, serverName):
+    # Nothing has been sent yet, so the connection carries on uncompressed if imaplib can't be taken over
+    if not canCompress(imapConn):
+        globs.log.write(globs.SEV_NOTICE, function='DeflateStream', action='startCompression', msg='This version of imaplib can\'t be used with compression. Not using COMPRESS=DEFLATE on server {}.'.format(serverName))
+        return None
+
+    # Servers often add COMPRESS to their capabilities only after logging in
+    if 'COMPRESS=DEFLATE' not in imapConn.capabilities:
+        retVal, data = imapConn.capability()
+        if retVal == 'OK' and data[-1] is not None:
+            imapConn.capabilities = tuple(data[-1].decode('ascii', errors='replace').upper().split())
+    if 'COMPRESS=DEFLATE' not in imapConn.capabilities:
+        globs.log.write(globs.SEV_DEBUG, function='DeflateStream', action='startCompression', msg='Server {} doesn\'t support COMPRESS=DEFLATE.'.format(serverName))
+        return None
+
+    imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+    try:
+        retVal, data = imapConn._simple_command('COMPRESS', 'DEFLATE')
+    except imaplib.IMAP4.error as e:
+        retVal, data = 'NO', [str(e).encode()]
+    if retVal != 'OK':
+        globs.log.write(globs.SEV_NOTICE, function='DeflateStream', action='startCompression', msg='Server {} refused COMPRESS DEFLATE: {}'.format(serverName, data))
+        return None
+    globs.log.write(globs.SEV_NOTICE, function='DeflateStream', action='startCompression', msg='Using COMPRESS=DEFLATE on server {}.'.format(serverName))
+    return DeflateStream(imapConn)
@@ -25,10 +25,22 @@ from email import encoders
 import json
 import ssl
 import sys
+import queue
+import select
+import concurrent.futures
+import collections
+import mailbox
+import io
 
 # Import dupReport modules
 import globs
 import drdatetime
+import drasync
+import drhttp
+import drtiming
+import drcompress
+import log
+import options
 import report
 
 
@@ -77,12 +89,134 @@ lineParts = [
     ('failed',              r'Failed: .*',                   re.MULTILINE|re.DOTALL,     1,                              ''),                        # No JSON equivalent
     ]
 
+# Precompiled tables used by EmailServer.searchMessageParts() to pull all the lineParts fields out of a text report in one scan of the body
+# Every lineParts regex starts with a literal field name ('DeletedFiles: ', 'Messages: ', 'Log data:', etc.)
+# linePartsKeyRegex finds all of the field names in a single pass. Each lineParts regex is then only tried at the places where its field name was found.
+linePartsRegex = [re.compile(regex, flag) for section, regex, flag, typ, jsonSection in lineParts]
+linePartsKey = [re.match(r'[^\\.(\[*^]*', regex).group() for section, regex, flag, typ, jsonSection in lineParts]
+linePartsIndex = {section: index for index, (section, regex, flag, typ, jsonSection) in enumerate(lineParts)}
+linePartsByKey = {}     # Field name -> indexes of the lineParts entries that start with it
+for index, key in enumerate(linePartsKey):
+    linePartsByKey.setdefault(key, []).append(index)
+linePartsKeyRegex = re.compile('|'.join(re.escape(key) for key in sorted(linePartsByKey, key=len, reverse=True)))   # Longest names first
+# Some field names contain other field names ('LimitedErrors: ' contains 'Errors: '). The combined regex only reports the longer one,
+# so keep a list of the (offset, field name) of every name found inside each name, including the name itself at offset 0.
+linePartsKeyHits = {}
+for key in linePartsByKey:
+    linePartsKeyHits[key] = sorted((start, other) for other in linePartsByKey for start in range(len(key) - len(other) + 1) if key.startswith(other, start))
+
 serverRcParts = {
     'imap': ['protocol', 'server', 'port', 'encryption', 'account', 'password', 'keepalive', 'folder', 'unreadonly', 'markread', 'authentication'],
     'pop3': ['protocol', 'server', 'port', 'encryption', 'account', 'password', 'keepalive', 'authentication'],
-    'smtp': ['protocol', 'server', 'port', 'encryption', 'account', 'password', 'keepalive', 'sender', 'sendername', 'receiver', 'authentication']
+    'smtp': ['protocol', 'server', 'port', 'encryption', 'account', 'password', 'keepalive', 'sender', 'sendername', 'receiver', 'authentication'],
+    'maildir': ['protocol', 'path'],
+    'mbox': ['protocol', 'path'],
+    'http': ['protocol', 'port']
+    }
+
+# Optional server options. If an option is not in the server's .rc section the default value is used.
+#   [0] option name     [1] default value   [2] type (0=int, 1=str, 2=bool)
+serverRcOptional = {
+    'imap': [
+        ('batchsize',       '500',              0),         # Number of messages per batched FETCH. 0 = fetch one message at a time
+        ('incremental',     'true',             2),         # Only search for messages newer than the last UID processed
+        ('connections',     '1',                0),         # Number of parallel connections used to retrieve messages from the folder
+        ('storebatch',      '1000',             0),         # Maximum number of messages flagged by each STORE command (markread=true)
+        ('markparsedonly',  'false',            2),         # Only mark messages that were parsed successfully as read (markread=true)
+        ('serversearch',    'false',            2),         # Have the server filter messages by subject & date before they are retrieved
+        ('engine',          'sync',             1),         # Retrieval engine for batched fetches: 'sync' (imaplib) or 'async' (asyncio, see drasync.py)
+        ('asyncconnections','4',                0),         # Number of connections used by the async engine
+        ('asyncpipeline',   '8',                0),         # Number of FETCH commands the async engine keeps in flight on each connection
+        ('bodylimit',       '0',                0),         # Number of bytes of each message body retrieved at first. 0 = retrieve the whole body
+        ('parseworkers',    '1',                0),         # Number of worker processes used to parse messages while they're being retrieved. 0 = one per CPU, 1 = parse in the retrieving thread
+        ('compress',        'false',            2),         # Use COMPRESS=DEFLATE (RFC 4978) if the server supports it
+        ],
+    'pop3': [
+        ('incremental',     'true',             2),         # Only look at messages whose UIDL wasn't on the server at the end of the last run
+        ('parseworkers',    '1',                0),         # Number of worker processes used to parse messages while they're being retrieved. 0 = one per CPU, 1 = parse in the retrieving thread
+        ],
+    'smtp': [],
+    'maildir': [
+        ('parseworkers',    '0',                0),         # Number of worker processes used to parse messages. 0 = one per CPU, 1 = parse in the main process
+        ],
+    'mbox': [
+        ('parseworkers',    '0',                0),         # Number of worker processes used to parse messages. 0 = one per CPU, 1 = parse in the main process
+        ],
+    'http': [
+        ('listen',          '127.0.0.1',        1),         # Address to listen on for reports. Blank = all addresses
+        ('token',           '',                 1),         # If set, requests must have '?token=<value>' in the URL
+        ]
     }
 
+# Local message stores that can be used as incoming servers, and the mailbox classes used to read them
+localProtocols = {'maildir': mailbox.Maildir, 'mbox': mailbox.mbox}
+
+# Header fields retrieved from incoming IMAP messages
+imapHeaderFetch = '(BODY.PEEK[HEADER.FIELDS (DATE SUBJECT MESSAGE-ID CONTENT-TRANSFER-ENCODING)])'
+imapBodyFetch = '(BODY.PEEK[TEXT])'
+imapPartialBodyFetch = '(BODY.PEEK[TEXT]<0.{}>)'     # First 'bodylimit' bytes of the body
+
+# Fields that must be in a message body cut off at 'bodylimit' bytes for it to be used. If any are missing the whole body is retrieved.
+# Duplicati writes the file counts first, then ParsedResult, EndTime and BeginTime, then the Messages/Warnings/Errors lists and the log data.
+# Failed backup reports only need the 'Failed:' line.
+partialRequired = ['parsedResult', 'endTimeStr', 'beginTimeStr']
+
+# Month names for IMAP SEARCH dates (dd-Mon-yyyy). Can't use strftime('%b') because it's locale-dependent
+imapMonths = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+# Messages handed to a parsing worker at a time
+parseBatchSize = 20
+
+# Maximum number of requests waiting for the database writer (see EmailManager.runWriter()). Collectors wait when the queue is full.
+writerQueueSize = 1000
+
+# Number of requests the database writer runs between commits
+writerCommitInterval = 500
+
+# Number of IMAP messages processed between checkpoints when batchsize = 0. Otherwise there's a checkpoint after every batch.
+checkpointInterval = 500
+
+# Parsing worker processes for local message stores (see EmailServer.parseLocalMessages()) and for the retrieval pipeline (see EmailServer.parseFetchedMessages())
+# Each worker has its own EmailServer to run the parsing code. Log lines are collected in memory and passed back to the main process to be written.
+parseWorkerServer = None
+
+def initParseWorker(progPath, opts, rcParser, serverName, serverOptions):
+    global parseWorkerServer
+    globs.progPath = progPath
+    globs.opts = opts
+    globs.log = log.LogHandler()
+    globs.log.defLogLevel = opts['verbose']
+    globs.log.logFile = io.StringIO()
+    globs.timer = drtiming.StageTimer(opts['stagetimers'])
+    globs.optionManager = options.OptionManager()
+    globs.optionManager.parser = rcParser
+    parseWorkerServer = EmailServer(serverName, serverOptions)
+    return None
+
+# Parse a list of raw messages in a worker process
+# Returns a list of (processNextMessage() return value, emailParts or None, log lines, stage times) for each message
+def parseWorkerMessages(msgList):
+    results = []
+    for msgBytes in msgList:
+        retVal, emailParts = parseWorkerServer.parseLocalMessage(msgBytes)
+        results.append((retVal, emailParts, globs.log.logFile.getvalue(), globs.timer.take()))
+        globs.log.logFile.seek(0)
+        globs.log.logFile.truncate()
+    return results
+
+# Parse the bodies of a list of retrieved messages in a worker process
+# msgList is a list of (processNextMessage() return value, emailParts or None, message UID). Messages with emailParts = None aren't parsed.
+# Returns the list with the log lines and stage times for each message added
+def parseWorkerBodies(msgList):
+    results = []
+    for retVal, emailParts, msgUid in msgList:
+        if emailParts is not None:
+            parseWorkerServer.parseBody(emailParts)
+        results.append((retVal, emailParts, msgUid, globs.log.logFile.getvalue(), globs.timer.take()))
+        globs.log.logFile.seek(0)
+        globs.log.logFile.truncate()
+    return results
+
 class EmailManager:
     def __init__(self):
         globs.log.write(globs.SEV_NOTICE, function='EmailManager', action='Init', msg='Initializing Email Manager.')
@@ -95,7 +229,7 @@ class EmailManager:
         for server in serverlist:
             isValid, options = self.validateServerOptions(server)
             if isValid:
-                if options['protocol'] in ['imap', 'pop3']:
+                if options['protocol'] in ['imap', 'pop3', 'maildir', 'mbox', 'http']:
                     self.incoming[server] =  EmailServer(server, options)
                 else: # Smtp
                     # Before you go blindly opening up an outgoing connection....
@@ -133,30 +267,195 @@ class EmailManager:
         globs.log.write(globs.SEV_NOTICE, function='EmailManager', action='getSmtpServer', msg='Unable to find any available outgoing SMTP servers.')
         return None
 
-    def checkForNewMessages(self):
+    # fullScan = True to look at every message on the servers, not just new ones. Defaults to True if the database will be purged.
+    def checkForNewMessages(self, fullScan=None):
         globs.log.write(globs.SEV_NOTICE, function='EmailManager', action='checkForNewMessages', msg='Checking inbound servers for new email messages.')
+        startTime = time.time()
+        globs.timer.reset()     # Times are for this collection only
+        if fullScan is None:
+            fullScan = globs.opts['purgedb']
+        globs.db.loadKnownMessageIds()
         for server in self.incoming:
-            # Get new messages on server
-            progCount = 0   # Count for progress indicator
-            newMessages = self.incoming[server].checkForMessages()
-            globs.log.write(globs.SEV_NOTICE, function='EmailManager', action='checkForNewMessages', msg='Found {} new messages on server {}'.format(newMessages, self.incoming[server].options['server']))
-            if newMessages > 0:
-                nxtMsg = self.incoming[server].processNextMessage()
-                while nxtMsg is not None:
-                    if globs.opts['showprogress'] > 0:
-                        progCount += 1
-                        if (progCount % globs.opts['showprogress']) == 0:
-                            globs.log.out('.', newline = False)
-                    nxtMsg = self.incoming[server].processNextMessage()
-                if globs.opts['showprogress'] > 0:
-                    globs.log.out(' ')   # Add newline at end.
-
-                # Do we want to mark messages as 'read/seen'? (Only works for IMAP)
-                if self.incoming[server].options['protocol'] == 'imap':
-                    if self.incoming[server].options['markread'] is True:
-                        self.incoming[server].markMessagesRead()
+            self.incoming[server].fullScan = fullScan
+
+        # Collect from several servers at once so one slow server doesn't hold up the rest.
+        # SQLite connections can't be shared between threads, so all database work is passed back to this (main) thread,
+        # which acts as the single database writer while the servers are being collected.
+        numWorkers = min(globs.opts['collectworkers'], len(self.incoming))
+        if numWorkers <= 1:
+            for server in self.incoming:
+                self.collectServer(self.incoming[server])
+        else:
+            self.collectConcurrently(numWorkers)
+        globs.db.dbCommit()     # Save the last batch of emails
+        globs.timer.writeSummary(time.time() - startTime)
         return
 
+    # Collect from the incoming servers on 'numWorkers' threads, with this thread acting as the database writer
+    def collectConcurrently(self, numWorkers):
+        globs.log.write(globs.SEV_NOTICE, function='EmailManager', action='checkForNewMessages', msg='Collecting from {} servers using {} workers.'.format(len(self.incoming), numWorkers))
+        writerQueue = queue.Queue(maxsize=writerQueueSize)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=numWorkers) as pool:
+            collectors = []
+            for server in self.incoming:
+                self.incoming[server].writerQueue = writerQueue
+                collectors.append(pool.submit(self.collectServer, self.incoming[server]))
+            self.runWriter(writerQueue, collectors)
+        for server in self.incoming:
+            self.incoming[server].writerQueue = None
+
+        # Pass along any exceptions raised in the collector threads
+        for collector in collectors:
+            collector.result()
+        return None
+
+    # Get and process all new messages on a single server
+    def collectServer(self, emailServer):
+        # Get new messages on server
+        newMessages = emailServer.checkForMessages()
+        globs.log.write(globs.SEV_NOTICE, function='EmailManager', action='collectServer', msg='Found {} new messages on server {}'.format(newMessages, emailServer.options['server']))
+        if newMessages > 0:
+            # Reports received over HTTP are saved as one batch, with a single commit
+            if emailServer.options['protocol'] == 'http':
+                emailServer.writerCall(globs.db.holdCommits, True)
+            shards = emailServer.openShards()
+            emailServer.openParsePool(shards)
+            if len(shards) == 0 and emailServer.parsePool is None:
+                self.processMessages(emailServer)
+            else:
+                self.processShards(emailServer, shards)
+            emailServer.closeParsePool(shards)
+            emailServer.closeShards(shards)
+            if emailServer.options['protocol'] == 'http':
+                emailServer.writerCall(globs.db.holdCommits, False)
+            if globs.opts['showprogress'] > 0:
+                globs.log.out(' ')   # Add newline at end.
+
+            # Do we want to mark messages as 'read/seen'? (Only works for IMAP)
+            # Messages up to the last checkpoint have been marked already. The rest have to be saved first.
+            if emailServer.options['protocol'] == 'imap':
+                if emailServer.options['markread'] is True:
+                    emailServer.writerCall(globs.db.commitHeld)
+                    emailServer.markMessagesRead()
+
+        # Remember where we left off on this server
+        # The server-side search (serversearch=true) uses the saved IMAP sync state too
+        if emailServer.options['protocol'] in ['imap', 'pop3'] and (emailServer.options['incremental'] is True or emailServer.options.get('serversearch') is True):
+            emailServer.saveSyncState()
+        # The collection finished, so there's nothing to resume
+        emailServer.clearCheckpoint()
+        return None
+
+    # Process all the messages queued on a server connection, then log the connection's throughput
+    # Messages are processed in order, so after n messages have been processed the first n messages on the connection are done. See EmailServer.checkpoint().
+    def processMessages(self, emailServer):
+        progCount = 0   # Count for progress indicator
+        numDone = 0     # Number of messages processed
+        startTime = time.time()
+        emailServer.fetchBytes = 0
+        nxtMsg = emailServer.processNextMessage()
+        while nxtMsg is not None:
+            if globs.opts['showprogress'] > 0:
+                progCount += 1
+                if (progCount % globs.opts['showprogress']) == 0:
+                    globs.log.out('.', newline = False)
+            numDone += 1
+            if numDone % emailServer.checkpointEvery() == 0:
+                emailServer.checkpoint(numDone)
+            if emailServer.writerQueue is None:     # This is the database writer. Save a batch that has waited too long while non-report messages are read.
+                globs.db.commitIfDue()
+            nxtMsg = emailServer.processNextMessage()
+
+        elapsed = max(time.time() - startTime, 0.001)
+        globs.log.write(globs.SEV_NOTICE, function='EmailManager', action='processMessages', msg='Connection {}: {} messages, {} bytes in {:.2f} seconds ({:.1f} msgs/sec, {:.1f} KB/sec)'.format(emailServer.name, emailServer.numEmails, emailServer.fetchBytes, elapsed, emailServer.numEmails / elapsed, emailServer.fetchBytes / 1024 / elapsed))
+        if emailServer.compressStream is not None:
+            globs.log.write(globs.SEV_NOTICE, function='EmailManager', action='processMessages', msg='Connection {} compression since connecting: {}'.format(emailServer.name, emailServer.compressStream.stats()))
+        return None
+
+    # Process a folder that has been split across several connections (see EmailServer.openShards()), or is using the retrieval pipeline
+    # Each connection runs on its own thread. If this is the main thread it also has to act as the database writer.
+    def processShards(self, emailServer, shards):
+        servers = [emailServer] + shards
+        localWriter = emailServer.writerQueue is None
+        if localWriter:
+            writerQueue = queue.Queue(maxsize=writerQueueSize)
+            for server in servers:
+                server.writerQueue = writerQueue
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(servers)) as pool:
+            collectors = [pool.submit(self.processMessages, server) for server in servers]
+            if localWriter:
+                self.runWriter(writerQueue, collectors)
+
+        if localWriter:
+            for server in servers:
+                server.writerQueue = None
+        for collector in collectors:
+            collector.result()
+        return None
+
+    # Wait for new messages to arrive on the incoming servers (daemon mode)
+    # IMAP servers that support IDLE and HTTP receivers are watched all at once. Servers that don't (including POP3) are just polled when the wait ends.
+    # timeout = maximum number of seconds to wait
+    # Returns True if new messages may be waiting, False if the wait timed out with nothing new
+    def waitForNewMessages(self, timeout):
+        globs.db.commitHeld()   # Nothing is left waiting to be written while the servers are idle
+        idling = []
+        for server in self.incoming:
+            if self.incoming[server].startIdle():
+                idling.append(self.incoming[server])
+
+        if len(idling) < len(self.incoming):    # Somebody has to be polled
+            globs.log.write(globs.SEV_DEBUG, function='EmailManager', action='waitForNewMessages', msg='{} of {} servers can IDLE. Others will be polled.'.format(len(idling), len(self.incoming)))
+        if len(idling) == 0:
+            time.sleep(timeout)
+            return True
+
+        # A compressed connection may already have received & decompressed the server's response. Its socket won't show it.
+        if any(server.compressStream is not None and server.compressStream.pending() for server in idling):
+            timeout = 0
+        try:
+            ready = select.select([server.serverconnect.socket() for server in idling], [], [], timeout)[0]
+        except (OSError, ValueError) as e:
+            globs.log.write(globs.SEV_ERROR, function='EmailManager', action='waitForNewMessages', msg='Error waiting for new messages: {}'.format(e))
+            ready = []
+
+        newMail = len(idling) < len(self.incoming)
+        for server in idling:
+            if server.endIdle():
+                newMail = True
+        globs.log.write(globs.SEV_NOTICE, function='EmailManager', action='waitForNewMessages', msg='Wait ended. Activity on {} servers. New messages={}'.format(len(ready), newMail))
+        return newMail
+
+    # Single database writer used during concurrent collection
+    # Runs requests queued by EmailServer.writerCall() until all the collectors have finished
+    # Commits are held and done every 'writerCommitInterval' requests, whenever the queue runs dry, or when waiting emails are [main]insertinterval seconds old,
+    # instead of once for every message
+    def runWriter(self, writerQueue, collectors):
+        globs.db.holdCommits(True)
+        numRequests = 0
+        while True:
+            allDone = all(collector.done() for collector in collectors)   # Check before reading the queue so no late requests get missed
+            try:
+                func, args, kwargs, future = writerQueue.get(timeout=0.1)
+            except queue.Empty:
+                globs.db.commitHeld()
+                if allDone:
+                    break
+                continue
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                globs.log.write(globs.SEV_ERROR, function='EmailManager', action='runWriter', msg='Error running {}: {}'.format(func.__name__, e))
+                future.set_exception(e)
+            numRequests += 1
+            if numRequests % writerCommitInterval == 0:
+                globs.db.commitHeld()
+            else:
+                globs.db.commitIfDue()
+        globs.db.holdCommits(False)
+        return None
+
     def sendEmail(self, **kwargs):
         svr = self.getSmtpServer()
 
@@ -183,7 +482,7 @@ class EmailManager:
         elif 'protocol' not in rcOptions:
             globs.log.write(globs.SEV_NOTICE, function='EmailManager', action='validateServerOptions', msg='No protocol specified for server \'{}\''.format(server))
             isValid = False
-        elif rcOptions['protocol'] not in ['imap', 'pop3', 'smtp']:
+        elif rcOptions['protocol'] not in ['imap', 'pop3', 'smtp', 'maildir', 'mbox', 'http']:
             globs.log.write(globs.SEV_NOTICE, function='EmailManager', action='validateServerOptions', msg='Invalid protocol \'{}\' specified for email server \'{}\''.format(rcOptions['protocol'], server))
             isValid = False
 
@@ -203,6 +502,22 @@ class EmailManager:
                 else: # String value
                     options[option] = rcOptions[option]
 
+        # Fill in optional options, using the default if not specified
+        for option, default, typ in serverRcOptional[rcOptions['protocol']]:
+            value = rcOptions[option] if option in rcOptions else default
+            if typ == 0:    # Int conversion
+                options[option] = int(value)
+            elif typ == 2:  # Bool conversion
+                options[option] = value.lower() == 'true'
+            else:           # String value
+                options[option] = value
+
+        # Local message stores and the HTTP receiver don't have a server. Use the path or listening address in its place in log messages.
+        if rcOptions['protocol'] in localProtocols and 'path' in options:
+            options['server'] = options['path']
+        elif rcOptions['protocol'] == 'http' and 'port' in options:
+            options['server'] = '{}:{}'.format(options['listen'] if options['listen'] != '' else '*', options['port'])
+
         return isValid, options
 
 class EmailServer:
@@ -216,10 +531,38 @@ class EmailServer:
         self.numEmails = 0      # Number of emails in list
         self.nextEmail = 0      # index into list of next email to be retrieved
         self.available = False  # Set to True if able to make a connection
+        self.batchCache = {}    # Prefetched IMAP headers & bodies, keyed by message UID. Used when batchsize > 0
+        self.uidValidity = None # UIDVALIDITY of the selected IMAP folder
+        self.lastUid = None     # Highest UID processed on a previous run (IMAP incremental sync)
+        self.writerQueue = None # Queue to the database writer thread. Set only during concurrent collection
+        self.allEmails = None   # Full list of new emails while the list is split across connections (see openShards())
+        self.fetchBytes = 0     # Bytes of message data retrieved. Used for throughput stats
+        self.parsedUids = set() # UIDs of IMAP messages successfully parsed. Used by markMessagesRead() when markparsedonly=true
+        self.markedUids = set() # UIDs of IMAP messages already marked as read by markMessagesRead() this run
+        self.shards = []        # Extra connections opened by openShards()
+        self.shardOwner = None  # EmailServer that opened this connection, if it's one of the extra connections from openShards()
+        self.checkpointDone = {}    # Number of messages done on each connection at its last checkpoint, by connection name. See saveCheckpoint().
+        self.checkpointBatch = 0    # Number of the last checkpoint saved for this folder
+        self.fullScan = False   # Look at every message in the folder, not just ones that are new since the last run. Set by EmailManager.checkForNewMessages()
+        self.idleTag = None     # Tag of the IMAP IDLE command in progress (daemon mode)
+        self.asyncEngine = None # drasync.AsyncImapEngine used for batched fetches when engine=async
+        self.asyncFailed = False    # Set if the async engine couldn't be used. Batched fetches go back to imaplib.
+        self.newestEmailTimestamp = None    # Timestamp of the newest email saved from the IMAP folder this run. See saveSyncState().
+        self.pop3Uidls = None   # {message index: UIDL} of the messages on a POP3 server. None if not tracking UIDLs
+        self.localResults = None    # Results from parsing the messages in a local message store. Set by processNextLocalMessage()
+        self.parsePool = None   # Pool of parsing worker processes shared by all the connections to this server (parseworkers != 1). Set by openParsePool()
+        self.parseAhead = 0     # Number of message batches this connection keeps waiting to be parsed
+        self.pipelineResults = None     # Results from the retrieval pipeline. Set by processNextPipelinedMessage()
+        self.compressStream = None      # drcompress.DeflateStream for the IMAP connection if compress=true and the server supports COMPRESS=DEFLATE
         globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='init', msg='Email server \'{}\' initialized'.format(serverName))
         return None
 
     def connect(self):
+        if self.options['protocol'] in localProtocols:
+            return self.openLocalStore()
+        if self.options['protocol'] == 'http':
+            return self.openHttpReceiver()
+
         globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='connect', msg='Connecting to email server \'{}\''.format(self.options['server']))
         globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='connect', msg='serverconnect=[{}] keepalive=[{}]'.format(self.serverconnect, self.options['keepalive']))
 
@@ -269,6 +612,7 @@ class EmailServer:
         else:     # self.serverconnect == None. Never connected, need to establish server connection
             globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='connect:Init', msg='Initiating new server connection using {}'.format(self.options['protocol']))
             if self.options['protocol'] == 'imap':
+                self.compressStream = None
                 try:
                     if self.options['encryption'] != 'none':
                         self.serverconnect = imaplib.IMAP4_SSL(self.options['server'],self.options['port'])
@@ -276,8 +620,12 @@ class EmailServer:
                         self.serverconnect = imaplib.IMAP4(self.options['server'],self.options['port'])
                     retVal, data = self.serverconnect.login(self.options['account'], self.options['password'])
                     globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='connectInit', msg='IMAP Logged in. retVal=[{}] data=[{}]'.format(retVal, globs.maskData(data)))
+                    self.compressStream = drcompress.startCompression(self.serverconnect, self.options['server']) if self.options['compress'] else None
                     retVal, data = self.serverconnect.select(self.options['folder'])
                     globs.log.write(globs.SEV_DEBUG,function='EmailServer', action='connect:Imap', msg='Setting IMAP folder. retVal=[{}] data=[{}]'.format(retVal, data))
+                    uidValidity = self.serverconnect.response('UIDVALIDITY')[1][0]
+                    self.uidValidity = int(uidValidity) if uidValidity is not None else None
+                    globs.log.write(globs.SEV_DEBUG,function='EmailServer', action='connect:Imap', msg='Folder UIDVALIDITY=[{}]'.format(self.uidValidity))
                     self.available = True
                     return retVal
                 except:
@@ -335,6 +683,77 @@ class EmailServer:
                 return None
         return None
 
+    # Start an IMAP IDLE command (RFC 2177) so the server will tell us when new mail arrives
+    # imaplib doesn't support IDLE, so the command is sent directly over the connection.
+    # Returns True if the server is now idling, False if it can't (not IMAP, not connected, or no IDLE capability)
+    # An HTTP receiver is always 'idling'. Its serverconnect.socket() is the receiver's wake-up socket.
+    def startIdle(self):
+        self.idleTag = None
+        if self.options['protocol'] == 'http':     # The receiver's wake-up socket is ready as soon as a report arrives
+            self.connect()
+            return self.available
+        if self.options['protocol'] != 'imap':
+            return False
+        self.connect()
+        if not self.available or 'IDLE' not in self.serverconnect.capabilities:
+            return False
+
+        try:
+            tag = self.serverconnect._new_tag()
+            self.serverconnect.send(tag + b' IDLE\r\n')
+            response = self.serverconnect.readline()
+            globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='startIdle', msg='IDLE response=[{}]'.format(response))
+            if not response.startswith(b'+'):   # Server refused
+                self.serverconnect.tagged_commands.pop(tag, None)
+                return False
+        except (imaplib.IMAP4.abort, OSError) as e:
+            self.dropConnection('IDLE', e)
+            return False
+
+        self.idleTag = tag
+        return True
+
+    # End an IMAP IDLE command started by startIdle()
+    # Returns True if the server reported new messages (EXISTS or RECENT) while idling, or an HTTP receiver has reports waiting
+    def endIdle(self):
+        if self.options['protocol'] == 'http' and self.serverconnect is not None:
+            return self.serverconnect.clearWake()
+        if self.idleTag is None:
+            return False
+
+        newMail = False
+        try:
+            self.serverconnect.send(b'DONE\r\n')
+            while True:     # Read everything the server sent up to the end of the IDLE command
+                line = self.serverconnect.readline()
+                globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='endIdle', msg='IDLE response=[{}]'.format(line))
+                if line == b'':
+                    raise imaplib.IMAP4.abort('connection closed during IDLE')
+                if line.startswith(self.idleTag):
+                    break
+                if line.startswith(b'*') and (line.rstrip().endswith(b'EXISTS') or line.rstrip().endswith(b'RECENT')):
+                    newMail = True
+            self.serverconnect.tagged_commands.pop(self.idleTag, None)
+        except (imaplib.IMAP4.abort, OSError) as e:
+            self.dropConnection('IDLE', e)
+            newMail = True      # Don't know what we missed. Let the reconnect find out.
+
+        self.idleTag = None
+        return newMail
+
+    # Forget about a connection that has failed so the next connect() starts a new one
+    def dropConnection(self, command, err):
+        globs.log.write(globs.SEV_ERROR, function='EmailServer', action='dropConnection', msg='{} error on server {}: {}. Will reconnect.'.format(command, self.options['server'], err))
+        try:
+            self.serverconnect.shutdown()
+        except:
+            pass
+        self.serverconnect = None
+        self.available = False
+        self.idleTag = None
+        self.compressStream = None
+        return None
+
     # Close email server connection
     def close(self):
         globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='close', msg='Closing connection to {}.'.format(self.options['server']))
@@ -342,8 +761,41 @@ class EmailServer:
         if self.serverconnect != None:
             if self.options['protocol'] in ['pop3', 'smtp']:
                 self.serverconnect.quit()
+            elif self.options['protocol'] == 'http':
+                self.serverconnect.close()
+                self.serverconnect = None
             else: #IMAP
                 self.serverconnect.close()
+        if self.asyncEngine is not None:
+            self.asyncEngine.close()
+            self.asyncEngine = None
+        return None
+
+    # Open a local message store (protocol = maildir or mbox)
+    def openLocalStore(self):
+        if self.serverconnect is not None:
+            return None
+
+        globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='openLocalStore', msg='Opening {} message store {}'.format(self.options['protocol'], self.options['path']))
+        try:
+            self.serverconnect = localProtocols[self.options['protocol']](self.options['path'], create=False)
+            self.available = True
+        except (mailbox.Error, OSError) as e:
+            globs.log.write(globs.SEV_ERROR, function='EmailServer', action='openLocalStore', msg='Unable to open message store {}: {}'.format(self.options['path'], e))
+            self.available = False
+        return None
+
+    # Start the HTTP report receiver (protocol = http)
+    def openHttpReceiver(self):
+        if self.serverconnect is not None:
+            return None
+
+        receiver = drhttp.HttpReceiver(self)
+        self.available = receiver.open()
+        if self.available:
+            self.serverconnect = receiver
+            if not globs.opts['daemon']:
+                globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='openHttpReceiver', msg='Not running in daemon mode (-D). Reports sent to {} will only be received while dupReport is running.'.format(self.options['server']))
         return None
 
     # Check if there are new messages waiting on the server
@@ -356,32 +808,321 @@ class EmailServer:
             globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='checkForMessages', msg='Server {} marked as \'unavailable\''.format(self.options['server']))
             return 0
 
+        self.pipelineResults = None
         if self.options['protocol'] == 'pop3':
-            self.numEmails = len(self.serverconnect.list()[1])  # Get list of new emails
+            self.newEmails = list(range(len(self.serverconnect.list()[1])))  # Get list of emails
+
+            # Skip messages that were already on the server at the end of the last run. They've been looked at already.
+            # Purging the database relies on seeing every message on the server, so don't skip any in that case.
+            self.pop3Uidls = self.getPop3Uidls() if self.options['incremental'] is True else None
+            if self.pop3Uidls is not None and self.fullScan is not True:
+                seenUidls = self.writerCall(globs.db.getPop3Uidls, self.options['server'], self.options['account'])
+                self.newEmails = [msgNum for msgNum in self.newEmails if self.pop3Uidls.get(msgNum) not in seenUidls]
+                globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='checkForMessages', msg='{} of {} messages on server {} are new since the last run.'.format(len(self.newEmails), len(self.pop3Uidls), self.options['server']))
+
+            self.numEmails = len(self.newEmails)
             if self.numEmails == 0:     # No new emails
                 self.newEmails = None
                 self.nextEmail = 0
                 return 0
-            self.newEmails = list(range(self.numEmails))
             self.nextEmail = -1     # processNextMessage() pre-increments message index. Initializing to -1 ensures the pre-increment start at 0
             return self.numEmails
         elif self.options['protocol'] == 'imap':
             # Issue #124 - only read unseen/unread messages. Speed up input processing.
             scope = '(UNSEEN)' if self.options['unreadonly'] == True else 'ALL'
-            retVal, data = self.serverconnect.search(None, scope)
+            if self.options['serversearch'] is True:
+                scope = '{} {}'.format(self.serverSearchCriteria(), scope).lstrip()
+
+            # If we've seen this folder before, only search for messages that arrived since the last run.
+            # If the folder's UIDVALIDITY has changed the old UIDs are meaningless, so fall back to a full scan.
+            # Purging the database relies on seeing every message on the server, so always do a full scan in that case.
+            self.lastUid = None
+            if self.options['incremental'] is True and self.uidValidity is not None:
+                uidValidity, lastUid = self.writerCall(globs.db.getImapSyncState, self.options['server'], self.options['account'], self.options['folder'])
+                if self.fullScan is True:
+                    globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='checkForMessages', msg='Full scan requested (database purge). Scanning entire folder.')
+                elif uidValidity is None:
+                    globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='checkForMessages', msg='No sync history for folder {}. Scanning entire folder.'.format(self.options['folder']))
+                elif uidValidity != self.uidValidity:
+                    globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='checkForMessages', msg='UIDVALIDITY for folder {} changed from {} to {}. Scanning entire folder.'.format(self.options['folder'], uidValidity, self.uidValidity))
+                else:
+                    self.lastUid = lastUid
+
+            # If the last collection from this folder didn't finish, pick up after the last checkpoint it saved
+            self.checkpointDone = {}
+            self.checkpointBatch = 0
+            if self.uidValidity is not None and self.fullScan is not True:
+                uidValidity, lastUid, batchId = self.writerCall(globs.db.getImapCheckpoint, self.options['server'], self.options['account'], self.options['folder'])
+                if uidValidity == self.uidValidity and (self.lastUid is None or lastUid > self.lastUid):
+                    globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='checkForMessages', msg='Last collection from folder {} stopped after checkpoint {}. Resuming after UID {}.'.format(self.options['folder'], batchId, lastUid))
+                    self.lastUid = lastUid
+                    self.checkpointBatch = batchId
+            if self.lastUid is not None:
+                scope = 'UID {}:* {}'.format(self.lastUid + 1, scope)
+
+            # Messages are tracked by UID rather than sequence number so they can be fetched & flagged in batches
+            retVal, data = self.serverconnect.uid('SEARCH', scope)
             globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='checkForMessagesImap', msg='Searching folder. retVal=[{}] data=[{}]'.format(retVal, data))
             if retVal != 'OK':          # No new emails
                 self.newEmails = None
                 self.numEmails = 0
                 self.nextEmail = 0
                 return 0
-            self.newEmails = list(data[0].split())   # Get list of new emails
+            self.newEmails = sorted(data[0].split(), key=int)   # Get list of new emails, oldest first. Checkpoints rely on the order.
+            if self.lastUid is not None:
+                # 'n:*' always matches the highest UID in the folder, even if it's less than n. Weed out anything already seen.
+                self.newEmails = [msgUid for msgUid in self.newEmails if int(msgUid) > self.lastUid]
+            self.batchCache = {}
+            self.parsedUids = set()
+            self.markedUids = set()
+            self.newestEmailTimestamp = None
             self.numEmails = len(self.newEmails)
             self.nextEmail = -1     # processNextMessage() pre-increments message index. Initializing to -1 ensures the pre-increment start at 0
             return self.numEmails
+        elif self.options['protocol'] == 'http':
+            self.newEmails = self.serverconnect.takeReports()
+            self.numEmails = len(self.newEmails)
+            if self.numEmails == 0:     # No reports
+                self.newEmails = None
+                self.nextEmail = 0
+                return 0
+            self.nextEmail = -1     # processNextMessage() pre-increments message index. Initializing to -1 ensures the pre-increment start at 0
+            return self.numEmails
+        elif self.options['protocol'] in localProtocols:
+            self.newEmails = sorted(self.serverconnect.keys())
+            self.numEmails = len(self.newEmails)
+            self.localResults = None
+            if self.numEmails == 0:     # No emails
+                self.newEmails = None
+                self.nextEmail = 0
+                return 0
+            self.nextEmail = -1     # processNextMessage() pre-increments message index. Initializing to -1 ensures the pre-increment start at 0
+            return self.numEmails
         else:  # Invalid protocol
             return 0
 
+    # Build IMAP SEARCH criteria so the server only returns messages that might be Duplicati reports (Set by 'serversearch=' option)
+    # SUBJECT uses the literal text at the start of [main]subjectregex. SINCE uses the date of the newest email in the database.
+    # Both are looser than the checks done in processNextMessage(), which still get the final say.
+    # Returns a string of search criteria, or '' if nothing useful can be derived
+    def serverSearchCriteria(self):
+        criteria = []
+
+        subjectText = self.subjectSearchText()
+        if subjectText is not None:
+            criteria.append('SUBJECT "{}"'.format(subjectText.replace('\\', '\\\\').replace('"', '\\"')))
+
+        # Purging the database relies on seeing every message on the server, so don't filter by date
+        if self.fullScan is not True:
+            # Use the newest email collected from this folder. Other servers & folders may receive their reports later than this one.
+            latest = self.writerCall(globs.db.getImapLastEmailTimestamp, self.options['server'], self.options['account'], self.options['folder'])
+            if latest is not None:
+                # Timestamps come from the message Date: header, but SINCE compares against the day the server received it, in the server's time zone.
+                # Back up a day to cover the difference.
+                sinceDate = datetime.date.fromtimestamp(latest) - datetime.timedelta(days=1)
+                criteria.append('SINCE {}-{}-{}'.format(sinceDate.day, imapMonths[sinceDate.month - 1], sinceDate.year))
+
+        globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='serverSearchCriteria', msg='Server search criteria: [{}]'.format(' '.join(criteria)))
+        return ' '.join(criteria)
+
+    # Get the literal text at the start of [main]subjectregex for use in an IMAP SUBJECT search
+    # Stops at the first regex special character. Returns None if there's no usable text
+    def subjectSearchText(self):
+        regex = globs.opts['subjectregex']
+        if '|' in regex:     # Alternatives. No single text string will match them all
+            return None
+
+        text = ''
+        pos = 1 if regex.startswith('^') else 0
+        while pos < len(regex):
+            char = regex[pos]
+            if char == '\\':
+                if pos + 1 < len(regex) and not regex[pos + 1].isalnum():   # Escaped literal character (e.g., '\.')
+                    text += regex[pos + 1]
+                    pos += 2
+                    continue
+                break       # Character class (e.g., '\w')
+            if char in '*?{':   # Previous character is optional
+                text = text[:-1]
+                break
+            if char in '.^$+[]()':
+                break
+            text += char
+            pos += 1
+
+        text = text.strip()
+        if text == '' or not text.isascii():    # Non-ASCII would need a CHARSET on the SEARCH command
+            return None
+        return text
+
+    # Run a database operation (or anything else that has to happen on the main thread)
+    # When servers are collected concurrently the request is queued for the database writer in EmailManager.runWriter().
+    # wait=True waits for and returns the result. wait=False queues the request and returns immediately.
+    def writerCall(self, func, *args, wait=True, **kwargs):
+        if self.writerQueue is None:
+            return func(*args, **kwargs)
+
+        future = concurrent.futures.Future()
+        self.writerQueue.put((func, args, kwargs, future))
+        return future.result() if wait else None
+
+    # Split the new messages in an IMAP folder across several connections (Set by 'connections=' option)
+    # Opens additional sessions to the same folder and gives each one a contiguous, disjoint range of UIDs. This server keeps the first range.
+    # Returns a list of the additional EmailServer objects, or [] if the folder isn't being split
+    def openShards(self):
+        self.allEmails = self.newEmails
+        if self.options['protocol'] != 'imap' or self.options['connections'] <= 1 or self.numEmails < 2:
+            return []
+
+        shards = []
+        for shardNum in range(1, min(self.options['connections'], self.numEmails)):
+            shard = EmailServer('{}#{}'.format(self.name, shardNum), self.options)
+            shard.connect()
+            if not shard.available or shard.uidValidity != self.uidValidity:
+                globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='openShards', msg='Unable to open connection #{} to server {}. Continuing with {} connections.'.format(shardNum, self.options['server'], len(shards) + 1))
+                break
+            shards.append(shard)
+        if len(shards) == 0:
+            return []
+
+        servers = [self] + shards
+        chunkSize = -(-self.numEmails // len(servers))     # Round up
+        for index, server in enumerate(servers):
+            server.newEmails = self.allEmails[index * chunkSize:(index + 1) * chunkSize]
+            server.numEmails = len(server.newEmails)
+            server.nextEmail = -1
+            server.batchCache = {}
+            server.parsedUids = set() if server is not self else server.parsedUids
+            server.markedUids = set() if server is not self else server.markedUids
+            server.newestEmailTimestamp = None if server is not self else server.newestEmailTimestamp
+            server.shardOwner = self if server is not self else None
+            server.lastUid = self.lastUid
+            server.writerQueue = self.writerQueue
+            globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='openShards', msg='Connection {} assigned {} messages.'.format(server.name, server.numEmails))
+        self.shards = shards
+        return shards
+
+    # Start the pool of parsing worker processes used by the retrieval pipeline (parseworkers != 1)
+    # The pool is shared by this server and its shards. Each connection keeps enough batches waiting to keep its share of the workers busy.
+    def openParsePool(self, shards):
+        if self.options['protocol'] not in ['imap', 'pop3'] or self.options['parseworkers'] == 1:
+            return None
+
+        numWorkers = self.options['parseworkers'] if self.options['parseworkers'] > 0 else os.cpu_count() or 1
+        globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='openParsePool', msg='Parsing messages from server {} using {} worker processes.'.format(self.options['server'], numWorkers))
+        initArgs = (globs.progPath, globs.opts, globs.optionManager.parser, self.name, self.options)
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=numWorkers, initializer=initParseWorker, initargs=initArgs)
+        for server in [self] + shards:
+            server.parsePool = pool
+            server.parseAhead = max(2, numWorkers * 2 // (len(shards) + 1))
+        return None
+
+    # Shut down the pool of parsing worker processes started by openParsePool()
+    def closeParsePool(self, shards):
+        if self.parsePool is None:
+            return None
+        self.parsePool.shutdown()
+        for server in [self] + shards:
+            server.parsePool = None
+            server.pipelineResults = None
+        return None
+
+    # Close the extra connections opened by openShards() and restore the full message list
+    def closeShards(self, shards):
+        for shard in shards:
+            self.parsedUids.update(shard.parsedUids)
+            self.markedUids.update(shard.markedUids)
+            self.noteEmailTimestamp(shard.newestEmailTimestamp)
+            shard.close()
+        self.shards = []
+        if self.allEmails is not None:
+            self.newEmails = self.allEmails
+            self.numEmails = len(self.newEmails)
+            self.allEmails = None
+        return None
+
+    # Number of messages to process on this connection between checkpoints. Only IMAP folders have checkpoints.
+    def checkpointEvery(self):
+        if self.options['protocol'] != 'imap':
+            return self.numEmails + 1
+        return self.options['batchsize'] if self.options['batchsize'] > 0 else checkpointInterval
+
+    # Save a checkpoint after the first numDone messages on this connection have been processed, so a collection that
+    # dies part way through can be resumed. Once the checkpoint is committed, the messages are marked as read (markread=true).
+    def checkpoint(self, numDone):
+        if self.options['protocol'] != 'imap' or self.uidValidity is None:
+            return None
+        owner = self.shardOwner if self.shardOwner is not None else self
+        self.writerCall(owner.saveCheckpoint, self.name, numDone)   # Waits until the messages before the checkpoint are committed
+        if self.options['markread'] is True:
+            self.markMessagesRead(self.newEmails[:numDone])
+        return None
+
+    # Save the IMAP checkpoint for this folder. Runs on the database writer, after the messages before the checkpoint.
+    # With several connections (see openShards()) each one works through its own range of UIDs, so the checkpoint is the
+    # end of the unbroken run of finished messages, starting from the first connection.
+    def saveCheckpoint(self, connName, numDone):
+        self.checkpointDone[connName] = numDone
+        lastUid = None
+        for server in [self] + self.shards:
+            done = self.checkpointDone.get(server.name, 0)
+            if done > 0:
+                lastUid = server.newEmails[done - 1]
+            if done < server.numEmails:
+                break
+        if lastUid is None:
+            return None
+
+        self.checkpointBatch += 1
+        globs.db.setImapCheckpoint(self.options['server'], self.options['account'], self.options['folder'], self.uidValidity, int(lastUid), self.checkpointBatch)
+        return None
+
+    # Forget the checkpoint for this folder once a collection has finished
+    def clearCheckpoint(self):
+        if self.options['protocol'] != 'imap' or self.checkpointBatch == 0:
+            return None
+        self.writerCall(globs.db.clearImapCheckpoint, self.options['server'], self.options['account'], self.options['folder'], wait=False)
+        self.checkpointBatch = 0
+        return None
+
+    # Get the UIDL (unique ID) of each message on the POP3 server
+    # Returns a dictionary of {message index: UIDL}, or None if the server doesn't support UIDL
+    def getPop3Uidls(self):
+        try:
+            server_msg, listings, octets = self.serverconnect.uidl()
+        except poplib.error_proto as e:
+            globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='getPop3Uidls', msg='Server {} doesn\'t support UIDL ({}). Looking at all messages.'.format(self.options['server'], e))
+            return None
+
+        uidls = {}
+        for listing in listings:
+            msgNum, uidl = listing.decode('utf-8').split(' ', 1)
+            uidls[int(msgNum) - 1] = uidl
+        return uidls
+
+    # Record where this run left off so the next run only looks at new messages
+    # IMAP: the highest UID seen in the folder. POP3: the UIDLs of all the messages on the server.
+    def saveSyncState(self):
+        if self.options['protocol'] == 'pop3':
+            if self.pop3Uidls is not None:
+                self.writerCall(globs.db.setPop3Uidls, self.options['server'], self.options['account'], list(self.pop3Uidls.values()), wait=False)
+            return None
+
+        if self.options['protocol'] != 'imap' or self.uidValidity is None or self.newEmails is None:
+            return None
+
+        lastUid = self.lastUid if self.lastUid is not None else 0
+        if len(self.newEmails) > 0:
+            lastUid = max(lastUid, max(int(msgUid) for msgUid in self.newEmails))
+        self.writerCall(globs.db.setImapSyncState, self.options['server'], self.options['account'], self.options['folder'], self.uidValidity, lastUid, self.newestEmailTimestamp, wait=False)
+        return None
+
+    # Keep track of the newest email saved from an IMAP folder, for the next run's server-side search (serversearch=true)
+    def noteEmailTimestamp(self, emailTimestamp):
+        if emailTimestamp is not None and (self.newestEmailTimestamp is None or float(emailTimestamp) > self.newestEmailTimestamp):
+            self.newestEmailTimestamp = float(emailTimestamp)
+        return None
+
     # Extract a (parentheses) field or raw data from the result
     # Some fields (sizes, date, time) can be presented in text or numeric values (Starting with Canary builds in Jan 2018)
     # Examples: EndTime: 1/24/2018 10:01:45 PM (1516852905)
@@ -442,7 +1183,7 @@ class EmailServer:
             hdrFields['content-transfer-encoding'] = ''
 
         globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='extractHeaders', msg='Header fields extracted: [{}]'.format(hdrFields))
-        return hdrFields['date'], hdrFields['subject'], hdrFields['message-id'], hdrFields['content-transfer-encoding']
+        return hdrFields.get('date'), hdrFields.get('subject'), hdrFields.get('message-id'), hdrFields['content-transfer-encoding']
 
     # Retrieve and process next message from server
     # Returns <Message-ID> or '<INVALID>' if there are more messages in queue, even if this message was unusable
@@ -451,44 +1192,245 @@ class EmailServer:
         globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='processNextMessage', msg='Processing next message on server {}. Protocol={}'.format(self.options['server'], self.options['protocol']))
         self.connect()
 
+        # Messages are retrieved ahead of the ones being returned when they're parsed by worker processes
+        if self.parsePool is not None:
+            return self.processNextPipelinedMessage()
+
         # Increment message counter to the next message.
         # Skip for message #0 because we haven't read any messages yet
         self.nextEmail += 1
 
+        # Check no-more-mail conditions. Either no new emails to get or gone past the last email on list
+        if (self.newEmails == None) or (self.nextEmail == self.numEmails):
+            return None
+
+        if self.options['protocol'] in localProtocols:
+            return self.processNextLocalMessage()
+        if self.options['protocol'] == 'http':
+            return self.processNextHttpMessage()
+
+        retVal, emailParts = self.fetchMessage()
+        if emailParts is None:
+            return retVal
+        self.parseBody(emailParts)
+        return self.saveMessage(emailParts)
+
+    # Retrieve the current message (self.nextEmail) from an IMAP or POP3 server
+    # Checks the headers and skips messages that are already in the database before the body is retrieved
+    # Returns (processNextMessage() return value, emailParts), with emailParts = None if the message shouldn't be parsed & saved
+    def fetchMessage(self):
         emailParts = {
             'header': {},
             'body': {}
             }
 
-        # Check no-more-mail conditions. Either no new emails to get or gone past the last email on list
-        if (self.newEmails == None) or (self.nextEmail == self.numEmails):
-            return None
-
         if self.options['protocol'] == 'pop3':
             # Get message header
+            timerStart = globs.timer.start()
             server_msg, body, octets = self.serverconnect.top((self.newEmails[self.nextEmail])+1,0)
+            globs.timer.stop('fetchheader', timerStart)
             globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='processNextMessage', msg='server_msg=[{}]  body=[{}]  octets=[{}]'.format(server_msg,body,octets))
             if server_msg[:3].decode() != '+OK':
                 globs.log.write(globs.SEV_ERROR,  function='EmailServer', action='processNextMessage', msg='ERROR getting message {}'.format(self.nextEmail))
-                return '<INVALID>'
+                return '<INVALID>', None
             # Get date, subject, and message ID from headers
             hdrLine = self.mergePop3Headers(body)       # Convert to IMAP format
-            emailParts['header']['date'], emailParts['header']['subject'], emailParts['header']['messageId'] = self.extractHeaders(hdrLine)
+            emailParts['header']['date'], emailParts['header']['subject'], emailParts['header']['messageId'], emailParts['header']['content-transfer-encoding'] = self.extractHeaders(hdrLine)
         elif self.options['protocol'] == 'imap':
             # Get message header
-            retVal, data = self.serverconnect.fetch(self.newEmails[self.nextEmail],'(BODY.PEEK[HEADER.FIELDS (DATE SUBJECT MESSAGE-ID CONTENT-TRANSFER-ENCODING)])')
-            if retVal != 'OK':
+            hdrData = self.fetchImapPart('header')
+            if hdrData is None:
                 globs.log.write(globs.SEV_ERROR, function='EmailServer', action='processNextMessage', msg='ERROR getting message {}'.format(self.nextEmail))
-                return '<INVALID>'
-            globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='processNextMessage', msg='Server.fetch(): retVal=[{}] data=[{}]'.format(retVal,data))
-            emailParts['header']['date'], emailParts['header']['subject'], emailParts['header']['messageId'], emailParts['header']['content-transfer-encoding'] = self.extractHeaders(data[0][1].decode('utf-8'))
+                return '<INVALID>', None
+            emailParts['header']['date'], emailParts['header']['subject'], emailParts['header']['messageId'], emailParts['header']['content-transfer-encoding'] = self.extractHeaders(hdrData.decode('utf-8'))
         else:   # Invalid protocol spec
             globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='processNextMessage', msg='Invalid protocol specification: {}.'.format(self.options['protocol']))
-            return None
+            return None, None
 
         # Log message basics
         globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='processNextMessage', msg='Next Message: headers=[{}]'.format(emailParts['header']))
 
+        retVal = self.checkHeaders(emailParts)
+        if retVal is not None:
+            return retVal, None
+
+        # See if the record is already in the database, meaning we've seen it before
+        if self.checkKnownMessage(emailParts['header']['messageId']):
+            return emailParts['header']['messageId'], None
+
+        self.parseEmailDate(emailParts)
+
+        # Search for source/destination pair in database. Add if not already there
+        self.writerCall(globs.db.searchSrcDestPair, emailParts['header']['sourceComp'], emailParts['header']['destComp'], wait=False)
+
+        # Extract the body (payload) from the email
+        if self.options['protocol'] == 'pop3':
+            # Retrieve the whole messsage. This is redundant with previous .top() call and results in extra data downloads
+            # In cases where there is a mix of Duplicati and non-Duplicati emails to read, this actually saves time in the large scale.
+            # In cases where all the emails on the server are Duplicati emails, this does, in fact, slow things down a bit
+            # POP3 is a stupid protocol. Use IMAP if at all possible.
+            timerStart = globs.timer.start()
+            server_msg, body, octets = self.serverconnect.retr((self.newEmails[self.nextEmail])+1)
+            globs.timer.stop('fetchbody', timerStart)
+            timerStart = globs.timer.start()
+            msgTmp=''
+            for j in body:
+                msgTmp += '{}\n'.format(j.decode("utf-8"))
+            emailParts['body']['fullbody'] = email.message_from_string(msgTmp)._payload  # Get message body
+            globs.timer.stop('decode', timerStart)
+        elif self.options['protocol'] == 'imap':
+            # Retrieve just the body text of the message.
+            bodyData = self.fetchImapPart('body')
+            if bodyData is None:
+                globs.log.write(globs.SEV_ERROR, function='EmailServer', action='processNextMessage', msg='ERROR getting body for message {}'.format(emailParts['header']['messageId']))
+                return emailParts['header']['messageId'], None
+            if self.options['bodylimit'] > 0 and len(bodyData) >= self.options['bodylimit']:     # Body may have been cut off at 'bodylimit' bytes
+                bodyData = self.checkPartialBody(bodyData, emailParts['header']['content-transfer-encoding'])
+                if bodyData is None:
+                    globs.log.write(globs.SEV_ERROR, function='EmailServer', action='processNextMessage', msg='ERROR getting full body for message {}'.format(emailParts['header']['messageId']))
+                    return emailParts['header']['messageId'], None
+            emailParts['body']['fullbody'] = bodyData.decode('utf-8')  # Get message body
+
+        return emailParts['header']['messageId'], emailParts
+
+    # Get the next message from the retrieval pipeline (parseworkers != 1)
+    # The messages are retrieved & parsed ahead of time by parseFetchedMessages(). The database work is passed on to the writer here.
+    def processNextPipelinedMessage(self):
+        if self.pipelineResults is None:
+            self.pipelineResults = self.parseFetchedMessages()
+        result = next(self.pipelineResults, None)
+        if result is None:      # No more messages
+            self.pipelineResults = None
+            return None
+
+        retVal, emailParts, msgUid, logLines, stageTimes = result
+        globs.log.writeLines(logLines)
+        globs.timer.merge(stageTimes)
+        if emailParts is None:      # Not a message of interest, already in the database, or unusable
+            return retVal
+        return self.saveMessage(emailParts, msgUid)
+
+    # Retrieval pipeline. Retrieve the messages on this connection and hand them to the parsing workers, 'parseBatchSize' messages at a time.
+    # Retrieval goes on while earlier batches are being parsed and the parsed messages are being written by the database writer.
+    # Only 'parseAhead' batches are kept waiting for the workers, so retrieval can't get too far ahead of the parsing.
+    # Yields (processNextMessage() return value, emailParts or None, message UID, log lines, stage times) for each message, in order
+    def parseFetchedMessages(self):
+        pending = collections.deque()
+        batch = []
+        while True:
+            self.nextEmail += 1
+            if (self.newEmails == None) or (self.nextEmail >= self.numEmails):
+                break
+            retVal, emailParts = self.fetchMessage()
+            batch.append((retVal, emailParts, self.newEmails[self.nextEmail]))
+            if len(batch) >= parseBatchSize:
+                pending.append(self.parsePool.submit(parseWorkerBodies, batch))
+                batch = []
+            if len(pending) >= self.parseAhead:     # Wait for the workers to catch up
+                for result in pending.popleft().result():
+                    yield result
+
+        if len(batch) > 0:
+            pending.append(self.parsePool.submit(parseWorkerBodies, batch))
+        while len(pending) > 0:
+            for result in pending.popleft().result():
+                yield result
+        return
+
+    # Get the next message from a local message store (protocol = maildir or mbox)
+    # The messages are parsed ahead of time by parseLocalMessages(). Anything that uses the database is done here.
+    def processNextLocalMessage(self):
+        if self.localResults is None:
+            self.localResults = self.parseLocalMessages()
+        retVal, emailParts, logLines, stageTimes = next(self.localResults)
+        globs.log.writeLines(logLines)
+        globs.timer.merge(stageTimes)
+        if emailParts is None:      # Not a message of interest, or unusable
+            return retVal
+
+        # See if the record is already in the database, meaning we've seen it before
+        if self.checkKnownMessage(emailParts['header']['messageId']):
+            return emailParts['header']['messageId']
+
+        # Search for source/destination pair in database. Add if not already there
+        self.writerCall(globs.db.searchSrcDestPair, emailParts['header']['sourceComp'], emailParts['header']['destComp'], wait=False)
+        return self.saveMessage(emailParts)
+
+    # Save the next report received by the HTTP receiver (protocol = http)
+    # Reports are parsed by the receiver when they arrive. Anything that uses the database is done here.
+    def processNextHttpMessage(self):
+        emailParts = self.newEmails[self.nextEmail]
+
+        # Duplicati may send the same report again
+        if self.checkKnownMessage(emailParts['header']['messageId']):
+            return emailParts['header']['messageId']
+
+        # Search for source/destination pair in database. Add if not already there
+        self.writerCall(globs.db.searchSrcDestPair, emailParts['header']['sourceComp'], emailParts['header']['destComp'], wait=False)
+        return self.saveMessage(emailParts)
+
+    # Parse all the messages in a local message store, using a pool of worker processes unless parseworkers = 1
+    # Messages are handed to the workers a few at a time, and only a few batches are read ahead, so large stores aren't read into memory all at once
+    # Yields (processNextMessage() return value, emailParts or None, log lines, stage times) for each message in self.newEmails, in order
+    def parseLocalMessages(self):
+        numWorkers = self.options['parseworkers'] if self.options['parseworkers'] > 0 else os.cpu_count() or 1
+        if numWorkers == 1:
+            for msgKey in self.newEmails:
+                timerStart = globs.timer.start()
+                msgBytes = self.serverconnect.get_bytes(msgKey)
+                globs.timer.stop('fetchbody', timerStart)
+                retVal, emailParts = self.parseLocalMessage(msgBytes)
+                yield retVal, emailParts, '', None
+            return
+
+        globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='parseLocalMessages', msg='Parsing {} messages from {} using {} worker processes.'.format(self.numEmails, self.options['path'], numWorkers))
+        initArgs = (globs.progPath, globs.opts, globs.optionManager.parser, self.name, self.options)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=numWorkers, initializer=initParseWorker, initargs=initArgs) as pool:
+            pending = collections.deque()
+            for start in range(0, self.numEmails, parseBatchSize):
+                timerStart = globs.timer.start()
+                msgList = [self.serverconnect.get_bytes(msgKey) for msgKey in self.newEmails[start:start + parseBatchSize]]
+                globs.timer.stop('fetchbody', timerStart)
+                pending.append(pool.submit(parseWorkerMessages, msgList))
+                if len(pending) >= numWorkers * 2:     # Enough work queued to keep the workers busy
+                    for result in pending.popleft().result():
+                        yield result
+            while len(pending) > 0:
+                for result in pending.popleft().result():
+                    yield result
+        return
+
+    # Parse a complete message read from a local message store
+    # Runs in a parsing worker process (when parseworkers isn't 1), so it can't use the database. processNextLocalMessage() does the rest.
+    # Returns (processNextMessage() return value, emailParts), with emailParts = None if the message shouldn't be saved
+    def parseLocalMessage(self, msgBytes):
+        emailParts = {
+            'header': {},
+            'body': {}
+            }
+
+        # Split the headers from the body. Files in a local store may use either \n or \r\n line endings, but extractHeaders() wants \r\n.
+        split = re.search(rb'\r?\n\r?\n', msgBytes)
+        if split is None:
+            globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='parseLocalMessage', msg='No message body. Abandoning message.')
+            return '<INVALID>', None
+        try:
+            hdrLine = re.sub(r'\r?\n', '\r\n', msgBytes[:split.start()].decode('utf-8')) + '\r\n'
+            emailParts['header']['date'], emailParts['header']['subject'], emailParts['header']['messageId'], emailParts['header']['content-transfer-encoding'] = self.extractHeaders(hdrLine)
+            retVal = self.checkHeaders(emailParts)
+            if retVal is not None:
+                return retVal, None
+            self.parseEmailDate(emailParts)
+            emailParts['body']['fullbody'] = msgBytes[split.end():].decode('utf-8')
+            self.parseBody(emailParts)
+        except (UnicodeDecodeError, ValueError) as e:
+            globs.log.write(globs.SEV_ERROR, function='EmailServer', action='parseLocalMessage', msg='Unable to parse message {}: {}'.format(emailParts['header'].get('messageId'), e))
+            return emailParts['header'].get('messageId', '<INVALID>'), None
+        return emailParts['header']['messageId'], emailParts
+
+    # Check the vital header fields, see if the message is a message of interest, and get the source & destination from the subject
+    # Returns None if the message should be processed, or the value processNextMessage() should return if it shouldn't
+    def checkHeaders(self, emailParts):
         # Check if any of the vital parts are missing
         if emailParts['header']['messageId'] is None or emailParts['header']['messageId'] == '':
             globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='processNextMessage', msg='No message-Id. Abandoning message.')
@@ -520,16 +1462,22 @@ class EmailServer:
         emailParts['header']['sourceComp'] = m.group(1)
         emailParts['header']['destComp'] = m.group(2)
         globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='processNextMessage', msg="Extract: source='[{}]' destination='[{}]'".format(emailParts['header']['sourceComp'],emailParts['header']['destComp']))
+        return None
 
-        # See if the record is already in the database, meaning we've seen it before
-        if globs.db.searchForMessage(emailParts['header']['messageId']):    # Is message is already in database?
+    # See if a message is already in the database. If it is, mark it as seen.
+    # Returns True if the message is already in the database, False if not
+    def checkKnownMessage(self, messageId):
+        if self.writerCall(globs.db.isKnownMessage, messageId):    # Is message is already in database?
             # Mark the email as being seen in the database
-            globs.db.execSqlStmt('UPDATE emails SET dbSeen = 1 WHERE messageId = \"{}\"'.format(emailParts['header']['messageId']))
-            globs.db.dbCommit()
-            return emailParts['header']['messageId']
+            self.writerCall(globs.db.markMessageSeen, messageId, wait=False)
+            self.markParsed()
+            return True
         # Message not yet in database. Proceed.
-        globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='processNextMessage', msg='Message ID [{}] does not yet exist in DB.'.format(emailParts['header']['messageId']))
+        globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='processNextMessage', msg='Message ID [{}] does not yet exist in DB.'.format(messageId))
+        return False
 
+    # Get the email timestamp & timezone from the message Date: header
+    def parseEmailDate(self, emailParts):
         # Extract date information from header
         dTup = email.utils.parsedate_tz(emailParts['header']['date'])
         if dTup:
@@ -550,42 +1498,20 @@ class EmailServer:
 
 
         globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='processNextMessage', msg='emailParts[\'header\']={}'.format(emailParts['header']))
+        return None
 
-        # Search for source/destination pair in database. Add if not already there
-        retVal = globs.db.searchSrcDestPair(emailParts['header']['sourceComp'], emailParts['header']['destComp'])
-
-        # Extract the body (payload) from the email
-        if self.options['protocol'] == 'pop3':
-            # Retrieve the whole messsage. This is redundant with previous .top() call and results in extra data downloads
-            # In cases where there is a mix of Duplicati and non-Duplicati emails to read, this actually saves time in the large scale.
-            # In cases where all the emails on the server are Duplicati emails, this does, in fact, slow things down a bit
-            # POP3 is a stupid protocol. Use IMAP if at all possible.
-            server_msg, body, octets = self.serverconnect.retr((self.newEmails[self.nextEmail])+1)
-            msgTmp=''
-            for j in body:
-                msgTmp += '{}\n'.format(j.decode("utf-8"))
-            emailParts['body']['fullbody'] = email.message_from_string(msgTmp)._payload  # Get message body
-        elif self.options['protocol'] == 'imap':
-            # Retrieve just the body text of the message.
-            retVal, data = self.serverconnect.fetch(self.newEmails[self.nextEmail],'(BODY.PEEK[TEXT])')
-
-            # Fix issue #71
-            # From https://stackoverflow.com/questions/2230037/how-to-fetch-an-email-body-using-imaplib-in-python
-            # "...usually the data format is [(bytes, bytes), bytes] but when the message is marked as unseen manually,
-            # the format is [bytes, (bytes, bytes), bytes] – Niklas R Sep 8 '15 at 23:29
-            # Need to check if len(data)==2 (normally unread) or ==3 (manually set unread)
-            globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='processNextMessage', msg='IMAP message fetch(): retval={} dataLen={}'.format(retVal, len(data)))
-            if len(data) == 2:
-                emailParts['body']['fullbody'] = data[0][1].decode('utf-8')  # Get message body
-            else:
-                emailParts['body']['fullbody'] = data[1][1].decode('utf-8')  # Get message body
-
+    # Decode the message body in emailParts['body']['fullbody'] and extract the Duplicati report fields from it
+    # Doesn't use the database or change any global state, so it can also run in a parsing worker process (see parseLocalMessage())
+    def parseBody(self, emailParts):
         globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='processNextMessage', msg='Message Body=[{}]'.format(emailParts['body']['fullbody']))
 
         # See if content-transfer-encoding is in use
         if emailParts['header']['content-transfer-encoding'].lower() == 'quoted-printable':
+            timerStart = globs.timer.start()
             emailParts['body']['fullbody'] = quopri.decodestring(emailParts['body']['fullbody'].replace('=0D=0A','\n')).decode("utf-8")
+            globs.timer.stop('decode', timerStart)
             globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='processNextMessage', msg='New (quopri) Message Body=[{}]'.format(emailParts['body']['fullbody']))
+        timerStart = globs.timer.start()
 
         # See if email is text or JSON. JSON messages begin with '{"Data":'
         isJson = True if emailParts['body']['fullbody'][:8] == '{\"Data\":' else False
@@ -618,7 +1544,6 @@ class EmailServer:
                 # The JSON report has somewhat different fields than the "classic" report, so we have to fudge this a little bit
                 #   so we can use common code to process both types later.
                 emailParts['body']['failed'] = 'Failure'
-                globs.report.resultList['Failure'] = True
                 if emailParts['body']['parsedResult'] == '':
                     emailParts['body']['parsedResult'] = 'Failure'
                 emailParts['body']['errors'] = jsonData['Message'] if 'Message' in jsonData else ''
@@ -627,14 +1552,11 @@ class EmailServer:
             emailParts['body']['fullbody'] = emailParts['body']['fullbody'].replace('<br/>','\n')
 
             globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='processNextMessage', msg='Message is Duplicati formatted')
-            # Go through each element in lineParts{}, get the value from the body, and assign it to the corresponding element in emailParts['body']{}
-            for section,regex,flag,typ, jsonSection in lineParts:
-                emailParts['body'][section] = self.searchMessagePart(emailParts['body']['fullbody'], regex, flag, typ) # Get the field parts
-                # bytesUploaded & bytesDownloaded are only included in JSON message formats. Set to 0 if it's a non-JSON message
-                if section == 'bytesUploaded':
-                    emailParts['body']['bytesUploaded'] = 0
-                if section == 'bytesDownloaded':
-                    emailParts['body']['bytesDownloaded'] = 0
+            # Get the value of each element in lineParts{} from the body in a single scan, and assign it to the corresponding element in emailParts['body']{}
+            emailParts['body'].update(self.searchMessageParts(emailParts['body']['fullbody']))
+            # bytesUploaded & bytesDownloaded are only included in JSON message formats. Set to 0 if it's a non-JSON message
+            emailParts['body']['bytesUploaded'] = 0
+            emailParts['body']['bytesDownloaded'] = 0
 
         # Adjust fields if not a clean run
         globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='processNextMessage', msg="emailParts['body']['failed']=[{}]".format(emailParts['body']['failed']))
@@ -676,7 +1598,6 @@ class EmailServer:
             if not isJson:
                 emailParts['body']['errors'] = emailParts['body']['failed']
                 emailParts['body']['parsedResult'] = 'Failure'
-                globs.report.resultList['Failure'] = True
                 emailParts['body']['warnings'] = emailParts['body']['details']
 
             globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='processNextMessage', msg='Errors=[{}]'.format(emailParts['body']['errors']))
@@ -692,6 +1613,15 @@ class EmailServer:
         for part in ['messages', 'warnings', 'errors', 'logdata']:
             if emailParts['body'][part] != '':
                 emailParts['body'][part] = emailParts['body'][part].replace(',','\n')
+        globs.timer.stop('parse', timerStart)
+        return None
+
+    # Save a fully parsed message to the database, sending a warning email first if needed
+    # Returns the message ID
+    # msgUid = UID of the message, if it isn't the current message (self.nextEmail)
+    def saveMessage(self, emailParts, msgUid = None):
+        if emailParts['body']['failed'] != '':
+            self.writerCall(globs.report.noteResult, 'Failure', wait=False)
 
         # If we're just collecting and get a warning/error, we may need to send an email to the admin
         if (globs.opts['collect'] is True) and (globs.opts['warnoncollect'] is True) and ((emailParts['body']['warnings'] != '') or (emailParts['body']['errors'] != '')):
@@ -705,13 +1635,173 @@ class EmailServer:
             if emailParts['body']['logdata'] != '':
                 errMsg += 'Log Data:' + emailParts['body']['logdata'] + '\n\n'
 
-            globs.emailManager.sendEmail(msgText=errMsg, subject='Duplicati Job Status Error')
+            self.writerCall(globs.emailManager.sendEmail, msgText=errMsg, subject='Duplicati Job Status Error', wait=False)
 
         globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='processNextMessage', msg='Resulting timestamps: endTimeStamp=[{}] beginTimeStamp=[{}]'.format(drdatetime.fromTimestamp(emailParts['body']['endTimestamp']), drdatetime.fromTimestamp(emailParts['body']['beginTimestamp'])))
 
-        globs.db.execEmailInsertSql(emailParts)
+        # With concurrent collection, another connection may have added the same message since it was checked. The database skips it.
+        self.writerCall(globs.db.execEmailInsertSql, emailParts, wait=False)
+        self.markParsed(msgUid)
+        if self.options['protocol'] == 'imap':
+            self.noteEmailTimestamp(emailParts['header']['emailTimestamp'])
         return emailParts['header']['messageId']
 
+    # Split the data returned from an IMAP UID FETCH into individual messages
+    # Returns a dictionary of {uid: payload}, where uid is a byte string (same as the output of UID SEARCH)
+    #
+    # Fix issue #71
+    # From https://stackoverflow.com/questions/2230037/how-to-fetch-an-email-body-using-imaplib-in-python
+    # "...usually the data format is [(bytes, bytes), bytes] but when the message is marked as unseen manually,
+    # the format is [bytes, (bytes, bytes), bytes] – Niklas R Sep 8 '15 at 23:29
+    # Some servers also return the UID after the literal (e.g., [(b'1 (BODY[TEXT] {123}', b'...'), b' UID 456)'])
+    # So, look for the UID in the literal's prefix first, then in the continuation line that follows it.
+    def parseFetchData(self, data):
+        payloads = {}
+        pendingPayload = None
+        for item in data:
+            if isinstance(item, tuple):
+                pendingPayload = item[1]
+                uid = re.search(rb'UID (\d+)', item[0])
+                if uid:
+                    payloads[uid.group(1)] = pendingPayload
+                    pendingPayload = None
+            elif isinstance(item, bytes) and pendingPayload is not None:
+                uid = re.match(rb'\s*UID (\d+)', item)    # Continuation of the previous response, not a new untagged response
+                if uid:
+                    payloads[uid.group(1)] = pendingPayload
+                pendingPayload = None
+        return payloads
+
+    # Get the header or body of the current IMAP message
+    # part = 'header', 'body' (limited to 'bodylimit' bytes, if set), or 'fullbody' (always the whole body, never from the batch cache)
+    # Returns the raw (byte string) data, or None if the server didn't return it
+    def fetchImapPart(self, part):
+        msgUid = self.newEmails[self.nextEmail]
+        fetchSpec = {'header': imapHeaderFetch, 'body': self.bodyFetchSpec(), 'fullbody': imapBodyFetch}[part]
+
+        if self.options['batchsize'] > 0 and part != 'fullbody':
+            if msgUid not in self.batchCache:
+                self.fetchImapBatch()
+            cached = self.batchCache[msgUid][part]
+            if part == 'body':      # Body is the last thing retrieved for a message. Free up the cache entry.
+                del self.batchCache[msgUid]
+            if cached is not None or part == 'header':  # Missing header means the message disappeared from the folder since the search
+                return cached
+            # Body wasn't prefetched (message didn't look interesting from its headers). Get it by itself.
+
+        timerStart = globs.timer.start()
+        retVal, data = self.serverconnect.uid('FETCH', msgUid, fetchSpec)
+        globs.timer.stop('fetchheader' if part == 'header' else 'fetchbody', timerStart)
+        globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='fetchImapPart', msg='Server.fetch({}): retVal=[{}] dataLen=[{}]'.format(part, retVal, len(data)))
+        if retVal != 'OK':
+            return None
+        payload = self.parseFetchData(data).get(msgUid)
+        if payload is not None:
+            self.fetchBytes += len(payload)
+        return payload
+
+    # Batched IMAP retrieval
+    # Fetch the headers for the next 'batchsize' messages in a single FETCH command, filter them locally
+    # (subjectregex & message-ids already in the database), then fetch the bodies of all the survivors in a single FETCH.
+    # Results are held in self.batchCache until processNextMessage() asks for them.
+    def fetchImapBatch(self):
+        batchUids = self.newEmails[self.nextEmail:self.nextEmail + self.options['batchsize']]
+        globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='fetchImapBatch', msg='Fetching headers for {} messages starting at message {}.'.format(len(batchUids), self.nextEmail))
+
+        self.batchCache = {}
+        timerStart = globs.timer.start()
+        headers = self.fetchUids(batchUids, imapHeaderFetch)
+        globs.timer.stop('fetchheader', timerStart)
+        self.fetchBytes += sum(len(hdr) for hdr in headers.values())
+
+        candidates = {}     # uid: message-id of messages that look interesting from their headers
+        for msgUid in batchUids:
+            self.batchCache[msgUid] = {'header': headers.get(msgUid), 'body': None}
+            if self.batchCache[msgUid]['header'] is None:
+                continue
+            date, subject, messageId, cte = self.extractHeaders(self.batchCache[msgUid]['header'].decode('utf-8'))
+            if subject is None or re.search(globs.opts['subjectregex'], subject) is None:   # Not a message of interest
+                continue
+            if messageId is None or messageId == '':    # Unusable
+                continue
+            candidates[msgUid] = messageId
+
+        # Check the whole batch against the message-ids already in the database at once
+        knownIds = self.writerCall(globs.db.filterKnownMessages, list(candidates.values())) if len(candidates) > 0 else set()
+        bodyUids = [msgUid for msgUid in candidates if candidates[msgUid] not in knownIds]
+
+        globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='fetchImapBatch', msg='Fetching bodies for {} of {} messages.'.format(len(bodyUids), len(batchUids)))
+        if len(bodyUids) > 0:
+            timerStart = globs.timer.start()
+            bodies = self.fetchUids(bodyUids, self.bodyFetchSpec())
+            globs.timer.stop('fetchbody', timerStart)
+            self.fetchBytes += sum(len(body) for body in bodies.values())
+            for msgUid in bodyUids:
+                self.batchCache[msgUid]['body'] = bodies.get(msgUid)
+        return None
+
+    # FETCH item used to retrieve message bodies. Only the first 'bodylimit' bytes are retrieved if the option is set.
+    def bodyFetchSpec(self):
+        if self.options['bodylimit'] > 0:
+            return imapPartialBodyFetch.format(self.options['bodylimit'])
+        return imapBodyFetch
+
+    # Check a message body that may have been cut off at 'bodylimit' bytes
+    # If it has all the fields needed, return it cut back to the last complete line. If not, retrieve the whole body.
+    # Returns the raw (byte string) body, or None if the server didn't return it
+    def checkPartialBody(self, bodyData, cte):
+        bodyData = bodyData[:bodyData.rfind(b'\n') + 1]      # Don't leave a partial line (or partial multi-byte character or quoted-printable code) at the end
+        text = bodyData.decode('utf-8')
+        if cte.lower() == 'quoted-printable':
+            text = quopri.decodestring(text.replace('=0D=0A','\n')).decode("utf-8")
+        text = text.replace('<br/>','\n')
+
+        # JSON reports can't be parsed unless they're complete
+        if text[:8] != '{\"Data\":' and (linePartsRegex[linePartsIndex['failed']].search(text) or all(linePartsRegex[linePartsIndex[section]].search(text) for section in partialRequired)):
+            # A Messages/Warnings/Errors list cut off before its closing ']' line would be dropped. Close it so the part that was retrieved is kept.
+            for index in range(len(lineParts)):
+                if linePartsKey[index] + '[' in text and linePartsRegex[index].search(text) is None:
+                    bodyData += b']\n'
+                    break
+            globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='checkPartialBody', msg='Using first {} bytes of message body.'.format(len(bodyData)))
+            return bodyData
+
+        globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='checkPartialBody', msg='Required fields not found in first {} bytes of message body. Retrieving whole body.'.format(self.options['bodylimit']))
+        return self.fetchImapPart('fullbody')
+
+    # UID FETCH a list of messages, using the async engine if it's enabled (engine=async) or the regular server connection if not
+    # Returns a dictionary of {uid: payload}
+    def fetchUids(self, uidList, fetchSpec):
+        if self.options['engine'] == 'async' and self.asyncEngine is None and not self.asyncFailed:
+            self.openAsyncEngine()
+
+        if self.asyncEngine is not None:
+            allOk, data = self.asyncEngine.fetch(uidList, fetchSpec)
+            if allOk:
+                return self.parseFetchData(data)
+            globs.log.write(globs.SEV_ERROR, function='EmailServer', action='fetchUids', msg='Async engine error on server {}. Switching back to standard retrieval.'.format(self.options['server']))
+            self.asyncEngine.close()
+            self.asyncEngine = None
+            self.asyncFailed = True
+
+        retVal, data = self.serverconnect.uid('FETCH', b','.join(uidList), fetchSpec)
+        return self.parseFetchData(data) if retVal == 'OK' else {}
+
+    # Start the async retrieval engine for this server
+    def openAsyncEngine(self):
+        engine = drasync.AsyncImapEngine(self.name, self.options)
+        if not engine.open():
+            globs.log.write(globs.SEV_ERROR, function='EmailServer', action='openAsyncEngine', msg='Unable to start async engine for server {}. Using standard retrieval.'.format(self.options['server']))
+            self.asyncFailed = True
+            return None
+        if engine.uidValidity != self.uidValidity:     # UIDs wouldn't mean the same thing on both sets of connections
+            globs.log.write(globs.SEV_ERROR, function='EmailServer', action='openAsyncEngine', msg='Async engine UIDVALIDITY {} doesn\'t match {}. Using standard retrieval.'.format(engine.uidValidity, self.uidValidity))
+            engine.close()
+            self.asyncFailed = True
+            return None
+        self.asyncEngine = engine
+        return None
+
     # Issue #174 support. Remove quotes from a string
     def _unwrap_quotes(self, src):
         QUOTE_SYMBOLS = ('"', "'")
@@ -723,17 +1813,62 @@ class EmailServer:
     # Issue #111 feature request
     # Provide ability to mark messages as read/seen if [main]markread is true in the .rc file.
     # This function is only works for IMAP. POP3 doesn't have this capability.
-    def markMessagesRead(self):
-        globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='markMessagesRead', msg='Marking {} {} messages as \'read/seen\''.format(self.numEmails, self.options['protocol']))
-        for msg in range(self.numEmails):
-            self.serverconnect.store(self.newEmails[msg],'+FLAGS',r'\Seen')
+    # Messages are flagged in bulk using compressed UID sequence sets, 'storebatch' messages at a time.
+    # msgUids = UIDs of the messages to mark (default all the new messages). Messages already marked this run are skipped.
+    def markMessagesRead(self, msgUids = None):
+        markUids = set(self.newEmails if msgUids is None else msgUids) - self.markedUids
+        if self.options['markparsedonly'] is True:
+            markUids &= self.parsedUids
+        self.markedUids.update(markUids)
+        if len(markUids) == 0:
+            return
+        globs.log.write(globs.SEV_NOTICE, function='EmailServer', action='markMessagesRead', msg='Marking {} of {} {} messages as \'read/seen\''.format(len(markUids), self.numEmails, self.options['protocol']))
+        for seqSet in self.uidSequenceSets(markUids):
+            retVal, data = self.serverconnect.uid('STORE', seqSet, '+FLAGS.SILENT', r'(\Seen)')
+            globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='markMessagesRead', msg='STORE {}: retVal=[{}] data=[{}]'.format(seqSet, retVal, data))
+            if retVal != 'OK':
+                globs.log.write(globs.SEV_ERROR, function='EmailServer', action='markMessagesRead', msg='Error marking messages {} as \'read/seen\': {}'.format(seqSet, data))
         return
 
+    # Remember that an IMAP message was parsed successfully (for markparsedonly=true)
+    # msgUid = UID of the message. Defaults to the current message (self.nextEmail)
+    def markParsed(self, msgUid = None):
+        if self.options['protocol'] == 'imap':
+            self.parsedUids.add(self.newEmails[self.nextEmail] if msgUid is None else msgUid)
+        return None
+
+    # Build compressed UID sequence sets (e.g., '101:600,602,610:900') for the messages in markUids
+    # Only numerically consecutive UIDs are combined into a range. Messages left out of the folder search (e.g., by serversearch=true)
+    # can sit between two report messages, and a range covering them would mark the user's other mail as seen.
+    # Each set covers at most 'storebatch' messages. Returns a list of sequence set strings.
+    def uidSequenceSets(self, markUids):
+        batches = []        # Each batch is a list of [firstUid, lastUid] runs
+        runs = []
+        count = 0
+        for msgUid in sorted(markUids, key=int):
+            if count == self.options['storebatch'] and count > 0:     # Batch full. Start a new one. (storebatch=0 means no limit)
+                batches.append(runs)
+                runs = []
+                count = 0
+            if len(runs) > 0 and int(runs[-1][1]) + 1 == int(msgUid):
+                runs[-1][1] = msgUid
+            else:
+                runs.append([msgUid, msgUid])
+            count += 1
+        if len(runs) > 0:
+            batches.append(runs)
+
+        seqSets = []
+        for runs in batches:
+            seqSets.append(','.join(first.decode() if first == last else '{}:{}'.format(first.decode(), last.decode()) for first, last in runs))
+        return seqSets
+
     # Search for field in message
     # msgField - text to search against
     # regex - regex to search for
     # multiLine - 0=single line, 1=multi-line
     # type - 0=int or 1=string
+    # processNextMessage() uses searchMessageParts() to get all the fields at once
     def searchMessagePart(self, msgField, regex, multiLine, typ):
         globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='searchMessagePart', msg='Searching for standard field: regex=[{}], multiline=[{}], typ=[{}]'.format(regex, multiLine, typ))
 
@@ -760,6 +1895,66 @@ class EmailServer:
         globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='searchMessagePart', msg='Search result: \'{}\''.format(retData))
         return retData
 
+    # Search for all the lineParts fields in message with a single scan of the text
+    # Gives the same results as calling searchMessagePart() for each lineParts entry
+    # Returns a dictionary of {section: value}
+    def searchMessageParts(self, msgField):
+        matches = {}
+        for keyMatch in linePartsKeyRegex.finditer(msgField):
+            for offset, key in linePartsKeyHits[keyMatch.group()]:
+                for index in linePartsByKey[key]:
+                    if index not in matches:
+                        # A regex search returns the first place its pattern matches, so the first place the field name is followed by a match is the result
+                        match = linePartsRegex[index].match(msgField, keyMatch.start() + offset)
+                        if match:
+                            matches[index] = match
+            if len(matches) == len(lineParts):     # Found everything. No need to look at the rest of the message.
+                break
+
+        # Multi-line fields can cover most of a large message, and they overlap (Messages:, Warnings: and Errors: all run to the last ']' line).
+        # Cut the text they cover into pieces at the start and end of each field, clean up each piece once, and build the field values from the pieces.
+        # Cleaning up two pieces separately gives the same result as cleaning them up together, as long as the cut doesn't split a run of white space.
+        spans = {index: matches[index].span() for index in matches if lineParts[index][2] != 0}
+        cuts = sorted(set(pos for span in spans.values() for pos in span if pos in (0, len(msgField)) or not (msgField[pos - 1].isspace() and msgField[pos].isspace())))
+        pieces = [self.collapseText(msgField[cuts[num]:cuts[num + 1]]) for num in range(len(cuts) - 1)]
+        cutIndex = {pos: num for num, pos in enumerate(cuts)}
+
+        retData = {}
+        for index, (section, regex, flag, typ, jsonSection) in enumerate(lineParts):
+            if index in spans and spans[index][0] in cutIndex and spans[index][1] in cutIndex:
+                retData[section] = ''.join(pieces[cutIndex[spans[index][0]]:cutIndex[spans[index][1]]])
+            else:
+                retData[section] = self.messagePartValue(matches.get(index), flag, typ)
+        globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='searchMessageParts', msg='Found {} of {} standard fields: {}'.format(len(matches), len(lineParts), [lineParts[index][0] for index in sorted(matches)]))
+        return retData
+
+    # Get the value of a field from its regex match
+    # match - regex match object, or None if the field wasn't found
+    # multiLine - 0=single line, 1=multi-line
+    # type - 0=int or 1=string
+    def messagePartValue(self, match, multiLine, typ):
+        if match is None:  # Pattern not found
+            if typ == 0:  # Integer field
+                return '0'
+            return ''         # String field
+        if multiLine == 0:   # Single line result. Drop the field name and join the remaining 'words' with single spaces.
+            return ' '.join(match.group().split()[1:])
+        return self.collapseText(match.group())
+
+    # Convert multiple white space to a single space and double quotes to single quotes
+    # Same result as re.sub(r'\s+', ' ', text), but str.split() is several times faster on long log sections
+    def collapseText(self, text):
+        words = text.split()
+        retData = ' '.join(words)
+        if len(words) == 0:
+            retData = ' ' if text != '' else ''
+        else:
+            if text[0].isspace():
+                retData = ' ' + retData
+            if text[-1].isspace():
+                retData = retData + ' '
+        return retData.replace('"', '\'')
+
     # Search for field in JSON message
     def searchMessagePartJson(self, jsonParts, key, typ):
         globs.log.write(globs.SEV_DEBUG, function='EmailServer', action='searchMessagePart', msg='Searching for JSON field \'{}\', typ=[{}]'.format(key,typ))
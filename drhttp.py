@@ -0,0 +1,199 @@
+#####
+#
+# Module name:  drhttp.py
+# Purpose:      HTTP receiver for Duplicati reports sent with Duplicati's --send-http-url option
+#
+# Notes:        Used when an incoming server section has 'protocol = http'.
+#               Listens for the POST requests Duplicati sends at the end of each job. Each report is parsed when it arrives,
+#               using the same code as reports received by email, and queued. The queued reports are saved to the database
+#               together the next time the server is collected. In daemon mode (-D) that happens as soon as a report arrives.
+#
+#               Duplicati can send the report in JSON (--send-http-result-output-format=Json) or text format, either as the
+#               whole request body or as a form field (--send-http-message-parameter-name, default 'message').
+#               The backup name ('<source><srcdestdelimiter><destination>') is taken from the 'backup-name' URL/form parameter
+#               if there is one, or from the 'Extra' section of a JSON report.
+#
+#####
+
+# Import system modules
+import email.utils
+import hashlib
+import hmac
+import http.server
+import ipaddress
+import json
+import queue
+import re
+import socket
+import threading
+import urllib.parse
+
+# Import dupReport modules
+import globs
+
+# Maximum number of parsed reports waiting to be saved. Requests wait for room when the queue is full.
+reportQueueSize = 1000
+
+# Number of seconds a request waits for room in the queue before it's turned away
+reportQueueTimeout = 30
+
+# Largest request body accepted, in bytes
+maxReportSize = 64 * 1024 * 1024
+
+# Handles the requests sent to the receiver
+class HttpRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        status, text = self.server.receiver.receiveReport(self)
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return None
+
+    # Send the standard request log lines to the dupReport log instead of stderr
+    def log_message(self, format, *args):
+        globs.log.write(globs.SEV_DEBUG, function='HttpReceiver', action='request', msg='{}: {}'.format(self.address_string(), format % args))
+        return None
+
+class HttpReceiver:
+    def __init__(self, emailServer):
+        self.emailServer = emailServer      # EmailServer that owns the receiver. Its parsing code is used for the reports.
+        self.options = emailServer.options
+        self.httpServer = None
+        self.thread = None
+        self.reports = queue.Queue(maxsize=reportQueueSize)     # Parsed reports (emailParts) waiting to be saved
+        self.wakeRead, self.wakeWrite = socket.socketpair()     # A byte is written to wakeWrite whenever a report is queued
+        self.wakeRead.setblocking(False)
+
+    # Start listening for reports
+    # Returns True if the receiver is listening, False if not
+    def open(self):
+        try:
+            self.httpServer = http.server.ThreadingHTTPServer((self.options['listen'], self.options['port']), HttpRequestHandler)
+        except OSError as e:
+            globs.log.write(globs.SEV_ERROR, function='HttpReceiver', action='open', msg='Unable to listen on {}: {}'.format(self.options['server'], e))
+            return False
+        self.httpServer.receiver = self
+        self.thread = threading.Thread(target=self.httpServer.serve_forever, name='HttpReceiver', daemon=True)
+        self.thread.start()
+        globs.log.write(globs.SEV_NOTICE, function='HttpReceiver', action='open', msg='Listening for Duplicati reports on {}'.format(self.options['server']))
+
+        # Without a token, anything that can reach a non-loopback address can add reports to the database
+        if self.options['token'] == '' and not ipaddress.ip_address(self.httpServer.server_address[0]).is_loopback:
+            globs.log.write(globs.SEV_WARNING, function='HttpReceiver', action='open', msg='Listening on {} without a token. Any computer that can reach this address can add reports. Set token= in the server section.'.format(self.options['server']))
+        return True
+
+    # Stop listening
+    def close(self):
+        if self.httpServer is not None:
+            self.httpServer.shutdown()
+            self.httpServer.server_close()
+            self.httpServer = None
+        self.wakeRead.close()
+        self.wakeWrite.close()
+        return None
+
+    # Socket that becomes readable when a report is queued. Lets EmailManager.waitForNewMessages() wait on the receiver like an idling IMAP server.
+    def socket(self):
+        return self.wakeRead
+
+    # Clear the wake-up signal
+    # Returns True if any reports are waiting to be saved
+    def clearWake(self):
+        try:
+            while self.wakeRead.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        return not self.reports.empty()
+
+    # Get all the reports waiting to be saved
+    # Returns a list of emailParts
+    def takeReports(self):
+        reports = []
+        while True:
+            try:
+                reports.append(self.reports.get_nowait())
+            except queue.Empty:
+                break
+        return reports
+
+    # Receive, parse and queue one report. Runs on the HTTP request thread.
+    # request = the HttpRequestHandler for the request
+    # Returns (HTTP status, response text)
+    def receiveReport(self, request):
+        url = urllib.parse.urlparse(request.path)
+        params = urllib.parse.parse_qs(url.query)
+        # A token sent when none is configured means the sender and this server section don't match, so it's turned away too
+        sentToken = params.get('token', [''])[0]
+        if self.options['token'] == '' and sentToken != '':
+            globs.log.write(globs.SEV_NOTICE, function='HttpReceiver', action='receiveReport', msg='Request from {} has a token, but no token is configured. Ignored.'.format(request.address_string()))
+            return 403, 'Forbidden'
+        if self.options['token'] != '' and not hmac.compare_digest(sentToken.encode('utf-8'), self.options['token'].encode('utf-8')):
+            globs.log.write(globs.SEV_NOTICE, function='HttpReceiver', action='receiveReport', msg='Request from {} has a missing or incorrect token. Ignored.'.format(request.address_string()))
+            return 403, 'Forbidden'
+
+        try:
+            length = int(request.headers.get('Content-Length', '0'))
+        except ValueError:
+            length = -1
+        if length <= 0 or length > maxReportSize:
+            return 400 if length <= maxReportSize else 413, 'Bad report size'
+        data = request.rfile.read(length)
+
+        # Report can be the whole body or a form field
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            return 400, 'Report is not UTF-8 text'
+        if request.headers.get_content_type() == 'application/x-www-form-urlencoded':
+            form = urllib.parse.parse_qs(text)
+            params.update(form)
+            text = form.get('message', [''])[0]
+        if text == '':
+            return 400, 'No report found'
+
+        emailParts = {
+            'header': {},
+            'body': {}
+            }
+        # The message-id is made from a hash of the report, so a report sent twice is only saved once
+        emailParts['header']['messageId'] = '<{}{}'.format(hashlib.sha1(text.encode('utf-8')).hexdigest(), globs.httpMessageIdSuffix)
+        emailParts['header']['date'] = email.utils.formatdate(localtime=True)
+        emailParts['header']['content-transfer-encoding'] = ''
+
+        # Get the source & destination from the backup name
+        backupName = params.get('backup-name', [''])[0]
+        if backupName == '' and text[:8] == '{\"Data\":':
+            try:
+                backupName = json.loads(text, strict = False).get('Extra', {}).get('backup-name', '')
+            except (ValueError, AttributeError) as e:
+                globs.log.write(globs.SEV_NOTICE, function='HttpReceiver', action='receiveReport', msg='Invalid JSON report from {}: {}. Report ignored.'.format(request.address_string(), e))
+                return 400, 'Invalid JSON report'
+        regex = '({}){}({})'.format(globs.opts['srcregex'], self.emailServer._unwrap_quotes(globs.opts['srcdestdelimiter']), globs.opts['destregex'])
+        m = re.search(regex, backupName)
+        if m is None:
+            globs.log.write(globs.SEV_NOTICE, function='HttpReceiver', action='receiveReport', msg='Can\'t find source & destination in backup name \'{}\' from {}. Report ignored.'.format(backupName, request.address_string()))
+            return 400, 'Backup name missing or doesn\'t match srcregex/destregex'
+        emailParts['header']['subject'] = backupName
+        emailParts['header']['sourceComp'] = m.group(1)
+        emailParts['header']['destComp'] = m.group(2)
+
+        try:
+            self.emailServer.parseEmailDate(emailParts)
+            emailParts['body']['fullbody'] = text
+            self.emailServer.parseBody(emailParts)
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            globs.log.write(globs.SEV_ERROR, function='HttpReceiver', action='receiveReport', msg='Unable to parse report {} from {}: {}'.format(emailParts['header']['messageId'], request.address_string(), e))
+            return 400, 'Unable to parse report'
+
+        try:
+            self.reports.put(emailParts, timeout=reportQueueTimeout)
+        except queue.Full:
+            globs.log.write(globs.SEV_ERROR, function='HttpReceiver', action='receiveReport', msg='Report queue full. Report {} from {} turned away.'.format(emailParts['header']['messageId'], request.address_string()))
+            return 503, 'Busy'
+        self.wakeWrite.send(b'.')
+        globs.log.write(globs.SEV_NOTICE, function='HttpReceiver', action='receiveReport', msg='Received report {} for {} from {}'.format(emailParts['header']['messageId'], backupName, request.address_string()))
+        return 200, 'OK'
@@ -0,0 +1,146 @@
+#####
+#
+# Module name:  drtiming.py
+# Purpose:      Optional timers for the stages of message processing
+#
+# Notes:        Enabled with [main]stagetimers=true. The time spent in each stage (retrieving headers & bodies, decoding,
+#               parsing, database lookups, inserts and commits) is collected in a histogram while email is being collected.
+#               At the end of each collection the histograms are written to the log and, if [main]stagetimerfile= is set,
+#               appended to that file as one line of JSON.
+#
+#               Times from parsing worker processes are passed back with the parsed messages and merged in (see merge()).
+#               Reports received over HTTP are parsed when they arrive, between collections, so only their database stages are timed.
+#
+#####
+
+# Import system modules
+import json
+import threading
+import time
+
+# Import dupReport modules
+import globs
+
+# Stages that are timed, in the order they're reported
+stageNames = ['fetchheader', 'fetchbody', 'decode', 'parse', 'lookup', 'insert', 'commit']
+
+# Upper limit of each histogram bucket, in microseconds. Longer times go in a final open-ended bucket.
+bucketLimits = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000, 1000000, 2000000, 5000000]
+
+class StageTimer:
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.lock = threading.Lock()    # Stages are timed on the collection, writer and HTTP request threads
+        self.stages = {}                # stage: {'count', 'totalNs', 'minNs', 'maxNs', 'buckets'}
+
+    # Start timing a stage
+    # Returns the start time to pass to stop(), or None if timing is turned off
+    def start(self):
+        return time.perf_counter_ns() if self.enabled else None
+
+    # Finish timing a stage started with start()
+    def stop(self, stage, startTime):
+        if startTime is not None:
+            self.add(stage, time.perf_counter_ns() - startTime)
+        return None
+
+    # Add one time (in nanoseconds) to a stage
+    def add(self, stage, elapsedNs):
+        bucket = 0
+        while bucket < len(bucketLimits) and elapsedNs > bucketLimits[bucket] * 1000:
+            bucket += 1
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = {'count': 0, 'totalNs': 0, 'minNs': elapsedNs, 'maxNs': elapsedNs, 'buckets': [0] * (len(bucketLimits) + 1)}
+            stats['count'] += 1
+            stats['totalNs'] += elapsedNs
+            stats['minNs'] = min(stats['minNs'], elapsedNs)
+            stats['maxNs'] = max(stats['maxNs'], elapsedNs)
+            stats['buckets'][bucket] += 1
+        return None
+
+    # Get the times collected so far and start again
+    # Used by parsing worker processes to send their times back with the messages they've parsed
+    def take(self):
+        if not self.enabled:
+            return None
+        with self.lock:
+            stages = self.stages
+            self.stages = {}
+        return stages
+
+    # Add times returned by take() in another process
+    def merge(self, stages):
+        if stages is None:
+            return None
+        with self.lock:
+            for stage, other in stages.items():
+                stats = self.stages.get(stage)
+                if stats is None:
+                    self.stages[stage] = other
+                    continue
+                stats['count'] += other['count']
+                stats['totalNs'] += other['totalNs']
+                stats['minNs'] = min(stats['minNs'], other['minNs'])
+                stats['maxNs'] = max(stats['maxNs'], other['maxNs'])
+                stats['buckets'] = [mine + theirs for mine, theirs in zip(stats['buckets'], other['buckets'])]
+        return None
+
+    # Estimate a percentile of a stage's times from its histogram. Returns the upper limit of the bucket it falls in, in ms.
+    def percentile(self, stats, fraction):
+        target = stats['count'] * fraction
+        seen = 0
+        for bucket, count in enumerate(stats['buckets']):
+            seen += count
+            if seen >= target and count > 0:
+                return min(bucketLimits[bucket] / 1000, stats['maxNs'] / 1000000) if bucket < len(bucketLimits) else stats['maxNs'] / 1000000
+        return stats['maxNs'] / 1000000
+
+    # Summarize the times collected so far
+    # Returns a dictionary of {stage: {count, totalMs, meanMs, minMs, p50Ms, p95Ms, p99Ms, maxMs, histogram}}. Histogram keys are bucket limits in microseconds.
+    def summary(self):
+        summary = {}
+        with self.lock:
+            for stage in sorted(self.stages, key=lambda stage: stageNames.index(stage) if stage in stageNames else len(stageNames)):
+                stats = self.stages[stage]
+                summary[stage] = {
+                    'count': stats['count'],
+                    'totalMs': stats['totalNs'] / 1000000,
+                    'meanMs': stats['totalNs'] / stats['count'] / 1000000,
+                    'minMs': stats['minNs'] / 1000000,
+                    'p50Ms': self.percentile(stats, 0.50),
+                    'p95Ms': self.percentile(stats, 0.95),
+                    'p99Ms': self.percentile(stats, 0.99),
+                    'maxMs': stats['maxNs'] / 1000000,
+                    'histogram': {('<={}'.format(bucketLimits[bucket]) if bucket < len(bucketLimits) else '>{}'.format(bucketLimits[-1])): count for bucket, count in enumerate(stats['buckets']) if count > 0}
+                    }
+        return summary
+
+    # Write the times collected during a collection to the log and the stage timer file, then start again
+    # elapsed = length of the collection, in seconds
+    def writeSummary(self, elapsed):
+        if not self.enabled:
+            return None
+        summary = self.summary()
+        globs.log.write(globs.SEV_NOTICE, function='StageTimer', action='writeSummary', msg='Stage times for collection lasting {:.3f} seconds:'.format(elapsed))
+        for stage, stats in summary.items():
+            globs.log.write(globs.SEV_NOTICE, function='StageTimer', action='writeSummary', msg='{}: count={} total={:.1f}ms mean={:.3f}ms min={:.3f}ms p50<={:.3f}ms p95<={:.3f}ms p99<={:.3f}ms max={:.3f}ms'.format(stage,
+                stats['count'], stats['totalMs'], stats['meanMs'], stats['minMs'], stats['p50Ms'], stats['p95Ms'], stats['p99Ms'], stats['maxMs']))
+            globs.log.write(globs.SEV_NOTICE, function='StageTimer', action='writeSummary', msg='{} histogram (microseconds): {}'.format(stage, ' '.join('{}:{}'.format(bucket, count) for bucket, count in stats['histogram'].items())))
+
+        if globs.opts['stagetimerfile'] != '':
+            try:
+                with open(globs.opts['stagetimerfile'], 'a') as timerFile:
+                    timerFile.write(json.dumps({'timestamp': time.time(), 'elapsedSec': elapsed, 'stages': summary}) + '\n')
+            except OSError as e:
+                globs.log.write(globs.SEV_ERROR, function='StageTimer', action='writeSummary', msg='Unable to write stage timer file {}: {}'.format(globs.opts['stagetimerfile'], e))
+
+        self.reset()
+        return None
+
+    # Throw away the times collected so far
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+        return None
@@ -24,6 +24,7 @@ import report
 import options
 import dremail
 import drdatetime
+import drtiming
 import dupapprise
 from datetime import datetime
 
@@ -45,6 +46,94 @@ def versionInfo():
     globs.log.out('\nFollow dupReport on Twitter @dupreport\n-----\n')
     return None
 
+# Collect new messages from the incoming email servers
+# fullScan = True to look at every message on the servers, not just new ones (see EmailManager.checkForNewMessages())
+def collectMessages(fullScan=None):
+    # Prep email list for potential purging (-p option or [main]purgedb=true)
+    if fullScan is not False:
+        globs.db.execSqlStmt('UPDATE emails SET dbSeen = 0')
+        globs.db.dbCommit()
+
+    if globs.opts['showprogress'] > 0:
+        globs.log.out('Analyzing email messages.')
+    globs.emailManager.checkForNewMessages(fullScan)
+    return None
+
+# Produce & distribute the report, send warnings, and purge the database as requested
+def runReports(startTime):
+    # Are we just reporting or not just collecting?
+    if (globs.opts['report'] or not globs.opts['collect']):
+        # All email has been collected. Create the report
+        if globs.opts['showprogress'] > 0:
+            globs.log.out('Producing report.')
+
+        globs.report.extractReportData()
+
+        # Run selected report
+        reportOutput = globs.report.createReport(globs.report.rStruct, startTime)
+
+    # Do we need to send any "backup not seen" warning messages?
+    if not globs.opts['stopbackupwarn'] or not globs.opts['nomail']:
+        report.sendNoBackupWarnings()
+
+    if globs.appriseObj is not None:
+        globs.appriseObj.sendNotifications()
+
+    # Do we need to send output to file(s)?
+    if globs.ofileList and not globs.opts['collect']:
+        if globs.opts['showprogress'] > 0:
+            globs.log.out('Creating report file(s).')
+        report.sendReportToFiles(reportOutput)
+   
+    # Are we forbidden from sending report to email?
+    if not globs.opts['nomail'] and not globs.opts['collect']: 
+        if globs.opts['showprogress'] > 0:
+            globs.log.out('Sending report emails.')
+
+        # Send email to SMTP server
+        globs.emailManager.sendEmail(msgHtml=globs.report.createFormattedOutput(reportOutput, 'html'), msgText=globs.report.createFormattedOutput(reportOutput, 'txt'), fileattach=True)
+
+    # Do we need to purge the database?
+    if globs.opts['purgedb'] == True:
+        globs.db.purgeOldEmails()
+
+    return None
+
+# Daemon mode (-D option)
+# Keep the incoming server connections open, collect new messages as soon as the servers say they've arrived (IMAP IDLE),
+# and run the reports every [main]reportinterval minutes. Runs until the program is stopped.
+def runDaemon():
+    if globs.opts['report']:
+        globs.log.err('Daemon mode (-D) can not be used with -t. Nothing would be collected.')
+        globs.closeEverythingAndExit(1)
+
+    reportInterval = globs.opts['reportinterval'] * 60
+    idleTimeout = globs.opts['idletimeout'] * 60
+    globs.log.write(globs.SEV_NOTICE, function='main', action='runDaemon', msg='Starting daemon mode. Reports every {} minutes, IDLE timeout {} minutes.'.format(globs.opts['reportinterval'], globs.opts['idletimeout']))
+
+    collectMessages()
+    nextReport = time.time() + reportInterval
+    try:
+        while True:
+            waitTime = max(min(idleTimeout, nextReport - time.time()), 0)
+            newMail = globs.emailManager.waitForNewMessages(waitTime)
+
+            if time.time() >= nextReport:
+                # A database purge needs to look at every message, so only do full scans right before a report
+                collectMessages(None if globs.opts['purgedb'] else False)
+                runReports(time.time())
+                globs.report.resultList = {}
+                while nextReport <= time.time():
+                    nextReport += reportInterval
+                globs.log.write(globs.SEV_NOTICE, function='main', action='runDaemon', msg='Next report at {}.'.format(datetime.fromtimestamp(nextReport)))
+            elif newMail:
+                collectMessages(False)
+    except KeyboardInterrupt:
+        globs.log.write(globs.SEV_NOTICE, function='main', action='runDaemon', msg='Daemon mode interrupted. Exiting.')
+
+    globs.closeEverythingAndExit(0)
+    return None
+
 if __name__ == "__main__":
     # Get program home directory
     globs.progPath = os.path.dirname(os.path.realpath(sys.argv[0]))
@@ -80,6 +169,7 @@ if __name__ == "__main__":
 
     # Open log file (finally!)
     globs.log.openLog(globs.opts['logpath'], globs.opts['logappend'], globs.opts['verbose'])
+    globs.timer = drtiming.StageTimer(globs.opts['stagetimers'])
 
     # Open report object and validate report options
     # We may not be running reports, but the options will be needed later in the program 
@@ -127,51 +217,15 @@ if __name__ == "__main__":
         globs.log.out('Connecting to email servers.')
     globs.emailManager = dremail.EmailManager()
 
+    # Running as a daemon? Doesn't return until the program is stopped.
+    if globs.opts['daemon']:
+        runDaemon()
+
     # Are we just collecting or not just reporting?
     if (globs.opts['collect'] or not globs.opts['report']):
-        # Prep email list for potential purging (-p option or [main]purgedb=true)
-        globs.db.execSqlStmt('UPDATE emails SET dbSeen = 0')
-        globs.db.dbCommit()
-
-        if globs.opts['showprogress'] > 0:
-            globs.log.out('Analyzing email messages.')
-        globs.emailManager.checkForNewMessages()
+        collectMessages()
 
-    # Are we just reporting or not just collecting?
-    if (globs.opts['report'] or not globs.opts['collect']):
-        # All email has been collected. Create the report
-        if globs.opts['showprogress'] > 0:
-            globs.log.out('Producing report.')
-
-        globs.report.extractReportData()
-
-        # Run selected report
-        reportOutput = globs.report.createReport(globs.report.rStruct, startTime)
-
-    # Do we need to send any "backup not seen" warning messages?
-    if not globs.opts['stopbackupwarn'] or not globs.opts['nomail']:
-        report.sendNoBackupWarnings()
-
-    if globs.appriseObj is not None:
-        globs.appriseObj.sendNotifications()
-
-    # Do we need to send output to file(s)?
-    if globs.ofileList and not globs.opts['collect']:
-        if globs.opts['showprogress'] > 0:
-            globs.log.out('Creating report file(s).')
-        report.sendReportToFiles(reportOutput)
-   
-    # Are we forbidden from sending report to email?
-    if not globs.opts['nomail'] and not globs.opts['collect']: 
-        if globs.opts['showprogress'] > 0:
-            globs.log.out('Sending report emails.')
-
-        # Send email to SMTP server
-        globs.emailManager.sendEmail(msgHtml=globs.report.createFormattedOutput(reportOutput, 'html'), msgText=globs.report.createFormattedOutput(reportOutput, 'txt'), fileattach=True)
-
-    # Do we need to purge the database?
-    if globs.opts['purgedb'] == True:
-        globs.db.purgeOldEmails()
+    runReports(startTime)
 
     globs.log.write(globs.SEV_NOTICE, function='main', action='Complete', msg='Program completed in {:.3f} seconds. Exiting.'.format(time.time() - startTime))
 
@@ -8,9 +8,9 @@
 import os
 
 # Define version info
-version=[3,0,10]     # Program Version
+version=[3,1,0]     # Program Version
 status='Release'
-dbVersion=[3,0,1]   # Required DB version
+dbVersion=[3,0,8]   # Required DB version
 rcVersion=[3,1,0]   # Required RC version
 copyright='Copyright (c) 2017-2022 Stephen Fried for Handy Guy Software.'
 
@@ -29,12 +29,16 @@ opts = None                         # Global program options
 progPath = None                     # Path to script files
 appriseObj = None                   # dupApprise instance
 
+# Message-ids given to reports received over HTTP (drhttp.py) end with this. Those reports aren't purged from the database with unseen emails.
+httpMessageIdSuffix = '@http.dupreport>'
+
 # Text & format fields for report email
 emailText=[]      # List of email text components
 emailFormat=[]    # Corresponding list of emial components print formats
 
 # Global variables referencing objects in other modules
 log = None              # Log file handling
+timer = None            # Stage timers (drtiming.StageTimer)
 inServer = None         # Inbound email server
 outServer =  None       # Outbound email server
 
@@ -14,6 +14,7 @@ import os
 import datetime
 import logging
 import socket
+import threading
 from logging.handlers import SysLogHandler
 
 
@@ -25,6 +26,7 @@ class LogHandler:
         self.tmpFile = None             # Temp file to hold log output before log file is opened.
         self.tmpLogPath = globs.progPath + '/' + globs.logName    # Path for temp log
         self.hostname = socket.gethostname()
+        self.writeLock = threading.RLock()  # Servers may be collected on several threads. Keep their log lines from interleaving.
         self.syslog = {
             'logger': None,
             'host': None,
@@ -147,6 +149,19 @@ class LogHandler:
     # Write log info to log file
     # Log Format = [TIMESTAMP][SEVERITY][FUNCTION][ACTION]<MESSAGE>
     def write(self, level, function='-', action='-', msg='' ):
+        with self.writeLock:
+            self.writeLocked(level, function, action, msg)
+        return None
+
+    # Copy lines that have already been formatted (by a parsing worker process, see dremail.initParseWorker()) into the log file
+    def writeLines(self, lines):
+        if lines != '' and self.logFile is not None:
+            with self.writeLock:
+                self.logFile.write(lines)
+                self.logFile.flush()
+        return None
+
+    def writeLocked(self, level, function, action, msg):
 
         if self.logFile is not None:
             logTarget = self.logFile
@@ -50,6 +50,14 @@ rcParts= [
     ('main',        'emailservers',     'incoming, outgoing',                                                       True),
     ('main',        'syslog',           '',                                                                         True),
     ('main',        'sysloglevel',      '5',                                                                        True),
+    ('main',        'collectworkers',   '4',                                                                        True),
+    ('main',        'reportinterval',   '1440',                                                                     True),
+    ('main',        'idletimeout',      '29',                                                                       True),
+    ('main',        'bloomthreshold',   '1000000',                                                                  True),
+    ('main',        'insertbatch',      '500',                                                                      True),
+    ('main',        'insertinterval',   '5',                                                                        True),
+    ('main',        'stagetimers',      'false',                                                                    True),
+    ('main',        'stagetimerfile',   '',                                                                         True),
 
     # [incoming] section defaults
     ('incoming',    'protocol',       'imap',                                                                       False),
@@ -296,10 +304,10 @@ class OptionManager:
             self.options[name] = value
 
         # Fix some of the datatypes
-        for item in ('verbose', 'showprogress', 'sysloglevel'):  # integers
+        for item in ('verbose', 'showprogress', 'sysloglevel', 'collectworkers', 'reportinterval', 'idletimeout', 'bloomthreshold', 'insertbatch', 'insertinterval'):  # integers
             self.options[item] = int(self.options[item])
 
-        for item in ('logappend', 'warnoncollect', 'applyutcoffset', 'show24hourtime', 'purgedb', 'masksensitive'):  # boolean
+        for item in ('logappend', 'warnoncollect', 'applyutcoffset', 'show24hourtime', 'purgedb', 'masksensitive', 'stagetimers'):  # boolean
             self.options[item] = self.options[item].lower() in ('true')
 
         # Check for valid date format
@@ -345,6 +353,7 @@ class OptionManager:
         self.options['stopbackupwarn'] = self.cmdLineArgs.stopbackupwarn
         self.options['validatereport'] = self.cmdLineArgs.validatereport
         self.options['layout'] = self.cmdLineArgs.layout
+        self.options['daemon'] = self.cmdLineArgs.daemon
 
         # Check rollback specifications
         self.options['rollback'] = self.cmdLineArgs.rollback
@@ -419,6 +428,7 @@ class OptionManager:
         opGroup1.add_argument("-t", "--report", help="Run summary report only. (Don't collect emails)", action="store_true")
 
         argParser.add_argument("-d","--dbpath", help="Path to dupReport database file.", action="store")
+        argParser.add_argument("-D","--daemon", help="Run continuously. Collect new emails as they arrive and run reports every [main]reportinterval minutes.", action="store_true")
         argParser.add_argument("-e","--emailservers", help="List of incoming (IMAP & POP3) and outgoing (SMTP) servers to use.", action="store")
         argParser.add_argument("-f", "--file", help="Send output to file or stdout. Format is -f <filespec>,<type>", action="append")
         argParser.add_argument("-F", "--fileattach", help="Same as -f, but also send file as attchment.", action="append")
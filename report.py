@@ -18,6 +18,7 @@ import re
 import sys
 import os
 import json
+import sqlite3
 
 # Import dupReport modules
 import globs
@@ -178,6 +179,17 @@ def splitRcIntoList(inputString):
     globs.log.write(globs.SEV_DEBUG, function='Report', action='splitRcIntoList', msg='.rc entry \'{}\' split into list: {}'.format(inputString, iniList))
     return iniList
 
+# Create date & time fields from an email's timestamp field, for the report table
+# This makes it much easier to extract & sort later on rather than trying to manipulate the timestamp at runtime
+# Returns (date timestamp, time timestamp)
+def splitTimestamp(endTimeStamp):
+    soloDate, soloTime = drdatetime.fromTimestamp(endTimeStamp, dfmt='YYYY-MM-DD')
+    soloDate += ' 00:00:00'
+    soloTime = '2000-01-01 ' + soloTime
+    reportDateStamp = drdatetime.toTimestamp(soloDate, 'YYYY-MM-DD', 'HH:MM:SS')
+    reportTimeStamp = drdatetime.toTimestamp(soloTime, 'YYYY-MM-DD', 'HH:MM:SS')
+    return reportDateStamp, reportTimeStamp
+
 # See if a source-destination pair is set to 'ignore' in the .rc file
 def ingoreSDPair(source, destination):
     retval = False
@@ -303,9 +315,7 @@ def pastBackupWarningThreshold(src, dest, nDays, nbWarnDefault):
 
 def sendNoBackupWarnings():
     # Get all source/destination pairs
-    sqlStmt = "SELECT source, destination FROM backupsets ORDER BY source, destination"
-    dbCursor = globs.db.execSqlStmt(sqlStmt)
-    srcDestRows = dbCursor.fetchall()
+    srcDestRows = sorted(globs.db.getBackupSets())
     if len(srcDestRows) != 0:
         for source, destination in srcDestRows:
 
@@ -374,22 +384,18 @@ def getLatestTimestamp(src, dest):
     globs.log.write(globs.SEV_NOTICE, function='Report', action='getLatestTimestamp', msg='Getting latest time stamp for {}{}{})'.format(src, globs.opts['srcdestdelimiter'], dest))
 
     # Get last timestamp from backupsets
-    sqlStmt = 'SELECT lastTimestamp FROM backupsets WHERE source = \"{}\" AND destination = \"{}\"'.format(src, dest)
-    dbCursor = globs.db.execSqlStmt(sqlStmt)
-    lastTimestamp = dbCursor.fetchone()
-    if lastTimestamp[0] is not None:
+    bkSet = globs.db.getBackupSet(src, dest)
+    if bkSet is not None and bkSet['lastTimestamp'] is not None:
             # See if there is a later timestamp waiting in the email table
-            sqlStmt = 'SELECT max(endTimeStamp) FROM emails WHERE sourceComp = \'{}\' AND destComp= \'{}\' AND endTimeStamp > {}'.format(src, dest, lastTimestamp[0])
-            dbCursor = globs.db.execSqlStmt(sqlStmt)
-            lastEmailStamp = dbCursor.fetchone()
-            if lastEmailStamp[0]:
+            lastEmailStamp = bkSet['lastEmailTimestamp']
+            if lastEmailStamp and lastEmailStamp > bkSet['lastTimestamp']:
                 # Found one - this is the latest timestamp for that srcDest pair
-                globs.log.write(globs.SEV_DEBUG, function='Report', action='getLatestTimestamp', msg='Found an email. Returning latest timestamp from email: {}'.format(lastEmailStamp[0]))
-                return lastEmailStamp[0]
+                globs.log.write(globs.SEV_DEBUG, function='Report', action='getLatestTimestamp', msg='Found an email. Returning latest timestamp from email: {}'.format(lastEmailStamp))
+                return lastEmailStamp
             else:
                 # Nothing newer in database - return latest time from backupsets
-                globs.log.write(globs.SEV_DEBUG, function='Report', action='getLatestTimestamp', msg='No emails found. Returning latest timestamp from backupsets: {}'.format(lastTimestamp[0]))
-                return lastTimestamp[0]
+                globs.log.write(globs.SEV_DEBUG, function='Report', action='getLatestTimestamp', msg='No emails found. Returning latest timestamp from backupsets: {}'.format(bkSet['lastTimestamp']))
+                return bkSet['lastTimestamp']
     else:
         # This should never happen
         globs.log.write(globs.SEV_NOTICE, function='Report', action='getLatestTimestamp', msg='Didn\'t find any timestamp for {}{}{}: something is wrong!'.format(src, globs.opts['srcdestdelimiter'], dest))
@@ -662,14 +668,69 @@ class Report:
         dbCursor = globs.db.execSqlStmt("DELETE FROM report")
         globs.db.dbCommit()
 
+        # Window functions (LAG()) need SQLite 3.25 or later. Older versions go through the backup sets one email at a time.
+        if sqlite3.sqlite_version_info < (3, 25, 0):
+            return self.extractReportDataByRow()
+
+        # Backup sets to report on, in source/destination order. Source/destination pairs set to ignore in the .rc file are left out (Issue #178)
+        # seq numbers the backup sets in that order, so the report rows can be read out without sorting them
+        reportSets = [(bkSet['pairId'],) for (source, destination), bkSet in sorted(globs.db.getBackupSets().items()) if ingoreSDPair(source, destination) is False]
+        globs.db.execSqlStmt("CREATE TEMP TABLE IF NOT EXISTS reportsets (seq integer primary key, pairId integer)")
+        globs.db.execSqlStmt("DELETE FROM reportsets")
+        globs.db.execSqlMany("INSERT INTO reportsets (pairId) VALUES (?)", reportSets)
+
+        # Copy all activity since the last report into the report table
+        # File count & size differences are from the previous email for the backup set, or from the backupsets table for the first one
+        # The CROSS JOINs keep reportsets as the outer loop. Each backup set's new emails are then a range of the (pairId, endTimestamp) index,
+        # already in report order, so neither the window nor the ORDER BY needs a sort.
+        globs.db.dbConn.create_function('reportDate', 1, lambda endTimeStamp: splitTimestamp(endTimeStamp)[0])
+        globs.db.dbConn.create_function('reportTime', 1, lambda endTimeStamp: splitTimestamp(endTimeStamp)[1])
+        globs.db.execSqlStmt("INSERT INTO report (pairId, source, destination, timestamp, date, time, duration, examinedFiles, examinedFilesDelta, sizeOfExaminedFiles, fileSizeDelta, \
+            addedFiles, deletedFiles, modifiedFiles, filesWithError, parsedResult, messages, warnings, errors, dupversion, logdata, bytesUploaded, bytesDownloaded) \
+            SELECT b.pairId, b.source, b.destination, e.endTimestamp, reportDate(e.endTimestamp), reportTime(e.endTimestamp), e.duration, \
+            e.examinedFiles, e.examinedFiles - LAG(e.examinedFiles, 1, b.lastFileCount) OVER bkset, \
+            e.sizeOfExaminedFiles, e.sizeOfExaminedFiles - LAG(e.sizeOfExaminedFiles, 1, b.lastFileSize) OVER bkset, \
+            e.addedFiles, e.deletedFiles, e.modifiedFiles, e.filesWithError, e.parsedResult, e.messages, e.warnings, e.errors, e.dupversion, e.logdata, e.bytesUploaded, e.bytesDownloaded \
+            FROM reportsets r CROSS JOIN backupsets b ON b.pairId = r.pairId \
+            CROSS JOIN emails e ON e.pairId = r.pairId AND e.endTimestamp > b.lastTimestamp \
+            WINDOW bkset AS (PARTITION BY r.seq ORDER BY e.endTimestamp) \
+            ORDER BY r.seq, e.endTimestamp")
+
+        # Save the latest activity for each backup set in the backupsets table
+        # Issue #138 - If the run was an error, there might not be a version number (depending on the Duplicati version). Keep the last one there was.
+        # The backup sets' emails are found through the (pairId, endTimestamp) index. The subqueries see the old lastTimestamp.
+        globs.db.execSqlStmt("UPDATE backupsets SET \
+            lastFileCount = (SELECT examinedFiles FROM emails WHERE pairId = backupsets.pairId ORDER BY endTimestamp DESC LIMIT 1), \
+            lastFileSize = (SELECT sizeOfExaminedFiles FROM emails WHERE pairId = backupsets.pairId ORDER BY endTimestamp DESC LIMIT 1), \
+            lastTimestamp = (SELECT MAX(endTimestamp) FROM emails WHERE pairId = backupsets.pairId), \
+            dupversion = COALESCE((SELECT dupversion FROM emails WHERE pairId = backupsets.pairId AND endTimestamp > backupsets.lastTimestamp \
+                AND dupversion != '' ORDER BY endTimestamp DESC LIMIT 1), dupversion) \
+            WHERE pairId IN (SELECT pairId FROM reportsets) \
+            AND EXISTS (SELECT 1 FROM emails WHERE pairId = backupsets.pairId AND endTimestamp > backupsets.lastTimestamp)")
+        globs.db.dbCommit()
+        globs.db.forgetBackupSets()
+
+        # Check success, warning, & error flags - Issue #172
+        dbCursor = globs.db.execSqlStmt("SELECT DISTINCT parsedResult FROM report")
+        for parsedResult, in dbCursor.fetchall():
+            self.resultList[parsedResult] = True
+        return None
+
+    # Note that an email with this result was seen while collecting - Issue #172
+    # Called on the database writer (main) thread, so collector threads don't change the report at the same time
+    def noteResult(self, parsedResult):
+        self.resultList[parsedResult] = True
+        return None
+
+    # Extract the report data one email at a time, for versions of SQLite without window functions
+    def extractReportDataByRow(self):
         # Select source/destination pairs from database
-        sqlStmt = "SELECT source, destination, lastTimestamp, lastFileCount, lastFileSize, dupversion FROM backupsets ORDER BY source, destination"
+        bkSets = globs.db.getBackupSets()
+        bkSetRows = [(bkSet['pairId'], source, destination, bkSet['lastTimestamp'], bkSet['lastFileCount'], bkSet['lastFileSize'], bkSet['dupversion']) for (source, destination), bkSet in sorted(bkSets.items())]
 
-        # Loop through backupsets table and then get latest activity for each src/dest pair
-        dbCursor = globs.db.execSqlStmt(sqlStmt)
-        bkSetRows = dbCursor.fetchall()
+        # Loop through backupsets and then get latest activity for each src/dest pair
         globs.log.write(globs.SEV_DEBUG, function='Report', action='extractReportData', msg='Backup set rows=[{}]'.format(bkSetRows))
-        for source, destination, lastTimestamp, lastFileCount, lastFileSize, lastdupversion in bkSetRows:
+        for pairId, source, destination, lastTimestamp, lastFileCount, lastFileSize, lastdupversion in bkSetRows:
             globs.log.write(globs.SEV_DEBUG, function='Report', action='extractReportData', msg='Next email record: Src={} Dest={} lastTimestamp={} lastFileCount={} lastFileSize={}  dupversion={}'.format(source, 
                 destination, lastTimestamp, lastFileCount, lastFileSize, lastdupversion))
 
@@ -680,8 +741,8 @@ class Report:
 
             # Select all activity for src/dest pair since last report run
             sqlStmt = 'SELECT dupVersion, endTimestamp, beginTimeStamp, duration, examinedFiles, sizeOfExaminedFiles, addedFiles, deletedFiles, modifiedFiles, \
-                filesWithError, parsedResult, warnings, errors, messages, logdata, bytesUploaded, bytesDownloaded FROM emails WHERE sourceComp=\'{}\' AND destComp=\'{}\' \
-                AND  endTimestamp > {} order by endTimestamp'.format(source, destination, lastTimestamp)
+                filesWithError, parsedResult, warnings, errors, messages, logdata, bytesUploaded, bytesDownloaded FROM emails WHERE pairId={} \
+                AND  endTimestamp > {} order by endTimestamp'.format(pairId, lastTimestamp)
             dbCursor = globs.db.execSqlStmt(sqlStmt)
 
             emailRows = dbCursor.fetchall()
@@ -700,32 +761,22 @@ class Report:
                     fileSizeDelta = sizeOfExaminedFiles - lastFileSize
                     globs.log.write(globs.SEV_DEBUG, function='Report', action='extractReportData', msg='Calculating examined file size difference: {} - {} = {}'.format(sizeOfExaminedFiles, lastFileSize, fileSizeDelta))
 
-                    # Create date & time fields from timestamp field.
-                    # This makes it much easier to extract & sort later on rather than trying to manipulate the timestamp at runtime
-                    soloDate, soloTime = drdatetime.fromTimestamp(endTimeStamp, dfmt='YYYY-MM-DD')
-                    soloDate += ' 00:00:00'
-                    soloTime = '2000-01-01 ' + soloTime
-                    reportDateStamp = drdatetime.toTimestamp(soloDate, 'YYYY-MM-DD', 'HH:MM:SS')
-                    reportTimeStamp = drdatetime.toTimestamp(soloTime, 'YYYY-MM-DD', 'HH:MM:SS')
+                    reportDateStamp, reportTimeStamp = splitTimestamp(endTimeStamp)
                     
                     # Convert from timestamp to date & time strings
-                    sqlStmt = "INSERT INTO report (source, destination, timestamp, date, time, duration, examinedFiles, examinedFilesDelta, sizeOfExaminedFiles, fileSizeDelta, \
+                    sqlStmt = "INSERT INTO report (pairId, source, destination, timestamp, date, time, duration, examinedFiles, examinedFilesDelta, sizeOfExaminedFiles, fileSizeDelta, \
                         addedFiles, deletedFiles, modifiedFiles, filesWithError, parsedResult, messages, warnings, errors, dupversion, logdata, bytesUploaded, bytesDownloaded) \
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
-                    rptData = (source, destination, endTimeStamp, reportDateStamp, reportTimeStamp, duration, examinedFiles, examinedFilesDelta, sizeOfExaminedFiles, fileSizeDelta, addedFiles, deletedFiles, modifiedFiles, filesWithError, parsedResult, messages, warnings, errors, dupversion, logdata, bytesUploaded, bytesDownloaded)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                    rptData = (pairId, source, destination, endTimeStamp, reportDateStamp, reportTimeStamp, duration, examinedFiles, examinedFilesDelta, sizeOfExaminedFiles, fileSizeDelta, addedFiles, deletedFiles, modifiedFiles, filesWithError, parsedResult, messages, warnings, errors, dupversion, logdata, bytesUploaded, bytesDownloaded)
                     globs.db.execReportInsertSql(sqlStmt, rptData)
 
                     # Update latest activity into into backupsets
                     # Issue #138 - If the run was an error, there might not be a version number (depending on the Duplicati version)
                     # Get the current values of these fields, use them if the new ones are invalid.
-                    sqlStmt = 'SELECT lastFileCount, lastFileSize, lasttimestamp, dupversion FROM backupsets WHERE source=\'{}\' AND destination=\'{}\''.format(source, destination)
-                    dbCursor = globs.db.execSqlStmt(sqlStmt)
-                    setRow = dbCursor.fetchone()
                     if dupversion == '':
-                        dupversion = setRow[3]
+                        dupversion = bkSets[(source, destination)]['dupversion']
 
-                    sqlStmt = 'UPDATE backupsets SET lastFileCount={}, lastFileSize={}, lasttimestamp=\'{}\', dupversion=\'{}\' WHERE source=\'{}\' AND destination=\'{}\''.format(examinedFiles, sizeOfExaminedFiles, endTimeStamp, dupversion, source, destination)
-                    globs.db.execSqlStmt(sqlStmt)
+                    globs.db.updateBackupSet(source, destination, examinedFiles, sizeOfExaminedFiles, endTimeStamp, dupversion)
                     globs.db.dbCommit()
 
                     # Set last file count & size the latest information
@@ -1216,21 +1267,19 @@ class Report:
                 singleReport['dataRows'][dataRowIndex].append([newStr, '#FFFFFF', markup])
 
         # Select all source/destination pairs (& last seen timestamp) from the backupset list 
-        sqlStmt = "SELECT DISTINCT source, destination, lasttimestamp FROM backupsets"
-        dbCursor = globs.db.execSqlStmt(sqlStmt)
-        sourceDestList = dbCursor.fetchall()
+        sourceDestList = [(bkSet['pairId'], source, destination, bkSet['lastTimestamp']) for (source, destination), bkSet in globs.db.getBackupSets().items()]
 
-        for source, destination, lastTimestamp in sourceDestList:
-            sqlStmt = "SELECT count(*) FROM report WHERE source='{}' and destination='{}'".format(source, destination)
-            dbCursor = globs.db.execSqlStmt(sqlStmt)
-            countRows = dbCursor.fetchone()
+        # Source/destination pairs that have activity in the report
+        dbCursor = globs.db.execSqlStmt("SELECT DISTINCT pairId FROM report")
+        reportedSets = set(pairId for pairId, in dbCursor.fetchall())
 
+        for pairId, source, destination, lastTimestamp in sourceDestList:
             # Are we ignoring this S-D pair? (Issue #178)
             if ingoreSDPair(source, destination) == True:
                 globs.log.write(globs.SEV_DEBUG, function='Report', action='buildNoActivityOutput', msg='Ignoring {}{}{}'.format(source, globs.opts['srcdestdelimiter'], destination))
                 continue
 
-            if countRows[0] == 0:
+            if pairId not in reportedSets:
                 # Calculate days since last activity & set background accordingly
                 srcDest = '{}{}{}'.format(source, globs.opts['srcdestdelimiter'], destination)
                 diff = drdatetime.daysSince(lastTimestamp)
@@ -1340,9 +1389,7 @@ class Report:
                 singleReport['dataRows'][dataRowIndex].append([newStr, '#FFFFFF', markup])
 
         # Select all source/destination pairs (& last seen timestamp) from the backupset list 
-        sqlStmt = "SELECT source, destination, dupversion, lastTimestamp FROM backupsets ORDER BY source, destination"
-        dbCursor = globs.db.execSqlStmt(sqlStmt)
-        sourceDestList = dbCursor.fetchall()
+        sourceDestList = [(source, destination, bkSet['dupversion'], bkSet['lastTimestamp']) for (source, destination), bkSet in sorted(globs.db.getBackupSets().items())]
         globs.log.write(globs.SEV_DEBUG, function='Report', action='buildLastSeenOutput', msg='sourceDestList=[{}]'.format(sourceDestList))
 
         for source, destination, dupversion, lastTimestamp in sourceDestList: